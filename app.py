@@ -6,14 +6,27 @@ from routes.outline_keys import outline_keys_bp
 from routes.dynamic_keys import dynamic_keys_bp
 from routes.locations import locations_bp
 from routes.swagger import swagger_bp
+from routes.tokens import tokens_bp
+from routes.metrics import metrics_bp
+from database.database_manager import release_request_connections
+from metrics import start_request_timer, observe_request
 
 app = Flask(__name__)
 
+# return pooled database connections that a request did not release itself
+app.teardown_appcontext(release_request_connections)
+
+# time every request for GET /metrics
+app.before_request(start_request_timer)
+app.after_request(observe_request)
+
 # app.register_blueprint(swagger_bp)
 app.register_blueprint(servers_bp)
 app.register_blueprint(outline_keys_bp)
 app.register_blueprint(dynamic_keys_bp)
 app.register_blueprint(locations_bp)
+app.register_blueprint(tokens_bp)
+app.register_blueprint(metrics_bp)
 
 # Register the Swagger UI blueprint
 # app.register_blueprint(swagger_bp)
@@ -0,0 +1,103 @@
+import json
+import re
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags
+from app import app as flask_app
+from routes.dynamic_keys import CLIENT_CONFIG_CACHE_CONTROL, dynamic_key_etag
+from database.async_database_manager import AsyncDatabaseManager
+
+"""
+Asyncio serving mode: `gunicorn -k uvicorn.workers.UvicornWorker asgi:app` (or `uvicorn asgi:app`).
+
+GET /keys/<key_id>, the endpoint every Outline client calls on connect, is answered on the event loop with asyncpg,
+so one worker keeps serving thousands of clients waiting on the database instead of one. Everything else, including
+CORS preflight requests, is passed to the unchanged Flask app, which runs in a thread pool.
+"""
+
+DYNAMIC_KEY_PATH = re.compile(r"/keys/(\d+)")
+
+db_manager = AsyncDatabaseManager()
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def send_response(send, scope: dict, body: dict | bytes | None, status: int, etag: str | None = None) -> None:
+    # Same body and headers as the Flask view in routes/dynamic_keys.py with flask_cors' @cross_origin(),
+    # bytes are pre-serialized JSON and sent as is, None is an empty 304 body
+    headers = []
+    content = b""
+    if body is not None:
+        if isinstance(body, bytes):
+            content = body
+        else:
+            content = (json.dumps(body, sort_keys=True, separators=(",", ":")) + "\n").encode("utf-8")
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode())]
+
+    if etag is not None:
+        headers += [(b"etag", f'"{etag}"'.encode()), (b"cache-control", CLIENT_CONFIG_CACHE_CONTROL.encode())]
+
+    origin = dict(scope["headers"]).get(b"origin")
+    if origin is None:
+        headers.append((b"access-control-allow-origin", b"*"))
+    else:
+        headers += [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": content})
+
+
+async def get_dynamic_key(scope: dict, send, key_id: int) -> None:
+    try:
+        tg_user_id = int(parse_qs(scope["query_string"].decode("latin-1"))["tg_user_id"][0])
+    except (KeyError, ValueError):
+        tg_user_id = None
+
+    if not tg_user_id:
+        return await send_response(send, scope, {"error": "Both key_id and tg_user_id are required"}, 400)
+
+    try:
+        # Conditional request, the version lookup is cheaper than fetching the config
+        if_none_match = dict(scope["headers"]).get(b"if-none-match")
+        if if_none_match:
+            version = await db_manager.get_dynamic_key_version(key_id, tg_user_id)
+            etag = dynamic_key_etag(key_id, version)
+            if version is not None and parse_etags(if_none_match.decode("latin-1")).contains_weak(etag):
+                return await send_response(send, scope, None, 304, etag)
+
+        result = await db_manager.get_dynamic_key_client_config(key_id, tg_user_id)
+    except Exception as e:
+        return await send_response(send, scope, {"error": "An unexpected error occurred", "details": str(e)}, 500)
+
+    if result is None:
+        return await send_response(send, scope, {"error": "Key not found or inactive"}, 404)
+
+    version, client_config = result
+    await send_response(send, scope, client_config, 200, dynamic_key_etag(key_id, version))
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await db_manager.open()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await db_manager.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: dict, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] == "http" and scope["method"] == "GET":
+        match = DYNAMIC_KEY_PATH.fullmatch(scope["path"])
+        if match:
+            return await get_dynamic_key(scope, send, int(match[1]))
+
+    await wsgi_app(scope, receive, send)
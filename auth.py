@@ -0,0 +1,134 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+from werkzeug.security import generate_password_hash, check_password_hash
+from config import (BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD, AUTH_CACHE_TTL, AUTH_CACHE_SIZE, AUTH_TOKEN_SECRET,
+                    AUTH_TOKEN_TTL)
+
+"""
+Admin authentication: HTTP Basic auth for the operator and HMAC-signed bearer tokens for the Telegram bot.
+Routes protect themselves with `@auth.login_required`, which accepts either scheme.
+"""
+
+# Derived once per process, hashing the password is deliberately slow
+BASIC_AUTH_PASSWORD_HASH: str | None = generate_password_hash(BASIC_AUTH_PASSWORD) if BASIC_AUTH_PASSWORD else None
+
+
+class VerifiedCredentialsCache:
+    """
+    Bounded LRU set of recently verified credentials with a time-to-live.
+
+    Credentials are stored as keyed digests with a per-process random key, never in plain text.
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._key = os.urandom(32)
+        self._entries: OrderedDict[bytes, float] = OrderedDict()  # digest -> expiry time
+        self._lock = threading.Lock()
+
+    def _digest(self, username: str, password: str) -> bytes:
+        return hmac.new(self._key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def contains(self, username: str, password: str) -> bool:
+        digest = self._digest(username, password)
+        with self._lock:
+            expires_at = self._entries.get(digest)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._entries[digest]
+                return False
+            self._entries.move_to_end(digest)
+            return True
+
+    def add(self, username: str, password: str) -> None:
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        digest = self._digest(username, password)
+        with self._lock:
+            self._entries[digest] = time.monotonic() + self.ttl
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+verified_credentials = VerifiedCredentialsCache(AUTH_CACHE_TTL, AUTH_CACHE_SIZE)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str, secret: str) -> str:
+    return _b64encode(hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(subject: str, ttl: int = AUTH_TOKEN_TTL, secret: str | None = None) -> tuple[str, int]:
+    """Return a bearer token for `subject` and its expiry as a unix timestamp."""
+    secret = secret or AUTH_TOKEN_SECRET
+    if not secret:
+        raise ValueError("AUTH_TOKEN_SECRET is not set")
+
+    expires_at = int(time.time()) + ttl
+    payload = _b64encode(f"{subject}:{expires_at}".encode())
+    return f"{payload}.{_sign(payload, secret)}", expires_at
+
+
+def parse_token(token: str, secret: str | None = None) -> str | None:
+    """Return the subject of a valid, unexpired token, otherwise None."""
+    secret = secret or AUTH_TOKEN_SECRET
+    if not secret or not token or token.count(".") != 1:
+        return None
+
+    payload, signature = token.split(".")
+    if not hmac.compare_digest(signature.encode(), _sign(payload, secret).encode()):
+        return None
+
+    try:
+        subject, expires_at = _b64decode(payload).decode("utf-8").rsplit(":", 1)
+        if int(expires_at) < time.time():
+            return None
+    except ValueError:
+        return None
+
+    return subject
+
+
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme="Bearer")
+auth = MultiAuth(basic_auth, token_auth)
+
+
+@basic_auth.verify_password
+def verify_password(username, password):
+    if BASIC_AUTH_PASSWORD_HASH is None or username != BASIC_AUTH_USERNAME:
+        return False
+
+    if verified_credentials.contains(username, password):
+        return True
+
+    if check_password_hash(BASIC_AUTH_PASSWORD_HASH, password):
+        verified_credentials.add(username, password)
+        return True
+
+    return False
+
+
+@token_auth.verify_token
+def verify_token(token):
+    return parse_token(token)
@@ -0,0 +1,62 @@
+import argparse
+import statistics
+import time
+from unittest.mock import patch
+from database import prepared_statements
+from database.database_manager import DatabaseManager
+
+"""
+Per-lookup latency of DatabaseManager.get_dynamic_key_client_config with and without server-side prepared
+statements.
+
+Runs against the database configured in .env and needs at least one active dynamic key. The cache tier is bypassed
+so every lookup reaches Postgres. Usage: python -m benchmarks.prepared_statements --lookups 5000
+"""
+
+
+def measure(db_manager: DatabaseManager, key_id: int, tg_user_id: int, lookups: int) -> list[float]:
+    timings = []
+    for _ in range(lookups):
+        started = time.perf_counter()
+        db_manager.get_dynamic_key_client_config(key_id, tg_user_id)
+        timings.append((time.perf_counter() - started) * 1_000_000)
+    return timings
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{label:<10} mean {statistics.mean(timings):8.1f} us   p50 {statistics.median(timings):8.1f} us   "
+          f"p99 {p99:8.1f} us")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lookups", type=int, default=5000, help="lookups per mode")
+    parser.add_argument("--warmup", type=int, default=200, help="untimed lookups before each mode")
+    args = parser.parse_args()
+
+    with patch("database.database_manager.get_cache", return_value=None):
+        results = {}
+        for label, enabled in [("plain", False), ("prepared", True)]:
+            db_manager = DatabaseManager()
+            try:
+                db_manager.cursor.execute("SELECT id, tg_user_id FROM dynamic_key WHERE is_active = TRUE LIMIT 1;")
+                row = db_manager.cursor.fetchone()
+                if row is None:
+                    raise SystemExit("No active dynamic key found, create one first")
+
+                with patch.object(prepared_statements, "POSTGRES_PREPARED_STATEMENTS", enabled):
+                    measure(db_manager, *row, args.warmup)
+                    results[label] = measure(db_manager, *row, args.lookups)
+            finally:
+                db_manager.close()
+
+    for label, timings in results.items():
+        report(label, timings)
+    speedup = statistics.mean(results["plain"]) / statistics.mean(results["prepared"])
+    print(f"prepared statements are {speedup:.2f}x faster per lookup")
+
+
+if __name__ == "__main__":
+    main()
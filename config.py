@@ -1,6 +1,4 @@
 import os
-from flask_httpauth import HTTPBasicAuth
-from werkzeug.security import generate_password_hash, check_password_hash
 
 """
 This code first checks whether the DOCKER_CONTAINER environment variable is set.
@@ -38,6 +36,84 @@ POSTGRES_CREDENTIALS: dict[str, str] = {
     "port": POSTGRES_PORT
 }
 
+# Connection pool used by DatabaseManager, one per gunicorn worker. POSTGRES_POOL_SIZE=0 turns pooling off and
+# makes every DatabaseManager open its own connection.
+POSTGRES_POOL_SIZE: int = int(os.getenv("POSTGRES_POOL_SIZE", 10))
+POSTGRES_POOL_TIMEOUT: float = float(os.getenv("POSTGRES_POOL_TIMEOUT", 5))
+POSTGRES_POOL_PING_INTERVAL: float = float(os.getenv("POSTGRES_POOL_PING_INTERVAL", 30))
+# Prepare hot queries once per connection, set to false behind transaction-pooling proxies such as PgBouncer
+POSTGRES_PREPARED_STATEMENTS: bool = os.getenv("POSTGRES_PREPARED_STATEMENTS", "true").lower() == "true"
+
+# Locations, providers and servers are kept in memory by every worker and reloaded on change notifications, plus
+# every REFERENCE_DATA_REFRESH_INTERVAL seconds in case a notification was missed (0 turns the periodic reload off)
+REFERENCE_DATA_REFRESH_INTERVAL: float = float(os.getenv("REFERENCE_DATA_REFRESH_INTERVAL", 300))
+
+# Optional cache in front of dynamic key lookups: empty to disable, "local://" or "redis://host:port/db"
+CACHE_URL: str = os.getenv("CACHE_URL", "")
+CACHE_TTL: int = int(os.getenv("CACHE_TTL", 300))
+# seconds a changed dynamic key is kept out of the cache, longer than any lookup takes from reading the row to
+# caching it
+CACHE_TOMBSTONE_TTL: int = int(os.getenv("CACHE_TOMBSTONE_TTL", 10))
+
+# Choice of the server a new dynamic key of a location is assigned to, see database/server_selection.py: seconds the
+# per-worker server scores are cached, and the spare key count and API latency at which a server's weight is halved
+SERVER_SELECTION_REFRESH_INTERVAL: float = float(os.getenv("SERVER_SELECTION_REFRESH_INTERVAL", 10))
+SERVER_SELECTION_SPARE_KEYS_REFERENCE: int = int(os.getenv("SERVER_SELECTION_SPARE_KEYS_REFERENCE", 10))
+SERVER_SELECTION_LATENCY_REFERENCE_MS: float = float(os.getenv("SERVER_SELECTION_LATENCY_REFERENCE_MS", 500))
+
+# Bulk dynamic key endpoints (/keys/batch): max operations per request and operations applied per transaction
+DYNAMIC_KEYS_BATCH_MAX_SIZE: int = int(os.getenv("DYNAMIC_KEYS_BATCH_MAX_SIZE", 10000))
+DYNAMIC_KEYS_BATCH_CHUNK_SIZE: int = int(os.getenv("DYNAMIC_KEYS_BATCH_CHUNK_SIZE", 500))
+
+# Outline management API: timeout of a single call in seconds and max parallel key creations per Outline server
+OUTLINE_API_TIMEOUT: float = float(os.getenv("OUTLINE_API_TIMEOUT", 2))
+OUTLINE_PROVISIONING_CONCURRENCY: int = int(os.getenv("OUTLINE_PROVISIONING_CONCURRENCY", 8))
+# Retries of idempotent Outline API calls and the base delay between them in seconds, and the failed calls in a row
+# after which a server is not called for OUTLINE_CIRCUIT_RESET_TIMEOUT seconds, see outline/client.py
+OUTLINE_API_RETRIES: int = int(os.getenv("OUTLINE_API_RETRIES", 2))
+OUTLINE_API_RETRY_BACKOFF: float = float(os.getenv("OUTLINE_API_RETRY_BACKOFF", 0.2))
+OUTLINE_CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("OUTLINE_CIRCUIT_FAILURE_THRESHOLD", 5))
+OUTLINE_CIRCUIT_RESET_TIMEOUT: float = float(os.getenv("OUTLINE_CIRCUIT_RESET_TIMEOUT", 30))
+# number of created keys written to the database with one INSERT
+OUTLINE_KEYS_INSERT_BATCH_SIZE: int = int(os.getenv("OUTLINE_KEYS_INSERT_BATCH_SIZE", 100))
+
+# Spare key replenisher (python -m outline.replenisher), see outline/replenisher.py
+REPLENISHER_INTERVAL: float = float(os.getenv("REPLENISHER_INTERVAL", 60))
+REPLENISHER_WINDOW_HOURS: float = float(os.getenv("REPLENISHER_WINDOW_HOURS", 24))
+REPLENISHER_LEAD_TIME_HOURS: float = float(os.getenv("REPLENISHER_LEAD_TIME_HOURS", 6))
+REPLENISHER_MIN_UNUSED_KEYS: int = int(os.getenv("REPLENISHER_MIN_UNUSED_KEYS", 10))
+REPLENISHER_MAX_UNUSED_KEYS: int = int(os.getenv("REPLENISHER_MAX_UNUSED_KEYS", 500))
+REPLENISHER_TRIM_FACTOR: float = float(os.getenv("REPLENISHER_TRIM_FACTOR", 3))
+REPLENISHER_MAX_KEYS_PER_CYCLE: int = int(os.getenv("REPLENISHER_MAX_KEYS_PER_CYCLE", 100))
+# seconds between checks of the per-server key counters against the outline_key table, 0 disables them
+REPLENISHER_COUNTER_CHECK_INTERVAL: float = float(os.getenv("REPLENISHER_COUNTER_CHECK_INTERVAL", 3600))
+
+# Outline server health checker (python -m outline.health_checker), see outline/health_checker.py: seconds between
+# checks, timeout and max parallel checks, and consecutive failed/successful checks that deactivate/reactivate a server
+HEALTH_CHECK_INTERVAL: float = float(os.getenv("HEALTH_CHECK_INTERVAL", 5))
+HEALTH_CHECK_TIMEOUT: float = float(os.getenv("HEALTH_CHECK_TIMEOUT", 1))
+HEALTH_CHECK_CONCURRENCY: int = int(os.getenv("HEALTH_CHECK_CONCURRENCY", 32))
+HEALTH_CHECK_FAILURE_THRESHOLD: int = int(os.getenv("HEALTH_CHECK_FAILURE_THRESHOLD", 3))
+HEALTH_CHECK_RECOVERY_THRESHOLD: int = int(os.getenv("HEALTH_CHECK_RECOVERY_THRESHOLD", 5))
+
+# Reconciler of Outline servers and the outline_key table (python -m outline.reconciler), see outline/reconciler.py:
+# seconds between passes, whether differences are repaired or only reported, servers compared at once, timeout of
+# listing the keys of a server, and the share of a server's keys above which differences are not repaired
+RECONCILER_INTERVAL: float = float(os.getenv("RECONCILER_INTERVAL", 3600))
+RECONCILER_REPAIR: bool = os.getenv("RECONCILER_REPAIR", "false").lower() == "true"
+RECONCILER_CONCURRENCY: int = int(os.getenv("RECONCILER_CONCURRENCY", 4))
+RECONCILER_API_TIMEOUT: float = float(os.getenv("RECONCILER_API_TIMEOUT", 30))
+RECONCILER_MAX_REPAIR_FRACTION: float = float(os.getenv("RECONCILER_MAX_REPAIR_FRACTION", 0.2))
+
+# Transfer metrics collector (python -m outline.transfer_metrics), see outline/transfer_metrics.py: seconds between
+# samples, servers sampled at once, timeout of fetching the metrics of a server, and days the samples and the hourly
+# rollups are kept. Daily rollups are kept forever
+TRANSFER_METRICS_INTERVAL: float = float(os.getenv("TRANSFER_METRICS_INTERVAL", 300))
+TRANSFER_METRICS_CONCURRENCY: int = int(os.getenv("TRANSFER_METRICS_CONCURRENCY", 16))
+TRANSFER_METRICS_API_TIMEOUT: float = float(os.getenv("TRANSFER_METRICS_API_TIMEOUT", 10))
+TRANSFER_SAMPLE_RETENTION_DAYS: int = int(os.getenv("TRANSFER_SAMPLE_RETENTION_DAYS", 7))
+TRANSFER_HOURLY_RETENTION_DAYS: int = int(os.getenv("TRANSFER_HOURLY_RETENTION_DAYS", 90))
+
 """
 flask application auth related shit
 """
@@ -45,10 +121,10 @@ flask application auth related shit
 BASIC_AUTH_USERNAME = os.getenv("BASIC_AUTH_USERNAME")
 BASIC_AUTH_PASSWORD = os.getenv("BASIC_AUTH_PASSWORD")
 
-auth = HTTPBasicAuth()
-
+# successful basic auth checks are remembered for AUTH_CACHE_TTL seconds, for at most AUTH_CACHE_SIZE credentials
+AUTH_CACHE_TTL: float = float(os.getenv("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", 128))
 
-@auth.verify_password
-def verify_password(username, password):
-    return username == BASIC_AUTH_USERNAME and \
-           check_password_hash(generate_password_hash(BASIC_AUTH_PASSWORD), password)
\ No newline at end of file
+# secret for HMAC-signed bearer tokens, token auth is disabled when it is not set
+AUTH_TOKEN_SECRET: str | None = os.getenv("AUTH_TOKEN_SECRET")
+AUTH_TOKEN_TTL: int = int(os.getenv("AUTH_TOKEN_TTL", 86400))
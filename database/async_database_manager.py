@@ -0,0 +1,83 @@
+import asyncio
+from config import (POSTGRES_CREDENTIALS, POSTGRES_POOL_SIZE, POSTGRES_POOL_TIMEOUT, POSTGRES_PREPARED_STATEMENTS,
+                    CACHE_TTL)
+from database.cache import get_cache, dynamic_key_cache_key, pack_client_config, unpack_client_config
+
+"""
+asyncpg counterpart of DatabaseManager for the read-only Outline client hot path served by asgi.py.
+
+It shares the cache entries of DatabaseManager, so writes made through the Flask endpoints invalidate them for
+both serving modes.
+"""
+
+
+class AsyncDatabaseManager:
+
+    def __init__(self) -> None:
+        self._pool = None
+        self._lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        async with self._lock:
+            if self._pool is None:
+                import asyncpg  # optional dependency, only needed for the asyncio serving mode
+
+                credentials = POSTGRES_CREDENTIALS
+                self._pool = await asyncpg.create_pool(
+                    host=credentials["host"], port=credentials["port"], user=credentials["user"],
+                    password=credentials["password"], database=credentials["dbname"],
+                    min_size=1, max_size=max(POSTGRES_POOL_SIZE, 1),
+                    # asyncpg prepares statements itself, which transaction-pooling proxies can't hold on to
+                    statement_cache_size=100 if POSTGRES_PREPARED_STATEMENTS else 0,
+                )
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._pool is not None:
+                await self._pool.close()
+                self._pool = None
+
+    async def get_dynamic_key_client_config(self, key_id: int, tg_user_id: int) -> tuple[int, bytes] | None:
+        cache = get_cache()
+        cache_key = dynamic_key_cache_key(key_id, tg_user_id)
+        if cache is not None:
+            cached = unpack_client_config(await cache.aget(cache_key))
+            if cached is not None:
+                return cached
+
+        query = """
+            SELECT version, client_config
+            FROM dynamic_key
+            WHERE id = $1 AND tg_user_id = $2 AND is_active = TRUE
+        """
+        result = await self._fetchrow(query, key_id, tg_user_id)
+        if result:
+            version, client_config = result["version"], result["client_config"]
+            # Only found keys are cached, a missing key can be created at any moment. aadd() leaves the tombstone
+            # of a change committed since the row was read in place.
+            if cache is not None:
+                await cache.aadd(cache_key, pack_client_config(version, client_config), CACHE_TTL)
+            return version, client_config
+        return None
+
+    async def get_dynamic_key_version(self, key_id: int, tg_user_id: int) -> int | None:
+        cache = get_cache()
+        if cache is not None:
+            cached = unpack_client_config(await cache.aget(dynamic_key_cache_key(key_id, tg_user_id)))
+            if cached is not None:
+                return cached[0]
+
+        query = """
+            SELECT version
+            FROM dynamic_key
+            WHERE id = $1 AND tg_user_id = $2 AND is_active = TRUE
+        """
+        result = await self._fetchrow(query, key_id, tg_user_id)
+        return result["version"] if result else None
+
+    async def _fetchrow(self, query: str, *args):
+        if self._pool is None:
+            await self.open()
+
+        async with self._pool.acquire(timeout=POSTGRES_POOL_TIMEOUT) as conn:
+            return await conn.fetchrow(query, *args)
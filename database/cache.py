@@ -0,0 +1,202 @@
+import logging
+import os
+import threading
+import time
+from config import CACHE_URL
+
+"""
+Optional cache tier in front of hot DatabaseManager lookups.
+
+CACHE_URL selects the backend: empty disables caching, `local://` keeps entries in the memory of the current
+process (tests, single worker setups), and `redis://host:port/db` shares one cache between all gunicorn workers
+and app replicas.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """In-process cache with per-entry time-to-live."""
+
+    def __init__(self) -> None:
+        self._entries: dict[str, tuple[bytes, float]] = {}  # key -> (value, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+
+    def add(self, key: str, value: bytes, ttl: int) -> bool:
+        """Set `key` only if it holds no live entry, return whether it was set."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                return False
+            self._entries[key] = (value, time.monotonic() + ttl)
+            return True
+
+    def set_many(self, keys: list[str], value: bytes, ttl: int) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (value, time.monotonic() + ttl)
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    # coroutine versions for the asyncio serving mode, the dict lookups never block the event loop for long
+    async def aget(self, key: str) -> bytes | None:
+        return self.get(key)
+
+    async def aset(self, key: str, value: bytes, ttl: int) -> None:
+        self.set(key, value, ttl)
+
+    async def aadd(self, key: str, value: bytes, ttl: int) -> bool:
+        return self.add(key, value, ttl)
+
+
+class RedisCache:
+    """
+    Cache backed by any server that speaks the Redis protocol.
+
+    A cache outage must not take the API down, so failed reads count as misses and failed writes are only logged.
+    """
+
+    def __init__(self, url: str) -> None:
+        import redis  # optional dependency, only needed when a redis:// CACHE_URL is configured
+
+        self._url = url
+        self._errors = (redis.RedisError,)
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._async_client = None  # created on first use by the asyncio serving mode
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            return self._client.get(key)
+        except self._errors as e:
+            logger.warning("Cache read failed: %s", e)
+            return None
+
+    def set(self, key: str, value: bytes, ttl: int) -> None:
+        try:
+            self._client.set(key, value, ex=ttl)
+        except self._errors as e:
+            logger.warning("Cache write failed: %s", e)
+
+    def add(self, key: str, value: bytes, ttl: int) -> bool:
+        """Set `key` only if it does not exist (SET NX), return whether it was set."""
+        try:
+            return bool(self._client.set(key, value, ex=ttl, nx=True))
+        except self._errors as e:
+            logger.warning("Cache write failed: %s", e)
+            return False
+
+    def set_many(self, keys: list[str], value: bytes, ttl: int) -> None:
+        try:
+            pipeline = self._client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.set(key, value, ex=ttl)
+            pipeline.execute()
+        except self._errors as e:
+            logger.warning("Cache write failed for %s: %s", keys, e)
+
+    def delete(self, *keys: str) -> None:
+        try:
+            self._client.delete(*keys)
+        except self._errors as e:
+            logger.warning("Cache invalidation failed for %s: %s", keys, e)
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            import redis.asyncio
+
+            self._async_client = redis.asyncio.Redis.from_url(self._url, socket_timeout=0.5,
+                                                              socket_connect_timeout=0.5)
+        return self._async_client
+
+    async def aget(self, key: str) -> bytes | None:
+        try:
+            return await self.async_client.get(key)
+        except self._errors as e:
+            logger.warning("Cache read failed: %s", e)
+            return None
+
+    async def aset(self, key: str, value: bytes, ttl: int) -> None:
+        try:
+            await self.async_client.set(key, value, ex=ttl)
+        except self._errors as e:
+            logger.warning("Cache write failed: %s", e)
+
+    async def aadd(self, key: str, value: bytes, ttl: int) -> bool:
+        try:
+            return bool(await self.async_client.set(key, value, ex=ttl, nx=True))
+        except self._errors as e:
+            logger.warning("Cache write failed: %s", e)
+            return False
+
+
+_cache: LocalCache | RedisCache | None = None
+_cache_pid: int | None = None
+_cache_lock = threading.Lock()
+
+
+def create_cache(url: str) -> LocalCache | RedisCache | None:
+    if not url:
+        return None
+    if url.startswith("local://"):
+        return LocalCache()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    raise ValueError(f"Unsupported CACHE_URL scheme: {url}")
+
+
+def get_cache() -> LocalCache | RedisCache | None:
+    """Return the cache of the current process, or None when caching is disabled."""
+    global _cache, _cache_pid
+
+    pid = os.getpid()
+    if _cache_pid != pid:
+        with _cache_lock:
+            if _cache_pid != pid:
+                _cache = create_cache(CACHE_URL)
+                _cache_pid = pid
+    return _cache
+
+
+# Written in place of the entry of a changed dynamic key for CACHE_TOMBSTONE_TTL seconds. Entries are only ever
+# filled with add(), so a lookup that read the row before the change committed can't put the stale row back.
+TOMBSTONE: bytes = b"-"
+
+
+def dynamic_key_cache_key(key_id: int, tg_user_id: int) -> str:
+    # entries hold the version and the pre-serialized client config of the key, see pack_client_config()
+    return f"dynamic_key_versioned_config:{key_id}:{tg_user_id}"
+
+
+def pack_client_config(version: int, client_config: bytes) -> bytes:
+    return b"%d\n%s" % (version, client_config)
+
+
+def unpack_client_config(value: bytes | None) -> tuple[int, bytes] | None:
+    """Return the (version, client_config) of a cache entry, None for a missing entry or a tombstone."""
+    if value is None or value == TOMBSTONE:
+        return None
+    version, client_config = value.split(b"\n", 1)
+    return int(version), client_config
@@ -0,0 +1,135 @@
+import os
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+from config import (POSTGRES_CREDENTIALS, POSTGRES_POOL_SIZE, POSTGRES_POOL_TIMEOUT,
+                    POSTGRES_POOL_PING_INTERVAL)
+from database.prepared_statements import PreparedStatementsConnection
+from metrics import DB_POOL_WAIT, DB_CONNECT, DB_POOL_TIMEOUTS
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """Raised when no connection was returned to the pool within the configured timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of PostgreSQL connections.
+
+    At most `max_size` connections are borrowed at the same time, callers beyond that wait up to `timeout`
+    seconds for a free one. Idle connections are checked before they are handed out: broken ones are dropped,
+    and ones that have been idle longer than `ping_interval` seconds are pinged with `SELECT 1`.
+    """
+
+    def __init__(self, max_size: int, timeout: float, ping_interval: float, credentials: dict[str, any]) -> None:
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._credentials = credentials
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: list[tuple[extensions.connection, float]] = []  # (connection, time it was returned)
+
+    def getconn(self) -> extensions.connection:
+        with DB_POOL_WAIT.time():
+            acquired = self._slots.acquire(timeout=self.timeout)
+        if not acquired:
+            DB_POOL_TIMEOUTS.inc()
+            raise PoolTimeoutError(f"No database connection available within {self.timeout} seconds")
+
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.pop() if self._idle else None
+
+                if idle is None:
+                    with DB_CONNECT.time():
+                        conn = psycopg2.connect(connection_factory=PreparedStatementsConnection,
+                                                **self._credentials)
+                    break
+
+                conn, returned_at = idle
+                if self._is_alive(conn, returned_at):
+                    break
+                self._discard(conn)
+
+            conn.autocommit = True
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn: extensions.connection, discard: bool = False) -> None:
+        try:
+            if not discard and not conn.closed:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    # server connection lost
+                    discard = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    # connection left in a transaction or in an error state
+                    conn.rollback()
+
+            if discard or conn.closed:
+                self._discard(conn)
+            else:
+                conn.autocommit = True
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def _is_alive(self, conn: extensions.connection, returned_at: float) -> bool:
+        if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        if time.monotonic() - returned_at < self.ping_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn: extensions.connection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool: ConnectionPool | None = None
+_pool_pid: int | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Return the connection pool of the current process, creating it on first use.
+
+    The pool is keyed by PID: a gunicorn worker forked from a master that already had a pool gets its own,
+    and the connections inherited from the parent are abandoned rather than closed, because closing them
+    would terminate the sessions the parent still uses.
+    """
+    global _pool, _pool_pid
+
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(POSTGRES_POOL_SIZE, POSTGRES_POOL_TIMEOUT, POSTGRES_POOL_PING_INTERVAL,
+                                       POSTGRES_CREDENTIALS)
+                _pool_pid = pid
+    return _pool
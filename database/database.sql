@@ -4,13 +4,25 @@ DROP TABLE IF EXISTS server_provider CASCADE;
 DROP TABLE IF EXISTS outline_server_info CASCADE;
 DROP TABLE IF EXISTS dynamic_key CASCADE;
 DROP TABLE IF EXISTS outline_key CASCADE;
+DROP TABLE IF EXISTS transfer_sample CASCADE;
+DROP TABLE IF EXISTS transfer_hourly CASCADE;
+DROP TABLE IF EXISTS transfer_daily CASCADE;
+DROP TABLE IF EXISTS transfer_last CASCADE;
+DROP TABLE IF EXISTS transfer_last_report CASCADE;
 
 CREATE TABLE outline_server (
     id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     hostname VARCHAR NOT NULL,
     port INTEGER NOT NULL,
-    api_url VARCHAR NOT NULL,
-    is_active BOOLEAN NOT NULL
+    api_url VARCHAR NOT NULL UNIQUE,
+    is_active BOOLEAN NOT NULL,
+    unused_keys INTEGER NOT NULL DEFAULT 0,
+    used_keys INTEGER NOT NULL DEFAULT 0,
+    latency_ms REAL,
+    health_history INTEGER NOT NULL DEFAULT -1,
+    health_checked_at TIMESTAMPTZ,
+    health_deactivated BOOLEAN NOT NULL DEFAULT FALSE,
+    api_version VARCHAR
 );
 
 CREATE TABLE server_location (
@@ -41,10 +53,35 @@ CREATE TABLE outline_key (
     fk_outline_server_id INTEGER NOT NULL,
     access_url VARCHAR NOT NULL,
     currently_used BOOLEAN NOT NULL,
+    last_allocated_at TIMESTAMPTZ,
 
     FOREIGN KEY (fk_outline_server_id) REFERENCES outline_server (id)
 );
 
+-- JSON text of a value with non-ASCII characters escaped as \uXXXX, surrogate pairs above U+FFFF, like the
+-- ensure_ascii output of Python's json.dumps that Flask's jsonify() uses. ASCII text is returned as it is.
+CREATE OR REPLACE FUNCTION json_ascii(value JSON) RETURNS TEXT
+LANGUAGE sql IMMUTABLE STRICT AS $$
+    SELECT CASE WHEN octet_length(value::TEXT) = length(value::TEXT) THEN value::TEXT ELSE (
+        SELECT string_agg(CASE WHEN code < 128 THEN c
+                               WHEN code < 65536 THEN '\u' || lpad(to_hex(code), 4, '0')
+                               ELSE '\u' || to_hex(55296 + (code - 65536) / 1024) ||
+                                    '\u' || to_hex(56320 + (code - 65536) % 1024) END, '' ORDER BY n)
+        FROM regexp_split_to_table(value::TEXT, '') WITH ORDINALITY AS chars(c, n), ascii(c) AS code
+    ) END;
+$$;
+
+-- Response body of GET /keys/<key_id> (Outline client config), same bytes as Flask's jsonify() of the key fields.
+-- Stored in dynamic_key.client_config whenever a key is written, so lookups serve it without any JSON work.
+CREATE OR REPLACE FUNCTION dynamic_key_client_config(server VARCHAR, server_port INTEGER,
+                                                     password VARCHAR, method VARCHAR)
+RETURNS BYTEA
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT convert_to(format('{"method":%s,"password":%s,"server":%s,"server_port":%s}',
+                             json_ascii(to_json(method)), json_ascii(to_json(password)),
+                             json_ascii(to_json(server)), server_port) || E'\n', 'UTF8');
+$$;
+
 CREATE TABLE dynamic_key (
     id BIGINT PRIMARY KEY CHECK (id >= 100000000 AND id <= 999999999),
     tg_user_id BIGINT NOT NULL,
@@ -54,16 +91,238 @@ CREATE TABLE dynamic_key (
     method VARCHAR NOT NULL,
     is_active BOOLEAN NOT NULL,
     fk_outline_key_uuid UUID NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    client_config BYTEA GENERATED ALWAYS AS (dynamic_key_client_config(server, server_port, password, method)) STORED,
 
     FOREIGN KEY (fk_outline_key_uuid) REFERENCES outline_key (uuid)
 );
 
+-- Split an Outline access url (ss://base64(method:password)@server:server_port/...) into dynamic key fields.
+-- Unpadded and url-safe base64 is accepted as well.
+CREATE OR REPLACE FUNCTION parse_access_url(access_url VARCHAR,
+                                            OUT server VARCHAR, OUT server_port INTEGER,
+                                            OUT password VARCHAR, OUT method VARCHAR)
+LANGUAGE sql IMMUTABLE STRICT AS $$
+    SELECT split_part(host_port, ':', 1), split_part(host_port, ':', 2)::INTEGER,
+           split_part(credentials, ':', 2), split_part(credentials, ':', 1)
+    FROM (
+        SELECT convert_from(decode(rpad(translate(user_info, '-_', '+/'), (length(user_info) + 3) / 4 * 4, '='),
+                                   'base64'), 'UTF8') AS credentials,
+               host_port
+        FROM (
+            SELECT split_part(substr(access_url, 6), '@', 1) AS user_info,
+                   split_part(split_part(access_url, '@', 2), '/', 1) AS host_port
+        ) AS url_parts
+    ) AS parts;
+$$;
+
+-- Per-server unused/used key counters (outline_server.unused_keys, used_keys), kept up to date by statement level
+-- triggers on outline_key: a batch insert or a claim changes each affected server row once per statement.
+CREATE OR REPLACE FUNCTION outline_server_key_counters_trigger() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    changes TEXT := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT fk_outline_server_id, currently_used, 1 AS delta FROM new_keys'
+        WHEN 'DELETE' THEN 'SELECT fk_outline_server_id, currently_used, -1 AS delta FROM old_keys'
+        ELSE 'SELECT fk_outline_server_id, currently_used, 1 AS delta FROM new_keys
+              UNION ALL
+              SELECT fk_outline_server_id, currently_used, -1 AS delta FROM old_keys'
+    END;
+BEGIN
+    EXECUTE format('
+        UPDATE outline_server os
+        SET unused_keys = os.unused_keys + c.unused_delta, used_keys = os.used_keys + c.used_delta
+        FROM (
+            SELECT fk_outline_server_id,
+                   COALESCE(SUM(delta) FILTER (WHERE NOT currently_used), 0) AS unused_delta,
+                   COALESCE(SUM(delta) FILTER (WHERE currently_used), 0) AS used_delta
+            FROM (%s) AS changes
+            GROUP BY fk_outline_server_id
+        ) c
+        WHERE os.id = c.fk_outline_server_id AND (c.unused_delta <> 0 OR c.used_delta <> 0)', changes);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS outline_key_counters_insert ON outline_key;
+CREATE TRIGGER outline_key_counters_insert AFTER INSERT ON outline_key
+REFERENCING NEW TABLE AS new_keys
+FOR EACH STATEMENT EXECUTE FUNCTION outline_server_key_counters_trigger();
+
+DROP TRIGGER IF EXISTS outline_key_counters_update ON outline_key;
+CREATE TRIGGER outline_key_counters_update AFTER UPDATE ON outline_key
+REFERENCING OLD TABLE AS old_keys NEW TABLE AS new_keys
+FOR EACH STATEMENT EXECUTE FUNCTION outline_server_key_counters_trigger();
+
+DROP TRIGGER IF EXISTS outline_key_counters_delete ON outline_key;
+CREATE TRIGGER outline_key_counters_delete AFTER DELETE ON outline_key
+REFERENCING OLD TABLE AS old_keys
+FOR EACH STATEMENT EXECUTE FUNCTION outline_server_key_counters_trigger();
+
+-- Recount the key counters of every server and fix the ones that drifted, returning the corrections.
+-- Server rows are locked first, so key changes committed meanwhile are either counted or applied afterwards.
+CREATE OR REPLACE FUNCTION repair_outline_server_key_counters()
+RETURNS TABLE (server_id INTEGER, unused_keys_drift INTEGER, used_keys_drift INTEGER)
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM 1 FROM outline_server ORDER BY id FOR UPDATE;
+
+    RETURN QUERY
+    WITH counts AS (
+        SELECT os.id,
+               COUNT(ok.uuid) FILTER (WHERE ok.currently_used = FALSE)::INTEGER AS unused_keys,
+               COUNT(ok.uuid) FILTER (WHERE ok.currently_used = TRUE)::INTEGER AS used_keys
+        FROM outline_server os
+        LEFT JOIN outline_key ok ON os.id = ok.fk_outline_server_id
+        GROUP BY os.id
+    ),
+    drifted AS (
+        SELECT c.id, c.unused_keys, c.used_keys, os.unused_keys AS old_unused_keys, os.used_keys AS old_used_keys
+        FROM counts c
+        JOIN outline_server os ON os.id = c.id
+        WHERE os.unused_keys <> c.unused_keys OR os.used_keys <> c.used_keys
+    ),
+    repaired AS (
+        UPDATE outline_server os
+        SET unused_keys = d.unused_keys, used_keys = d.used_keys
+        FROM drifted d
+        WHERE os.id = d.id
+    )
+    SELECT d.id, d.old_unused_keys - d.unused_keys, d.old_used_keys - d.used_keys FROM drifted d ORDER BY d.id;
+END;
+$$;
+
+-- Workers keep locations, providers and servers in memory (database/reference_data.py) and reload them when notified
+-- on reference_data_changed. outline_server only notifies for the columns they cache, not for key counter updates.
+CREATE OR REPLACE FUNCTION notify_reference_data_changed() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('reference_data_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS server_location_reference_data_changed ON server_location;
+CREATE TRIGGER server_location_reference_data_changed AFTER INSERT OR UPDATE OR DELETE ON server_location
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+DROP TRIGGER IF EXISTS server_provider_reference_data_changed ON server_provider;
+CREATE TRIGGER server_provider_reference_data_changed AFTER INSERT OR UPDATE OR DELETE ON server_provider
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+DROP TRIGGER IF EXISTS outline_server_info_reference_data_changed ON outline_server_info;
+CREATE TRIGGER outline_server_info_reference_data_changed AFTER INSERT OR UPDATE OR DELETE ON outline_server_info
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+DROP TRIGGER IF EXISTS outline_server_reference_data_changed ON outline_server;
+CREATE TRIGGER outline_server_reference_data_changed
+AFTER INSERT OR DELETE OR UPDATE OF hostname, port, api_url, is_active, api_version ON outline_server
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+-- Bytes transferred by every outline key since the previous sample of the transfer metrics collector
+-- (outline/transfer_metrics.py), only keys that transferred something get a row. Append-only and partitioned by UTC
+-- day, so expired samples are dropped as whole partitions. Columns are ordered by alignment to avoid padding, and the
+-- dynamic key is the one the outline key belonged to when it was sampled.
+CREATE TABLE IF NOT EXISTS transfer_sample (
+    sampled_at TIMESTAMPTZ NOT NULL,
+    bytes BIGINT NOT NULL,
+    dynamic_key_id BIGINT,
+    outline_key_uuid UUID NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL
+) PARTITION BY RANGE (sampled_at);
+
+-- Samples are appended in time order, a BRIN index finds the last hours for the rollups in a few pages
+CREATE INDEX IF NOT EXISTS idx_transfer_sample_sampled_at ON transfer_sample USING BRIN (sampled_at);
+
+-- Create the missing daily partitions of transfer_sample from first_day to last_day
+CREATE OR REPLACE FUNCTION create_transfer_sample_partitions(first_day DATE, last_day DATE) RETURNS VOID
+LANGUAGE plpgsql AS $$
+DECLARE
+    day DATE;
+BEGIN
+    FOR day IN SELECT generate_series(first_day, last_day, INTERVAL '1 day')::DATE LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF transfer_sample FOR VALUES FROM (%L) TO (%L)',
+                       'transfer_sample_' || to_char(day, 'YYYYMMDD'),
+                       day::TIMESTAMP AT TIME ZONE 'UTC', (day + 1)::TIMESTAMP AT TIME ZONE 'UTC');
+    END LOOP;
+END;
+$$;
+
+-- Drop the daily partitions of transfer_sample before before_day, returning their names
+CREATE OR REPLACE FUNCTION drop_transfer_sample_partitions(before_day DATE) RETURNS SETOF TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'transfer_sample'::REGCLASS
+          AND to_date(right(c.relname, 8), 'YYYYMMDD') < before_day
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$;
+
+-- Hourly and daily (UTC) transfer of every outline key, rolled up from transfer_sample by the collector. The dynamic
+-- key is the one of the latest sample of the period.
+CREATE TABLE IF NOT EXISTS transfer_hourly (
+    period_start TIMESTAMPTZ NOT NULL,
+    bytes BIGINT NOT NULL,
+    dynamic_key_id BIGINT,
+    outline_key_uuid UUID NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+
+    PRIMARY KEY (period_start, outline_key_uuid)
+);
+
+CREATE TABLE IF NOT EXISTS transfer_daily (
+    period_start TIMESTAMPTZ NOT NULL,
+    bytes BIGINT NOT NULL,
+    dynamic_key_id BIGINT,
+    outline_key_uuid UUID NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+
+    PRIMARY KEY (period_start, outline_key_uuid)
+);
+
+-- Index for the usage of one dynamic key over time
+CREATE INDEX IF NOT EXISTS idx_transfer_daily_dynamic_key_id ON transfer_daily (dynamic_key_id, period_start)
+WHERE dynamic_key_id IS NOT NULL;
+
+-- Last transfer metrics report of every server seen by the transfer metrics collector (outline/transfer_metrics.py),
+-- the bytes each Outline key id transferred in the 30 days before reported_at. Samples are the growth since this
+-- report, and it is replaced in the same transaction as the samples are stored, so collectors taking turns all
+-- compute against the latest report.
+CREATE TABLE IF NOT EXISTS transfer_last (
+    bytes BIGINT NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL,
+
+    PRIMARY KEY (fk_outline_server_id, outline_key_id)
+);
+
+-- Servers with a report in transfer_last, the first report of a server only primes it
+CREATE TABLE IF NOT EXISTS transfer_last_report (
+    fk_outline_server_id INTEGER PRIMARY KEY,
+    reported_at TIMESTAMPTZ NOT NULL
+);
+
 ALTER SEQUENCE outline_server_id_seq RESTART WITH 1;
 ALTER SEQUENCE server_location_id_seq RESTART WITH 1;
 ALTER SEQUENCE server_provider_id_seq RESTART WITH 1;
 
--- Index on fk_outline_server_id
-CREATE INDEX IF NOT EXISTS idx_outline_key_server_id ON outline_key (fk_outline_server_id);
+-- Index on fk_outline_server_id, ordered by uuid for the keyset pagination of GET /outline_keys/<server_id>
+CREATE INDEX IF NOT EXISTS idx_outline_key_server_id_uuid ON outline_key (fk_outline_server_id, uuid);
 
 -- Partial index on currently_used when true
 CREATE INDEX IF NOT EXISTS idx_outline_key_currently_used_true ON outline_key (fk_outline_server_id)
@@ -73,6 +332,17 @@ WHERE currently_used = true;
 CREATE INDEX IF NOT EXISTS idx_outline_key_currently_used_false ON outline_key (fk_outline_server_id)
 WHERE currently_used = false;
 
+-- Index for the one dynamic key per telegram user check done when a key is created
+CREATE INDEX IF NOT EXISTS idx_dynamic_key_tg_user_id ON dynamic_key (tg_user_id);
+
+-- Covering index for the version lookup that answers conditional GET /keys/<key_id> with an index-only scan
+CREATE INDEX IF NOT EXISTS idx_dynamic_key_version ON dynamic_key (id, tg_user_id) INCLUDE (version)
+WHERE is_active = TRUE;
+
+-- Index for the allocation rate used by the spare key replenisher
+CREATE INDEX IF NOT EXISTS idx_outline_key_last_allocated_at ON outline_key (fk_outline_server_id, last_allocated_at)
+WHERE last_allocated_at IS NOT NULL;
+
 -- Insert location information
 INSERT INTO server_location (location, location_ru, iso) VALUES
 ('Ascension Island', 'Остров Вознесения', 'AC'),
@@ -1,48 +1,79 @@
 import psycopg2
-from config import POSTGRES_CREDENTIALS
+from collections.abc import Iterator
+from datetime import date, datetime
+from psycopg2 import extensions, errors
+from psycopg2.extras import execute_values
+from flask import g, has_app_context
+from config import POSTGRES_CREDENTIALS, POSTGRES_POOL_SIZE, CACHE_TTL, CACHE_TOMBSTONE_TTL
+from database.connection_pool import get_pool
+from database.cache import (get_cache, dynamic_key_cache_key, pack_client_config, unpack_client_config,
+                            TOMBSTONE)
+from database.prepared_statements import PreparedStatementsConnection, execute_prepared
+from database.reference_data import get_reference_data
+from database.server_selection import get_server_selector
+from metrics import InstrumentedCursor, DB_CONNECT
 # import names
 import uuid
 import random
 import base64
+import io
 
 
 class DatabaseManager:
 
     def __init__(self) -> None:
-        self.conn = psycopg2.connect(**POSTGRES_CREDENTIALS)
-        self.conn.autocommit = True  # Set autocommit to True
-        self.cursor = self.conn.cursor()
+        # The connection is borrowed lazily, so requests rejected before touching the database never wait for one
+        self._conn: extensions.connection | None = None
+        self._cursor: extensions.cursor | None = None
+
+        # Remember managers created while handling a request, so their connections are returned when it ends
+        if has_app_context():
+            g.setdefault("db_managers", []).append(self)
+
+    @property
+    def conn(self) -> extensions.connection:
+        if self._conn is None:
+            if POSTGRES_POOL_SIZE > 0:
+                self._conn = get_pool().getconn()
+            else:
+                with DB_CONNECT.time():
+                    self._conn = psycopg2.connect(connection_factory=PreparedStatementsConnection,
+                                                  **POSTGRES_CREDENTIALS)
+                self._conn.autocommit = True  # Set autocommit to True
+        return self._conn
+
+    @property
+    def cursor(self) -> extensions.cursor:
+        if self._cursor is None:
+            self._cursor = self.conn.cursor(cursor_factory=InstrumentedCursor)
+        return self._cursor
 
     def create_outline_server(self, hostname: str, port: int, api_url: str,
-                              location_name: str, provider_id: int) -> int:
+                              location_name: str, provider_id: int, api_version: str | None = None) -> int | None:
+        """Register an Outline server, return its id or None if a server with `api_url` exists."""
         try:
             # Start a transaction
             self.conn.autocommit = False
 
             # Check if provider_id exists
-            provider_query: str = "SELECT 1 FROM server_provider WHERE id = %s;"
-            self.cursor.execute(provider_query, (provider_id,))
-            if not self.cursor.fetchone():
+            reference_data = get_reference_data()
+            if not reference_data.provider_exists(provider_id):
                 raise ValueError(f"Provider with id '{provider_id}' not found")
 
             # Insert data into outline_server table
             insert_server_query: str = """
-                INSERT INTO outline_server (hostname, port, api_url, is_active)
-                VALUES (%s, %s, %s, TRUE)
+                INSERT INTO outline_server (hostname, port, api_url, is_active, api_version)
+                VALUES (%s, %s, %s, TRUE, %s)
                 RETURNING id;
             """
-            self.cursor.execute(insert_server_query, (hostname, port, api_url))
+            self.cursor.execute(insert_server_query, (hostname, port, api_url, api_version))
             outline_server_id: int = self.cursor.fetchone()[0]
 
             # Fetch location id from server_location table
-            location_query: str = "SELECT id FROM server_location WHERE location = %s;"
-            self.cursor.execute(location_query, (location_name,))
-            location_result: tuple[int, ...] | None = self.cursor.fetchone()
-            if not location_result:
+            location_id: int | None = reference_data.get_location_id(location_name)
+            if location_id is None:
                 raise ValueError(f"Location '{location_name}' not found")
 
-            location_id: int = location_result[0]
-
             # Insert data into outline_server_info table
             insert_server_info_query: str = """
                 INSERT INTO outline_server_info (fk_outline_server_id, fk_server_location_id, fk_server_provider_id)
@@ -56,7 +87,18 @@ class DatabaseManager:
             # Set autocommit back to True
             self.conn.autocommit = True
 
+            # The change notification reaches every worker, this one reloads right away to see its own write
+            reference_data.reload()
+            get_server_selector().invalidate()
+
             return outline_server_id
+        except errors.UniqueViolation as e:
+            self.conn.rollback()
+            self.conn.autocommit = True
+            # the unique api_url decides between concurrent registrations of the same server
+            if e.diag.constraint_name == "outline_server_api_url_key":
+                return None
+            raise e
         except Exception as e:
             # Rollback the transaction in case of any exception
             self.conn.rollback()
@@ -65,38 +107,32 @@ class DatabaseManager:
             raise e
 
     def check_server_exists_using_api_url(self, api_url: str) -> bool:
+        # Guards a write, so it asks the database rather than the reference data snapshot
         query = "SELECT 1 FROM outline_server WHERE api_url = %s LIMIT 1;"
         self.cursor.execute(query, (api_url,))
         return self.cursor.fetchone() is not None
 
     def check_server_exists_using_id(self, server_id: int) -> bool:
-        query = "SELECT 1 FROM outline_server WHERE id = %s LIMIT 1;"
-        self.cursor.execute(query, (server_id,))
-        return self.cursor.fetchone() is not None
+        return get_reference_data().server_exists(server_id)
 
-    def get_server_api_url(self, server_id: int) -> str:
-        query = "SELECT api_url FROM outline_server WHERE id = %s LIMIT 1;"
-        self.cursor.execute(query, (server_id,))
-        return self.cursor.fetchone()[0]
+    def get_server_api_url(self, server_id: int) -> str | None:
+        return get_reference_data().get_server_api_url(server_id)
+
+    def get_server_api_version(self, server_id: int) -> str | None:
+        """Return the Outline server version reported by GET /server when the server was registered."""
+        return get_reference_data().get_server_api_version(server_id)
 
     def location_exists(self, location_name: str) -> bool:
-        query = """
-            SELECT 1 
-            FROM server_location 
-            WHERE location = %s 
-            LIMIT 1;
-        """
-        self.cursor.execute(query, (location_name,))
-        return self.cursor.fetchone() is not None
+        return get_reference_data().location_exists(location_name)
 
     def get_servers(self, location_name: str | None = None) -> dict[str, any]:
         try:
+            # unused_keys and used_keys are maintained by triggers on outline_key, nothing is counted here
             query = """
-                SELECT os.id, sl.location, COUNT(ok.id) AS unused_keys
+                SELECT os.id, sl.location, os.unused_keys, os.used_keys
                 FROM outline_server os
                 JOIN outline_server_info osi ON os.id = osi.fk_outline_server_id
                 JOIN server_location sl ON osi.fk_server_location_id = sl.id
-                LEFT JOIN outline_key ok ON os.id = ok.fk_outline_server_id AND ok.currently_used = FALSE
                 WHERE os.is_active = TRUE
             """
 
@@ -105,10 +141,13 @@ class DatabaseManager:
                 query += " AND sl.location = %s"
                 params.append(location_name)
 
-            query += " GROUP BY os.id, sl.location"
+            query += " ORDER BY os.id"
             self.cursor.execute(query, params)
 
-            servers = [{"id": row[0], "location": row[1], "unused_keys": row[2]} for row in self.cursor.fetchall()]
+            servers = [
+                {"id": row[0], "location": row[1], "unused_keys": row[2], "used_keys": row[3]}
+                for row in self.cursor.fetchall()
+            ]
             total_count = len(servers)
 
             return {"total_count": total_count, "servers": servers}
@@ -118,42 +157,77 @@ class DatabaseManager:
             raise e
 
     def generate_unique_uuid(self) -> str:
-        while True:
-            new_uuid = str(uuid.uuid4())
-            if not self.check_uuid_exists(new_uuid):
-                return new_uuid
-
-    def check_uuid_exists(self, new_uuid: str) -> bool:
-        query = "SELECT 1 FROM outline_key WHERE uuid = %s LIMIT 1;"
-        self.cursor.execute(query, (new_uuid,))
-        return self.cursor.fetchone() is not None
+        """
+        Generate a uuid for a new outline key.
+
+        No lookup is made: uuid4 collisions are practically impossible and uniqueness is enforced by the primary key
+        when the key is inserted, see insert_keys.
+        """
+        return str(uuid.uuid4())
 
-    def insert_key(self, uuid: str, id: str, fk_outline_server_id: int, access_url: str, currently_used: bool) -> None:
+    def insert_key(self, uuid: str, id: str, fk_outline_server_id: int, access_url: str, currently_used: bool) -> str:
+        """Insert one outline key, return the uuid it was stored with (see insert_keys)."""
+        return self.insert_keys([(uuid, id, fk_outline_server_id, access_url, currently_used)])[0]
+
+    def insert_keys(self, keys: list[tuple[str, str, int, str, bool]], max_attempts: int = 3) -> list[str]:
+        """
+        Insert several outline keys with one multi-row INSERT in one transaction.
+
+        Each tuple holds (uuid, id, fk_outline_server_id, access_url, currently_used). Rows whose uuid is already
+        taken are skipped by ON CONFLICT and inserted again with a fresh uuid, so no lookup is needed beforehand and
+        concurrent workers cannot race each other. The retries are part of the transaction, either all keys are
+        stored or none. Return the stored uuids in the order of `keys`, anything named after a passed uuid has to
+        follow the stored one.
+        """
+        stored_uuids: list[str] = [key[0] for key in keys]
+        pending: list[int] = list(range(len(keys)))  # positions of keys that are not stored yet
         query = """
             INSERT INTO outline_key (uuid, id, fk_outline_server_id, access_url, currently_used)
-            VALUES (%s, %s, %s, %s, %s);
+            VALUES %s
+            ON CONFLICT (uuid) DO NOTHING
+            RETURNING uuid;
         """
-        self.cursor.execute(query, (uuid, id, fk_outline_server_id, access_url, currently_used))
 
-    def get_outline_keys(self, server_id: int, currently_used: bool | None = None,
-                         limit: int | None = None) -> list[dict[str, any]]:
         try:
-            query: str = """
-                SELECT uuid, access_url, currently_used 
-                FROM outline_key 
-                WHERE fk_outline_server_id = %s
-            """
-            params: list[int] = [server_id]
+            self.conn.autocommit = False  # Start transaction
+            for _ in range(max_attempts):
+                if not pending:
+                    break
 
-            if currently_used is not None:
-                query += " AND currently_used = %s"
-                params.append(currently_used)
+                rows = [(stored_uuids[i],) + tuple(keys[i][1:]) for i in pending]
+                inserted = {str(row[0]) for row in execute_values(self.cursor, query, rows, page_size=len(rows),
+                                                                  fetch=True)}
 
-            if limit is not None:
-                query += " LIMIT %s"
-                params.append(limit)
+                pending = [i for i in pending if stored_uuids[i] not in inserted]
+                for i in pending:
+                    stored_uuids[i] = self.generate_unique_uuid()
 
-            self.cursor.execute(query, params)
+            if pending:
+                raise ValueError(f"Could not allocate a unique uuid for {len(pending)} outline key(s)")
+
+            self.conn.commit()  # Commit the transaction
+            return stored_uuids
+        except Exception as e:
+            self.conn.rollback()  # Rollback on error
+            raise e
+        finally:
+            self.conn.autocommit = True  # Restore the autocommit setting
+
+    def get_outline_keys(self, server_id: int, currently_used: bool | None = None,
+                         limit: int | None = None, after: str | None = None) -> list[dict[str, any]]:
+        try:
+            # One statement for every filter combination, a NULL filter or limit matches everything.
+            # Keys are ordered by uuid, so the next page starts after the last uuid of the previous one.
+            query: str = """
+                SELECT uuid, access_url, currently_used
+                FROM outline_key
+                WHERE fk_outline_server_id = $1
+                AND ($2::BOOLEAN IS NULL OR currently_used = $2)
+                AND ($4::UUID IS NULL OR uuid > $4)
+                ORDER BY uuid
+                LIMIT $3
+            """
+            execute_prepared(self.cursor, "get_outline_keys", query, (server_id, currently_used, limit, after))
             keys: list[dict[str, any]] = [
                 {"uuid": row[0], "access_url": row[1], "currently_used": row[2]} for row in self.cursor.fetchall()
             ]
@@ -163,50 +237,378 @@ class DatabaseManager:
             # self.conn.rollback()
             raise e
 
-    def get_locations(self, active_servers: bool | None = None) -> list[dict[str, str]]:
+    def iter_outline_keys(self, server_id: int, currently_used: bool | None = None, limit: int | None = None,
+                          after: str | None = None, batch_size: int = 1000) -> Iterator[dict[str, any]]:
+        """
+        Same keys as get_outline_keys, read through a server-side cursor `batch_size` rows at a time, so memory
+        stays bounded however many keys the server has.
+        """
+        query: str = """
+            SELECT uuid, access_url, currently_used
+            FROM outline_key
+            WHERE fk_outline_server_id = %(server_id)s
+            AND (%(currently_used)s::BOOLEAN IS NULL OR currently_used = %(currently_used)s)
+            AND (%(after)s::UUID IS NULL OR uuid > %(after)s)
+            ORDER BY uuid
+            LIMIT %(limit)s
+        """
+        params = {"server_id": server_id, "currently_used": currently_used, "after": after, "limit": limit}
+
+        # Named cursors only live inside a transaction
+        self.conn.autocommit = False
         try:
-            if active_servers is True:
-                # Fetch locations with active servers
-                query = """
-                    SELECT DISTINCT sl.location, sl.location_ru, sl.iso
-                    FROM server_location sl
-                    INNER JOIN outline_server_info osi ON sl.id = osi.fk_server_location_id
-                    INNER JOIN outline_server os ON osi.fk_outline_server_id = os.id
-                    WHERE os.is_active = TRUE;
-                """
-            elif active_servers is False:
-                # Fetch locations without active servers
-                query = """
-                    SELECT sl.location, sl.location_ru, sl.iso
-                    FROM server_location sl
-                    WHERE NOT EXISTS (
-                        SELECT 1 FROM outline_server_info osi
-                        INNER JOIN outline_server os ON osi.fk_outline_server_id = os.id
-                        WHERE osi.fk_server_location_id = sl.id AND os.is_active = TRUE
-                    );
-                """
-            else:
-                # Fetch all locations
-                query = "SELECT sl.location, sl.location_ru, sl.iso FROM server_location sl;"
+            with self.conn.cursor(name="outline_keys_stream") as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(query, params)
+                for row in cursor:
+                    yield {"uuid": row[0], "access_url": row[1], "currently_used": row[2]}
+        finally:
+            # Also reached when the consumer stops early, e.g. the client disconnected
+            self.conn.rollback()
+            self.conn.autocommit = True
+
+    def get_key_inventory(self, window_hours: float) -> list[dict[str, any]]:
+        """
+        Return spare key inventory of every active server: number of unused keys and number of keys allocated to
+        dynamic keys during the last `window_hours` hours.
+        """
+        query = """
+            SELECT os.id, os.api_url, os.unused_keys,
+                   (SELECT COUNT(*) FROM outline_key ok
+                    WHERE ok.fk_outline_server_id = os.id
+                    AND ok.last_allocated_at > now() - make_interval(secs => %s)) AS recent_allocations
+            FROM outline_server os
+            WHERE os.is_active = TRUE
+            ORDER BY os.id;
+        """
+        self.cursor.execute(query, (window_hours * 3600,))
+        return [
+            {"id": row[0], "api_url": row[1], "unused_keys": row[2], "recent_allocations": row[3]}
+            for row in self.cursor.fetchall()
+        ]
+
+    def get_server_load(self) -> list[dict[str, any]]:
+        """Return the location, key counters and API latency of every active server, read by the server selector."""
+        query = """
+            SELECT os.id, sl.location, os.unused_keys, os.used_keys, os.latency_ms
+            FROM outline_server os
+            JOIN outline_server_info osi ON os.id = osi.fk_outline_server_id
+            JOIN server_location sl ON osi.fk_server_location_id = sl.id
+            WHERE os.is_active = TRUE
+        """
+        execute_prepared(self.cursor, "get_server_load", query, ())
+        return [
+            {"id": row[0], "location": row[1], "unused_keys": row[2], "used_keys": row[3], "latency_ms": row[4]}
+            for row in self.cursor.fetchall()
+        ]
+
+    def record_server_latency(self, server_id: int, latency_ms: float, smoothing: float = 0.3) -> None:
+        """Fold an observed Outline management API response time into the smoothed latency of the server."""
+        query = """
+            UPDATE outline_server
+            SET latency_ms = COALESCE(latency_ms * (1 - %(smoothing)s) + %(latency_ms)s * %(smoothing)s,
+                                      %(latency_ms)s)
+            WHERE id = %(server_id)s
+        """
+        self.cursor.execute(query, {"server_id": server_id, "latency_ms": latency_ms, "smoothing": smoothing})
 
-            self.cursor.execute(query)
-            return [{"location": row[0], "location_ru": row[1], "iso": row[2]} for row in self.cursor.fetchall()]
+    def get_servers_to_check(self) -> list[dict[str, any]]:
+        """Return the servers the health checker polls: active ones and the ones it deactivated itself."""
+        query = """
+            SELECT id, api_url
+            FROM outline_server
+            WHERE is_active = TRUE OR health_deactivated = TRUE
+            ORDER BY id;
+        """
+        self.cursor.execute(query)
+        return [{"id": row[0], "api_url": row[1]} for row in self.cursor.fetchall()]
+
+    def record_health_checks(self, checks: list[dict[str, any]], failure_threshold: int, recovery_threshold: int,
+                             smoothing: float = 0.3) -> list[dict[str, any]]:
+        """
+        Store one round of health checks, {"server_id", "healthy", "latency_ms"} each, and change is_active of
+        servers with hysteresis: an active server is deactivated after `failure_threshold` failed checks in a row,
+        a server deactivated by the health checker is reactivated after `recovery_threshold` successful ones.
+
+        The check results are shifted into health_history, latency_ms of healthy servers is smoothed like
+        record_server_latency. is_active is only written when a server changes, so that unchanged rounds don't
+        notify the workers to reload their reference data. Return {"id", "is_active"} of the changed servers.
+        """
+        record_query = """
+            UPDATE outline_server os
+            SET health_history = (os.health_history << 1) | c.healthy::INTEGER,
+                health_checked_at = now(),
+                latency_ms = CASE WHEN c.healthy
+                                  THEN COALESCE(os.latency_ms * (1 - %(smoothing)s) + c.latency_ms * %(smoothing)s,
+                                                c.latency_ms)
+                                  ELSE os.latency_ms END
+            FROM unnest(%(server_ids)s::INTEGER[], %(healthy)s::BOOLEAN[], %(latencies)s::REAL[])
+                AS c(server_id, healthy, latency_ms)
+            WHERE os.id = c.server_id
+            RETURNING os.id, os.health_history, os.is_active, os.health_deactivated;
+        """
+        # servers deactivated by hand in the meantime (health_deactivated = FALSE) are not reactivated
+        change_query = """
+            UPDATE outline_server os
+            SET is_active = c.is_active, health_deactivated = NOT c.is_active
+            FROM unnest(%(server_ids)s::INTEGER[], %(is_active)s::BOOLEAN[]) AS c(server_id, is_active)
+            WHERE os.id = c.server_id AND os.is_active <> c.is_active
+            AND (os.is_active = TRUE OR os.health_deactivated = TRUE)
+            RETURNING os.id, os.is_active;
+        """
+        failure_mask = (1 << failure_threshold) - 1
+        recovery_mask = (1 << recovery_threshold) - 1
+
+        try:
+            self.conn.autocommit = False  # Start transaction
+            self.cursor.execute(record_query, {
+                "server_ids": [check["server_id"] for check in checks],
+                "healthy": [check["healthy"] for check in checks],
+                "latencies": [check["latency_ms"] for check in checks],
+                "smoothing": smoothing
+            })
+
+            changes = []
+            for server_id, health_history, is_active, health_deactivated in self.cursor.fetchall():
+                if is_active and health_history & failure_mask == 0:
+                    changes.append((server_id, False))
+                elif not is_active and health_deactivated and health_history & recovery_mask == recovery_mask:
+                    changes.append((server_id, True))
+
+            changed = []
+            if changes:
+                self.cursor.execute(change_query, {"server_ids": [change[0] for change in changes],
+                                                   "is_active": [change[1] for change in changes]})
+                changed = [{"id": row[0], "is_active": row[1]} for row in self.cursor.fetchall()]
+
+            self.conn.commit()  # Commit the transaction
+            return changed
         except Exception as e:
-            self.conn.rollback()
+            self.conn.rollback()  # Rollback on error
+            raise e
+        finally:
+            self.conn.autocommit = True  # Restore the autocommit setting
+
+    def repair_server_key_counters(self) -> list[dict[str, int]]:
+        """
+        Recount the trigger-maintained unused_keys/used_keys of every server and fix drifted ones.
+
+        Return the corrections as [{"server_id", "unused_keys_drift", "used_keys_drift"}], drift being the stored
+        value minus the real one.
+        """
+        self.cursor.execute("SELECT server_id, unused_keys_drift, used_keys_drift "
+                            "FROM repair_outline_server_key_counters();")
+        return [
+            {"server_id": row[0], "unused_keys_drift": row[1], "used_keys_drift": row[2]}
+            for row in self.cursor.fetchall()
+        ]
+
+    def delete_unused_keys(self, server_id: int, count: int) -> list[dict[str, any]]:
+        """
+        Delete up to `count` unused outline keys of a server, return their uuid and Outline id.
+
+        Keys still referenced by a (deactivated) dynamic key are never deleted, and keys locked by a concurrent
+        allocation are skipped.
+        """
+        query = """
+            DELETE FROM outline_key
+            WHERE uuid IN (
+                SELECT ok.uuid
+                FROM outline_key ok
+                WHERE ok.fk_outline_server_id = %s AND ok.currently_used = FALSE
+                  AND NOT EXISTS (SELECT 1 FROM dynamic_key dk WHERE dk.fk_outline_key_uuid = ok.uuid)
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING uuid, id;
+        """
+        self.cursor.execute(query, (server_id, count))
+        return [{"uuid": str(row[0]), "id": row[1]} for row in self.cursor.fetchall()]
+
+    def get_outline_key_digest(self, server_id: int) -> tuple[int, str]:
+        """
+        Return the number of outline keys of a server and the md5 of their Outline ids, sorted numerically and joined
+        by newlines. Used by the reconciler to tell in one row whether the server has exactly these keys.
+        """
+        query = """
+            SELECT COUNT(*), md5(COALESCE(string_agg(id::TEXT, E'\\n' ORDER BY id), ''))
+            FROM outline_key
+            WHERE fk_outline_server_id = %s;
+        """
+        self.cursor.execute(query, (server_id,))
+        count, digest = self.cursor.fetchone()
+        return count, digest
+
+    def get_outline_key_ids(self, server_id: int) -> set[int]:
+        """Return the Outline ids of all outline keys of a server."""
+        self.cursor.execute("SELECT id FROM outline_key WHERE fk_outline_server_id = %s;", (server_id,))
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def delete_dead_keys(self, server_id: int, key_ids: list[int]) -> tuple[list[dict], list[dict]]:
+        """
+        Delete outline keys of a server that no longer exist on the Outline server, so they are not handed out.
+
+        Keys in use or referenced by a dynamic key can't be deleted, users of such keys have to be moved to other
+        keys, e.g. with evacuate_server. Return (deleted, kept): lists of {"uuid", "id"}.
+        """
+        query = """
+            WITH dead AS (
+                SELECT ok.uuid, ok.id,
+                       ok.currently_used OR EXISTS (SELECT 1 FROM dynamic_key dk WHERE dk.fk_outline_key_uuid = ok.uuid)
+                           AS referenced
+                FROM outline_key ok
+                WHERE ok.fk_outline_server_id = %(server_id)s AND ok.id = ANY(%(key_ids)s::INTEGER[])
+                FOR UPDATE OF ok
+            ),
+            deleted AS (
+                DELETE FROM outline_key
+                WHERE uuid IN (SELECT uuid FROM dead WHERE NOT referenced)
+                RETURNING uuid
+            )
+            SELECT d.uuid, d.id, del.uuid IS NOT NULL
+            FROM dead d
+            LEFT JOIN deleted del ON del.uuid = d.uuid
+            ORDER BY d.id;
+        """
+        self.cursor.execute(query, {"server_id": server_id, "key_ids": key_ids})
+
+        deleted, kept = [], []
+        for key_uuid, key_id, was_deleted in self.cursor.fetchall():
+            (deleted if was_deleted else kept).append({"uuid": str(key_uuid), "id": key_id})
+        return deleted, kept
+
+    def create_transfer_sample_partitions(self, first_day: date, last_day: date) -> None:
+        """Create the missing daily partitions of transfer_sample for the UTC days first_day to last_day."""
+        self.cursor.execute("SELECT create_transfer_sample_partitions(%s, %s);", (first_day, last_day))
+
+    def store_transfer_reports(self, sampled_at: datetime, reports: dict[int, dict[int, int]]) -> int:
+        """
+        Store the transfer reports taken at `sampled_at`, the bytes of each Outline key id by server id.
+
+        The reports are streamed with COPY into a temporary table. Every key that transferred more than in the last
+        report of its server in transfer_last gets a sample of the growth in transfer_sample, mapped to outline_key
+        and dynamic_key by one INSERT ... SELECT, then the reports replace the last ones. All of it is one
+        transaction, so the next round computes against these reports whichever collector runs it. The first report
+        of a server only primes it, samples of keys missing in outline_key are dropped, see outline/reconciler.py.
+        Return the number of samples stored. The partition of `sampled_at` must exist.
+        """
+        samples_query = """
+            INSERT INTO transfer_sample (sampled_at, bytes, dynamic_key_id, outline_key_uuid, fk_outline_server_id,
+                                         outline_key_id)
+            SELECT %(sampled_at)s, r.bytes - COALESCE(l.bytes, 0),
+                   (SELECT dk.id FROM dynamic_key dk WHERE dk.fk_outline_key_uuid = ok.uuid
+                    ORDER BY dk.is_active DESC LIMIT 1),
+                   ok.uuid, ok.fk_outline_server_id, ok.id
+            FROM transfer_report_copy r
+            JOIN transfer_last_report lr ON lr.fk_outline_server_id = r.server_id
+            LEFT JOIN transfer_last l ON l.fk_outline_server_id = r.server_id AND l.outline_key_id = r.key_id
+            JOIN outline_key ok ON ok.fk_outline_server_id = r.server_id AND ok.id = r.key_id
+            WHERE r.bytes > COALESCE(l.bytes, 0);
+        """
+        # keys of the reported servers missing in their new report are removed, unchanged ones are not rewritten
+        last_query = """
+            DELETE FROM transfer_last l
+            WHERE l.fk_outline_server_id = ANY(%(server_ids)s)
+              AND NOT EXISTS (SELECT 1 FROM transfer_report_copy r
+                              WHERE r.server_id = l.fk_outline_server_id AND r.key_id = l.outline_key_id);
+
+            INSERT INTO transfer_last (bytes, fk_outline_server_id, outline_key_id)
+            SELECT bytes, server_id, key_id FROM transfer_report_copy
+            ON CONFLICT (fk_outline_server_id, outline_key_id) DO UPDATE SET bytes = EXCLUDED.bytes
+            WHERE transfer_last.bytes <> EXCLUDED.bytes;
+
+            INSERT INTO transfer_last_report (fk_outline_server_id, reported_at)
+            SELECT unnest(%(server_ids)s::INTEGER[]), %(sampled_at)s
+            ON CONFLICT (fk_outline_server_id) DO UPDATE SET reported_at = EXCLUDED.reported_at;
+        """
+        params = {"sampled_at": sampled_at, "server_ids": list(reports)}
+        rows = io.StringIO("".join(f"{server_id}\t{key_id}\t{bytes_}\n" for server_id, transfer in reports.items()
+                                   for key_id, bytes_ in transfer.items()))
+
+        try:
+            self.conn.autocommit = False  # Start transaction
+            self.cursor.execute("CREATE TEMPORARY TABLE transfer_report_copy "
+                                "(server_id INTEGER, key_id INTEGER, bytes BIGINT) ON COMMIT DROP;")
+            self.cursor.copy_expert("COPY transfer_report_copy (server_id, key_id, bytes) FROM STDIN;", rows)
+            self.cursor.execute(samples_query, params)
+            stored = self.cursor.rowcount
+            self.cursor.execute(last_query, params)
+            self.conn.commit()  # Commit the transaction
+            return stored
+        except Exception as e:
+            self.conn.rollback()  # Rollback on error
+            raise e
+        finally:
+            self.conn.autocommit = True  # Restore the autocommit setting
+
+    def rollup_transfer(self, hourly_since: datetime, daily_since: datetime) -> tuple[int, int]:
+        """
+        Recompute transfer_hourly from the samples since `hourly_since` and transfer_daily from the hours since
+        `daily_since`, both are the start of a UTC hour or day. Periods are replaced as a whole, so rolling up an
+        unfinished period again later is safe. Return the number of hourly and daily rows written.
+        """
+        hourly_query = """
+            INSERT INTO transfer_hourly (period_start, bytes, dynamic_key_id, outline_key_uuid, fk_outline_server_id,
+                                         outline_key_id, samples)
+            SELECT date_trunc('hour', sampled_at, 'UTC'), SUM(bytes),
+                   (array_agg(dynamic_key_id ORDER BY sampled_at DESC))[1],
+                   outline_key_uuid, MIN(fk_outline_server_id), MIN(outline_key_id), COUNT(*)
+            FROM transfer_sample
+            WHERE sampled_at >= %s
+            GROUP BY date_trunc('hour', sampled_at, 'UTC'), outline_key_uuid
+            ON CONFLICT (period_start, outline_key_uuid) DO UPDATE
+            SET bytes = EXCLUDED.bytes, dynamic_key_id = EXCLUDED.dynamic_key_id, samples = EXCLUDED.samples;
+        """
+        daily_query = """
+            INSERT INTO transfer_daily (period_start, bytes, dynamic_key_id, outline_key_uuid, fk_outline_server_id,
+                                        outline_key_id, samples)
+            SELECT date_trunc('day', period_start, 'UTC'), SUM(bytes),
+                   (array_agg(dynamic_key_id ORDER BY period_start DESC))[1],
+                   outline_key_uuid, MIN(fk_outline_server_id), MIN(outline_key_id), SUM(samples)
+            FROM transfer_hourly
+            WHERE period_start >= %s
+            GROUP BY date_trunc('day', period_start, 'UTC'), outline_key_uuid
+            ON CONFLICT (period_start, outline_key_uuid) DO UPDATE
+            SET bytes = EXCLUDED.bytes, dynamic_key_id = EXCLUDED.dynamic_key_id, samples = EXCLUDED.samples;
+        """
+        try:
+            self.conn.autocommit = False  # Start transaction
+            self.cursor.execute(hourly_query, (hourly_since,))
+            hourly = self.cursor.rowcount
+            self.cursor.execute(daily_query, (daily_since,))
+            daily = self.cursor.rowcount
+            self.conn.commit()  # Commit the transaction
+            return hourly, daily
+        except Exception as e:
+            self.conn.rollback()  # Rollback on error
             raise e
+        finally:
+            self.conn.autocommit = True  # Restore the autocommit setting
+
+    def expire_transfer_metrics(self, samples_before: date, hourly_before: datetime) -> list[str]:
+        """
+        Drop the sample partitions of the days before `samples_before` and the hourly rollups before `hourly_before`,
+        return the names of the dropped partitions. Daily rollups are kept.
+        """
+        self.cursor.execute("SELECT drop_transfer_sample_partitions(%s);", (samples_before,))
+        dropped = [row[0] for row in self.cursor.fetchall()]
+        self.cursor.execute("DELETE FROM transfer_hourly WHERE period_start < %s;", (hourly_before,))
+        return dropped
+
+    def try_advisory_lock(self, lock_id: int) -> bool:
+        """Take a session-level advisory lock without waiting, it is held until unlocked or the connection closes."""
+        self.cursor.execute("SELECT pg_try_advisory_lock(%s);", (lock_id,))
+        return self.cursor.fetchone()[0]
+
+    def advisory_unlock(self, lock_id: int) -> None:
+        self.cursor.execute("SELECT pg_advisory_unlock(%s);", (lock_id,))
+
+    def get_locations(self, active_servers: bool | None = None) -> list[dict[str, str]]:
+        return get_reference_data().get_locations(active_servers)
 
     def generate_unique_dynamic_key_id(self) -> int:
-        """Generate a unique 9-digit ID."""
-        while True:
-            new_id: int = random.randint(100000000, 999999999)
-            if not self.check_dynamic_key_id_exists(new_id):
-                return new_id
-
-    def check_dynamic_key_id_exists(self, id: int) -> bool:
-        """Check if a dynamic key ID already exists."""
-        query = "SELECT 1 FROM dynamic_key WHERE id = %s;"
-        self.cursor.execute(query, (id,))
-        return self.cursor.fetchone() is not None
+        """Generate a 9-digit ID, uniqueness is enforced by the primary key when the key is inserted."""
+        return random.randint(100000000, 999999999)
 
     def parse_access_url(self, access_url: str):
         """Parse the access URL and extract server, server_port, password, and method."""
@@ -221,153 +623,624 @@ class DatabaseManager:
             "method": method
         }
 
-    def insert_dynamic_key(self, id: int, tg_user_id: int, server: str, server_port: int,
-                           password: str, method: str, is_active: bool, fk_outline_key_uuid: uuid.UUID):
-        """Insert a new dynamic key into the database with transaction management and update outline_key."""
-        try:
-            self.conn.autocommit = False  # Start transaction
+    def insert_dynamic_key(self, tg_user_id: int, outline_key_uuid: str | None = None, server_id: int | None = None,
+                           location: str | None = None, max_attempts: int = 3) -> tuple[str, int | None]:
+        """
+        Create an active dynamic key for a telegram user from an outline key and mark the outline key as used.
 
-            # Insert into dynamic_key table
-            insert_query = """
-                INSERT INTO dynamic_key 
-                (id, tg_user_id, server, server_port, password, method, is_active, fk_outline_key_uuid)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+        The outline key is either the given `outline_key_uuid`, or any unused key of an active server picked by
+        `server_id` and/or `location`. Unused keys are claimed with FOR UPDATE SKIP LOCKED, so concurrent callers
+        never receive the same key and never wait for each other.
+
+        All checks and writes are done by one statement, so the call costs one round trip and one transaction.
+        Return (status, id) where status is one of "created", "outline_key_not_found", "outline_key_in_use",
+        "no_unused_outline_keys", "dynamic_key_exists"; id is only set for "created".
+        """
+        if outline_key_uuid is None and server_id is None and location is not None:
+            # The server is picked by its cached load score, any server of the location is taken if the picked one
+            # ran out of spare keys since the scores were loaded
+            selected_server_id = get_server_selector().pick(location, self.get_server_load)
+            if selected_server_id is not None:
+                result = self.insert_dynamic_key(tg_user_id, server_id=selected_server_id, location=location,
+                                                 max_attempts=max_attempts)
+                if result[0] != "no_unused_outline_keys":
+                    return result
+
+        if outline_key_uuid is not None:
+            # lock the row so that a concurrent claim of the same key is seen as currently_used once we get it
+            candidate_query = """
+                SELECT uuid, currently_used, access_url
+                FROM outline_key
+                WHERE uuid = %(outline_key_uuid)s
+                FOR UPDATE
+            """
+        else:
+            candidate_query = """
+                SELECT uuid, currently_used, access_url
+                FROM outline_key
+                WHERE currently_used = FALSE
+                AND fk_outline_server_id IN (
+                    SELECT os.id
+                    FROM outline_server os
+                    JOIN outline_server_info osi ON os.id = osi.fk_outline_server_id
+                    JOIN server_location sl ON osi.fk_server_location_id = sl.id
+                    WHERE os.is_active = TRUE
+                    AND (%(server_id)s::INTEGER IS NULL OR os.id = %(server_id)s)
+                    AND (%(location)s::VARCHAR IS NULL OR sl.location = %(location)s)
+                )
+                AND NOT EXISTS (SELECT 1 FROM dynamic_key WHERE tg_user_id = %(tg_user_id)s)
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
             """
-            self.cursor.execute(insert_query,
-                                (id, tg_user_id, server, server_port, password, method, is_active, fk_outline_key_uuid))
 
-            # Update the outline_key table
-            update_query = """
+        query = f"""
+            WITH candidate AS ({candidate_query}),
+            outline_key_row AS (
+                SELECT c.uuid, c.currently_used, p.server, p.server_port, p.password, p.method
+                FROM candidate c, parse_access_url(c.access_url) p
+            ),
+            existing_key AS (
+                SELECT 1 FROM dynamic_key WHERE tg_user_id = %(tg_user_id)s LIMIT 1
+            ),
+            inserted AS (
+                INSERT INTO dynamic_key
+                (id, tg_user_id, server, server_port, password, method, is_active, fk_outline_key_uuid)
+                SELECT %(id)s, %(tg_user_id)s, server, server_port, password, method, TRUE, uuid
+                FROM outline_key_row
+                WHERE currently_used = FALSE AND NOT EXISTS (SELECT 1 FROM existing_key)
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id, fk_outline_key_uuid
+            ),
+            claimed AS (
                 UPDATE outline_key
-                SET currently_used = TRUE
-                WHERE uuid = %s;
-            """
-            self.cursor.execute(update_query, (fk_outline_key_uuid,))
+                SET currently_used = TRUE, last_allocated_at = now()
+                WHERE uuid IN (SELECT fk_outline_key_uuid FROM inserted)
+            )
+            SELECT EXISTS (SELECT 1 FROM existing_key), (SELECT currently_used FROM outline_key_row),
+                   (SELECT id FROM inserted);
+        """
 
-            self.conn.commit()  # Commit the transaction
-        except Exception as e:
-            self.conn.rollback()  # Rollback on error
-            raise e  # Re-raise the exception for handling outside
-        finally:
-            self.conn.autocommit = True  # Restore the autocommit setting
+        for _ in range(max_attempts):
+            params = {"id": self.generate_unique_dynamic_key_id(), "tg_user_id": tg_user_id,
+                      "outline_key_uuid": outline_key_uuid, "server_id": server_id, "location": location}
+            self.cursor.execute(query, params)
+            dynamic_key_exists, outline_key_used, key_id = self.cursor.fetchone()
 
-    def check_outline_key_exists(self, outline_key_uuid: str) -> bool:
-        """Check if an outline key exists and is active."""
-        query = "SELECT 1 FROM outline_key WHERE uuid = %s;"
-        self.cursor.execute(query, (outline_key_uuid,))
-        return self.cursor.fetchone() is not None
+            if outline_key_uuid is not None and outline_key_used is None:
+                return "outline_key_not_found", None
+            if dynamic_key_exists:
+                return "dynamic_key_exists", None
+            if outline_key_used is None:
+                return "no_unused_outline_keys", None
+            if outline_key_used:
+                return "outline_key_in_use", None
+            if key_id is not None:
+                return "created", key_id
+            # the random id is already taken, try another one
 
-    def get_access_url_by_outline_key(self, outline_key_uuid: str) -> str:
-        """Get the access URL for a given outline key UUID."""
-        query = "SELECT access_url FROM outline_key WHERE uuid = %s;"
-        self.cursor.execute(query, (outline_key_uuid,))
-        result = self.cursor.fetchone()
-        return result[0] if result else None
-
-    def check_dynamic_key_exists_for_user(self, tg_user_id: int) -> bool:
-        """Check if a dynamic key already exists for the given tg_user_id."""
-        query = "SELECT 1 FROM dynamic_key WHERE tg_user_id = %s LIMIT 1;"
-        self.cursor.execute(query, (tg_user_id,))
-        return self.cursor.fetchone() is not None
+        raise ValueError("Could not allocate a unique dynamic key id")
 
     def update_dynamic_key_is_active(self, key_id: int, is_active: bool) -> None:
         try:
             self.conn.autocommit = False  # Start transaction
-            update_query = "UPDATE dynamic_key SET is_active = %s WHERE id = %s;"
+            update_query = """
+                UPDATE dynamic_key SET is_active = %s, version = version + 1 WHERE id = %s RETURNING tg_user_id;
+            """
             self.cursor.execute(update_query, (is_active, key_id))
+            result = self.cursor.fetchone()
             self.conn.commit()  # Commit the transaction
+
+            if result:
+                self.invalidate_dynamic_key(key_id, result[0])
         except Exception as e:
             self.conn.rollback()  # Rollback on error
             raise e  # Re-raise the exception for handling outside
         finally:
             self.conn.autocommit = True  # Restore the autocommit setting
 
-    def check_dynamic_key_exists_by_id(self, key_id: int) -> bool:
-        query = "SELECT 1 FROM dynamic_key WHERE id = %s;"
+    def deactivate_dynamic_key_and_outline_key(self, key_id: int) -> bool:
+        """
+        Deactivate a dynamic key and release its outline key with one statement.
+
+        Return False if the dynamic key does not exist.
+        """
+        query = """
+            WITH deactivated AS (
+                UPDATE dynamic_key
+                SET is_active = FALSE, version = version + 1
+                WHERE id = %s
+                RETURNING tg_user_id, fk_outline_key_uuid
+            ),
+            released AS (
+                UPDATE outline_key
+                SET currently_used = FALSE
+                WHERE uuid IN (SELECT fk_outline_key_uuid FROM deactivated)
+            )
+            SELECT tg_user_id FROM deactivated;
+        """
         self.cursor.execute(query, (key_id,))
-        return self.cursor.fetchone() is not None
+        result = self.cursor.fetchone()
+        if result is None:
+            return False
 
-    def deactivate_dynamic_key_and_outline_key(self, key_id: int) -> None:
+        self.invalidate_dynamic_key(key_id, result[0])
+        return True
+
+    def update_dynamic_key_with_new_outline_key(self, key_id: int, new_outline_key_uuid: str) -> str:
+        """
+        Move a dynamic key to another outline key and activate it: the previous outline key is released, the new
+        one is marked as used and the dynamic key gets the credentials of the new one, all with one statement.
+
+        Return "updated", "outline_key_not_found" or "dynamic_key_not_found".
+        """
+        query = """
+            WITH new_key AS (
+                SELECT ok.uuid, p.server, p.server_port, p.password, p.method
+                FROM outline_key ok, parse_access_url(ok.access_url) p
+                WHERE ok.uuid = %(outline_key_uuid)s
+            ),
+            current_key AS (
+                SELECT id, fk_outline_key_uuid FROM dynamic_key WHERE id = %(id)s FOR UPDATE
+            ),
+            updated AS (
+                UPDATE dynamic_key dk
+                SET server = nk.server, server_port = nk.server_port, password = nk.password, method = nk.method,
+                    is_active = TRUE, fk_outline_key_uuid = nk.uuid, version = dk.version + 1
+                FROM new_key nk, current_key ck
+                WHERE dk.id = ck.id
+                RETURNING dk.tg_user_id
+            ),
+            released AS (
+                UPDATE outline_key
+                SET currently_used = FALSE
+                WHERE uuid IN (SELECT fk_outline_key_uuid FROM current_key)
+                  AND uuid NOT IN (SELECT uuid FROM new_key)
+                  AND EXISTS (SELECT 1 FROM updated)
+            ),
+            claimed AS (
+                UPDATE outline_key
+                SET currently_used = TRUE, last_allocated_at = now()
+                WHERE uuid IN (SELECT uuid FROM new_key)
+                  AND EXISTS (SELECT 1 FROM updated)
+            )
+            SELECT EXISTS (SELECT 1 FROM new_key), EXISTS (SELECT 1 FROM current_key),
+                   (SELECT tg_user_id FROM updated);
+        """
+        self.cursor.execute(query, {"id": key_id, "outline_key_uuid": new_outline_key_uuid})
+        outline_key_found, dynamic_key_found, tg_user_id = self.cursor.fetchone()
+
+        if not outline_key_found:
+            return "outline_key_not_found"
+        if not dynamic_key_found:
+            return "dynamic_key_not_found"
+
+        self.invalidate_dynamic_key(key_id, tg_user_id)
+        return "updated"
+
+    def insert_dynamic_keys(self, keys: list[dict[str, any]], max_attempts: int = 3) -> list[tuple[str, int | None]]:
+        """
+        Create several dynamic keys in one transaction, the batch version of insert_dynamic_key.
+
+        Each dict holds tg_user_id and either outline_key_uuid, or server_id and/or location to claim an unused key
+        from. Keys with an explicit outline key are created by one statement, claimed keys by one statement per
+        (server_id, location) pair. tg_user_id and outline_key_uuid must be unique within the batch.
+        Return (status, id) per key in the order of `keys`, statuses being those of insert_dynamic_key.
+        """
+        # Explicit keys go first, so that claims can't take an outline key requested by another key of the batch.
+        # Keys given by location only are spread over its servers by their load scores, like insert_dynamic_key.
+        groups: dict[tuple, list[int]] = {("outline_key_uuid",): []}
+        selected: set[int] = set()
+        for position, key in enumerate(keys):
+            if key.get("outline_key_uuid") is not None:
+                groups[("outline_key_uuid",)].append(position)
+                continue
+
+            server_id = key.get("server_id")
+            if server_id is None and key.get("location") is not None:
+                server_id = get_server_selector().pick(key["location"], self.get_server_load)
+                if server_id is not None:
+                    selected.add(position)
+            groups.setdefault((server_id, key.get("location")), []).append(position)
+
+        results: list[tuple[str, int | None]] = [("created", None)] * len(keys)
         try:
             self.conn.autocommit = False  # Start transaction
 
-            # Update dynamic_key table
-            update_dynamic_query = "UPDATE dynamic_key SET is_active = FALSE WHERE id = %s;"
-            self.cursor.execute(update_dynamic_query, (key_id,))
+            for group, pending in groups.items():
+                self._insert_dynamic_keys_group(keys, group, pending, results, max_attempts)
 
-            # Get the associated outline key UUID
-            get_uuid_query = "SELECT fk_outline_key_uuid FROM dynamic_key WHERE id = %s;"
-            self.cursor.execute(get_uuid_query, (key_id,))
-            fk_outline_key_uuid = self.cursor.fetchone()[0]
-
-            # Update the outline_key table
-            update_outline_query = "UPDATE outline_key SET currently_used = FALSE WHERE uuid = %s;"
-            self.cursor.execute(update_outline_query, (fk_outline_key_uuid,))
+            # Picked servers that ran out of spare keys meanwhile, any server of the location is taken instead
+            fallback_groups: dict[tuple, list[int]] = {}
+            for position in sorted(selected):
+                if results[position][0] == "no_unused_outline_keys":
+                    fallback_groups.setdefault((None, keys[position]["location"]), []).append(position)
+            for group, pending in fallback_groups.items():
+                self._insert_dynamic_keys_group(keys, group, pending, results, max_attempts)
 
             self.conn.commit()  # Commit the transaction
+            return results
         except Exception as e:
             self.conn.rollback()  # Rollback on error
-            raise e  # Re-raise the exception for handling outside
+            raise e
         finally:
             self.conn.autocommit = True  # Restore the autocommit setting
 
-    def update_dynamic_key_with_new_outline_key(
-            self, key_id: int, new_outline_key_uuid: str, key_details: dict) -> None:
-        try:
-            self.conn.autocommit = False  # Start transaction
+    def _insert_dynamic_keys_group(self, keys: list[dict[str, any]], group: tuple, pending: list[int],
+                                   results: list[tuple[str, int | None]], max_attempts: int) -> None:
+        """
+        Create the keys at `pending` positions of one insert_dynamic_keys group and store their (status, id) in
+        `results`. The group is ("outline_key_uuid",) for explicit outline keys, else (server_id, location).
+        """
+        explicit_candidate_query = """
+            SELECT r.position, ok.uuid, ok.currently_used, ok.access_url
+            FROM requested r
+            JOIN outline_key ok ON ok.uuid = r.outline_key_uuid
+            ORDER BY ok.uuid
+            FOR UPDATE OF ok
+        """
+        # the n-th eligible request gets the n-th claimed key, users with a dynamic key don't claim any
+        claim_candidate_query = """
+            SELECT r.position, c.uuid, c.currently_used, c.access_url
+            FROM (
+                SELECT position, row_number() OVER (ORDER BY position) AS rank
+                FROM requested
+                WHERE NOT EXISTS (SELECT 1 FROM dynamic_key dk WHERE dk.tg_user_id = requested.tg_user_id)
+            ) r
+            JOIN (
+                SELECT k.uuid, k.currently_used, k.access_url, row_number() OVER () AS rank
+                FROM (
+                    SELECT uuid, currently_used, access_url
+                    FROM outline_key
+                    WHERE currently_used = FALSE
+                    AND fk_outline_server_id IN (
+                        SELECT os.id
+                        FROM outline_server os
+                        JOIN outline_server_info osi ON os.id = osi.fk_outline_server_id
+                        JOIN server_location sl ON osi.fk_server_location_id = sl.id
+                        WHERE os.is_active = TRUE
+                        AND (%(server_id)s::INTEGER IS NULL OR os.id = %(server_id)s)
+                        AND (%(location)s::VARCHAR IS NULL OR sl.location = %(location)s)
+                    )
+                    LIMIT (SELECT count(*) FROM requested
+                           WHERE NOT EXISTS (SELECT 1 FROM dynamic_key dk WHERE dk.tg_user_id = requested.tg_user_id))
+                    FOR UPDATE SKIP LOCKED
+                ) k
+            ) c ON c.rank = r.rank
+        """
+        query_template = """
+            WITH requested AS (
+                SELECT *
+                FROM unnest(%(positions)s::INTEGER[], %(ids)s::BIGINT[], %(tg_user_ids)s::BIGINT[],
+                            %(outline_key_uuids)s::UUID[]) AS r(position, id, tg_user_id, outline_key_uuid)
+            ),
+            candidate AS ({candidate_query}),
+            outline_key_row AS (
+                SELECT c.position, c.uuid, c.currently_used, p.server, p.server_port, p.password, p.method
+                FROM candidate c, parse_access_url(c.access_url) p
+            ),
+            existing_key AS (
+                SELECT DISTINCT tg_user_id FROM dynamic_key WHERE tg_user_id IN (SELECT tg_user_id FROM requested)
+            ),
+            inserted AS (
+                INSERT INTO dynamic_key
+                (id, tg_user_id, server, server_port, password, method, is_active, fk_outline_key_uuid)
+                SELECT r.id, r.tg_user_id, o.server, o.server_port, o.password, o.method, TRUE, o.uuid
+                FROM requested r
+                JOIN outline_key_row o ON o.position = r.position
+                WHERE o.currently_used = FALSE AND r.tg_user_id NOT IN (SELECT tg_user_id FROM existing_key)
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id, fk_outline_key_uuid
+            ),
+            claimed AS (
+                UPDATE outline_key
+                SET currently_used = TRUE, last_allocated_at = now()
+                WHERE uuid IN (SELECT fk_outline_key_uuid FROM inserted)
+            )
+            SELECT r.position, r.tg_user_id IN (SELECT tg_user_id FROM existing_key), o.currently_used, i.id
+            FROM requested r
+            LEFT JOIN outline_key_row o ON o.position = r.position
+            LEFT JOIN inserted i ON i.fk_outline_key_uuid = o.uuid;
+        """
+
+        explicit = group == ("outline_key_uuid",)
+        query = query_template.format(candidate_query=explicit_candidate_query if explicit else claim_candidate_query)
+
+        for _ in range(max_attempts):
+            if not pending:
+                break
+
+            params = {
+                "positions": pending,
+                "ids": [self.generate_unique_dynamic_key_id() for _ in pending],
+                "tg_user_ids": [keys[i]["tg_user_id"] for i in pending],
+                "outline_key_uuids": [keys[i].get("outline_key_uuid") for i in pending],
+                "server_id": None if explicit else group[0],
+                "location": None if explicit else group[1],
+            }
+            self.cursor.execute(query, params)
 
-            # Get the current outline key UUID associated with this dynamic key
-            get_current_uuid_query = "SELECT fk_outline_key_uuid FROM dynamic_key WHERE id = %s;"
-            self.cursor.execute(get_current_uuid_query, (key_id,))
-            current_uuid = self.cursor.fetchone()[0]
+            retry = []
+            for position, dynamic_key_exists, outline_key_used, key_id in self.cursor.fetchall():
+                if explicit and outline_key_used is None:
+                    results[position] = ("outline_key_not_found", None)
+                elif dynamic_key_exists:
+                    results[position] = ("dynamic_key_exists", None)
+                elif outline_key_used is None:
+                    results[position] = ("no_unused_outline_keys", None)
+                elif outline_key_used:
+                    results[position] = ("outline_key_in_use", None)
+                elif key_id is not None:
+                    results[position] = ("created", key_id)
+                else:
+                    # the random id is already taken, try another one
+                    retry.append(position)
+            pending = retry
 
-            # Update the currently_used status of the current outline key to FALSE
-            if current_uuid:
-                update_current_outline_query = "UPDATE outline_key SET currently_used = FALSE WHERE uuid = %s;"
-                self.cursor.execute(update_current_outline_query, (current_uuid,))
+        if pending:
+            raise ValueError(f"Could not allocate a unique dynamic key id for {len(pending)} key(s)")
 
-            # Update dynamic_key table with new details
-            update_dynamic_query = """
+    def deactivate_dynamic_keys(self, key_ids: list[int]) -> list[bool]:
+        """
+        Deactivate several dynamic keys and release their outline keys with one statement, the batch version of
+        deactivate_dynamic_key_and_outline_key. Return per key id whether the dynamic key exists.
+        """
+        query = """
+            WITH deactivated AS (
                 UPDATE dynamic_key
-                SET server = %s, server_port = %s, password = %s, method = %s, 
-                    is_active = TRUE, fk_outline_key_uuid = %s
-                WHERE id = %s;
-            """
-            self.cursor.execute(update_dynamic_query, (key_details["server"], key_details["server_port"],
-                                                       key_details["password"], key_details["method"],
-                                                       new_outline_key_uuid, key_id))
+                SET is_active = FALSE, version = version + 1
+                WHERE id = ANY(%s::BIGINT[])
+                RETURNING id, tg_user_id, fk_outline_key_uuid
+            ),
+            released AS (
+                UPDATE outline_key
+                SET currently_used = FALSE
+                WHERE uuid IN (SELECT fk_outline_key_uuid FROM deactivated)
+            )
+            SELECT id, tg_user_id FROM deactivated;
+        """
+        self.cursor.execute(query, (key_ids,))
+        deactivated: list[tuple[int, int]] = self.cursor.fetchall()
 
-            # Update the outline_key table for the new UUID
-            update_new_outline_query = "UPDATE outline_key SET currently_used = TRUE WHERE uuid = %s;"
-            self.cursor.execute(update_new_outline_query, (new_outline_key_uuid,))
+        self.invalidate_dynamic_keys(deactivated)
+        deactivated_ids = {row[0] for row in deactivated}
+        return [key_id in deactivated_ids for key_id in key_ids]
 
-            self.conn.commit()  # Commit the transaction
-        except Exception as e:
-            self.conn.rollback()  # Rollback on error
-            raise e  # Re-raise the exception for handling outside
-        finally:
-            self.conn.autocommit = True  # Restore the autocommit setting
+    def update_dynamic_keys_with_new_outline_keys(self, keys: list[tuple[int, str]]) -> list[str]:
+        """
+        Move several dynamic keys to other outline keys with one statement, the batch version of
+        update_dynamic_key_with_new_outline_key. `keys` holds (key_id, new_outline_key_uuid) pairs, both unique
+        within the batch, so outline keys may also be swapped between the dynamic keys of the batch.
+
+        Return per pair "updated", "outline_key_not_found" or "dynamic_key_not_found".
+        """
+        query = """
+            WITH requested AS (
+                SELECT * FROM unnest(%(ids)s::BIGINT[], %(outline_key_uuids)s::UUID[]) AS r(id, outline_key_uuid)
+            ),
+            new_key AS (
+                SELECT r.id, ok.uuid, p.server, p.server_port, p.password, p.method
+                FROM requested r
+                JOIN outline_key ok ON ok.uuid = r.outline_key_uuid, parse_access_url(ok.access_url) p
+            ),
+            current_key AS (
+                SELECT id, fk_outline_key_uuid FROM dynamic_key WHERE id IN (SELECT id FROM requested)
+                ORDER BY id
+                FOR UPDATE
+            ),
+            updated AS (
+                UPDATE dynamic_key dk
+                SET server = nk.server, server_port = nk.server_port, password = nk.password, method = nk.method,
+                    is_active = TRUE, fk_outline_key_uuid = nk.uuid, version = dk.version + 1
+                FROM new_key nk
+                JOIN current_key ck ON ck.id = nk.id
+                WHERE dk.id = nk.id
+                RETURNING dk.id, dk.tg_user_id, ck.fk_outline_key_uuid AS previous_outline_key_uuid, nk.uuid
+            ),
+            released AS (
+                UPDATE outline_key
+                SET currently_used = FALSE
+                WHERE uuid IN (SELECT previous_outline_key_uuid FROM updated)
+                  AND uuid NOT IN (SELECT uuid FROM updated)
+            ),
+            claimed AS (
+                UPDATE outline_key
+                SET currently_used = TRUE, last_allocated_at = now()
+                WHERE uuid IN (SELECT uuid FROM updated)
+            )
+            SELECT r.id, nk.uuid IS NOT NULL, ck.id IS NOT NULL, u.tg_user_id
+            FROM requested r
+            LEFT JOIN new_key nk ON nk.id = r.id
+            LEFT JOIN current_key ck ON ck.id = r.id
+            LEFT JOIN updated u ON u.id = r.id;
+        """
+        self.cursor.execute(query, {"ids": [key[0] for key in keys], "outline_key_uuids": [key[1] for key in keys]})
+
+        statuses: dict[int, str] = {}
+        updated: list[tuple[int, int]] = []
+        for key_id, outline_key_found, dynamic_key_found, tg_user_id in self.cursor.fetchall():
+            if not outline_key_found:
+                statuses[key_id] = "outline_key_not_found"
+            elif not dynamic_key_found:
+                statuses[key_id] = "dynamic_key_not_found"
+            else:
+                statuses[key_id] = "updated"
+                updated.append((key_id, tg_user_id))
 
-    def get_dynamic_key_details(self, key_id: int, tg_user_id: int) -> dict | None:
+        self.invalidate_dynamic_keys(updated)
+        return [statuses[key[0]] for key in keys]
+
+    def evacuate_server(self, server_id: int, drain: bool = True, limit: int | None = None) -> dict[str, any]:
+        """
+        Move the active dynamic keys of a server to unused outline keys of the other active servers of its location.
+
+        Dynamic keys are paired with spare keys, rewritten and the outline keys swapped with one statement. With
+        `drain` the server is also deactivated, so no new dynamic key is given one of its keys; its existing keys
+        keep working until they are moved. A server the health checker took offline is deactivated by hand as well,
+        so that it is not reactivated when it recovers. Dynamic keys left without a spare key stay where they are and are
+        moved by the next call, at most `limit` keys are moved per call.
+
+        Return {"moved": number of moved keys, "remaining": active dynamic keys still on the server}.
+        """
         query = """
-            SELECT server, server_port, password, method
+            WITH drained AS (
+                UPDATE outline_server
+                SET is_active = FALSE, health_deactivated = FALSE
+                WHERE id = %(server_id)s AND %(drain)s AND (is_active = TRUE OR health_deactivated = TRUE)
+            ),
+            on_server AS (
+                SELECT dk.id, dk.fk_outline_key_uuid
+                FROM dynamic_key dk
+                JOIN outline_key ok ON ok.uuid = dk.fk_outline_key_uuid
+                WHERE ok.fk_outline_server_id = %(server_id)s AND dk.is_active = TRUE
+                ORDER BY dk.id
+                LIMIT %(limit)s
+                FOR UPDATE OF dk
+            ),
+            moving AS (
+                SELECT id, fk_outline_key_uuid, row_number() OVER (ORDER BY id) AS rank FROM on_server
+            ),
+            spare AS (
+                SELECT k.uuid, k.access_url, row_number() OVER () AS rank
+                FROM (
+                    SELECT uuid, access_url
+                    FROM outline_key
+                    WHERE currently_used = FALSE
+                    AND fk_outline_server_id IN (
+                        SELECT os.id
+                        FROM outline_server os
+                        JOIN outline_server_info osi ON os.id = osi.fk_outline_server_id
+                        WHERE os.is_active = TRUE AND os.id <> %(server_id)s
+                        AND osi.fk_server_location_id IN (
+                            SELECT fk_server_location_id FROM outline_server_info
+                            WHERE fk_outline_server_id = %(server_id)s
+                        )
+                    )
+                    LIMIT (SELECT count(*) FROM on_server)
+                    FOR UPDATE SKIP LOCKED
+                ) k
+            ),
+            matched AS (
+                SELECT m.id, m.fk_outline_key_uuid AS previous_outline_key_uuid, s.uuid,
+                       p.server, p.server_port, p.password, p.method
+                FROM moving m
+                JOIN spare s ON s.rank = m.rank, parse_access_url(s.access_url) p
+            ),
+            updated AS (
+                UPDATE dynamic_key dk
+                SET server = m.server, server_port = m.server_port, password = m.password, method = m.method,
+                    fk_outline_key_uuid = m.uuid, version = dk.version + 1
+                FROM matched m
+                WHERE dk.id = m.id
+                RETURNING dk.id, dk.tg_user_id
+            ),
+            released AS (
+                UPDATE outline_key
+                SET currently_used = FALSE
+                WHERE uuid IN (SELECT previous_outline_key_uuid FROM matched)
+            ),
+            claimed AS (
+                UPDATE outline_key
+                SET currently_used = TRUE, last_allocated_at = now()
+                WHERE uuid IN (SELECT uuid FROM matched)
+            )
+            SELECT (SELECT count(*)
+                    FROM dynamic_key dk
+                    JOIN outline_key ok ON ok.uuid = dk.fk_outline_key_uuid
+                    WHERE ok.fk_outline_server_id = %(server_id)s AND dk.is_active = TRUE),
+                   id, tg_user_id
+            FROM updated
+            RIGHT JOIN (SELECT 1) AS always_one_row ON TRUE;
+        """
+        self.cursor.execute(query, {"server_id": server_id, "drain": drain, "limit": limit})
+        rows = self.cursor.fetchall()
+
+        # the statement sees the keys as they were before it, moved ones included
+        moved: list[tuple[int, int]] = [(row[1], row[2]) for row in rows if row[1] is not None]
+        self.invalidate_dynamic_keys(moved)
+        if drain:
+            get_reference_data().reload()
+            get_server_selector().invalidate()
+
+        return {"moved": len(moved), "remaining": rows[0][0] - len(moved)}
+
+    def get_dynamic_key_client_config(self, key_id: int, tg_user_id: int) -> tuple[int, bytes] | None:
+        """
+        Return the version and the Outline client config of an active dynamic key as ready-to-send JSON bytes.
+
+        The bytes are built by the database whenever the key is written (dynamic_key.client_config), so a lookup
+        does no per-request dict or JSON work. The version is bumped by every change of the key.
+        """
+        cache = get_cache()
+        cache_key = dynamic_key_cache_key(key_id, tg_user_id)
+        if cache is not None:
+            cached = unpack_client_config(cache.get(cache_key))
+            if cached is not None:
+                return cached
+
+        query = """
+            SELECT version, client_config
             FROM dynamic_key
-            WHERE id = %s AND tg_user_id = %s AND is_active = TRUE;
+            WHERE id = $1 AND tg_user_id = $2 AND is_active = TRUE
         """
-        self.cursor.execute(query, (key_id, tg_user_id))
+        execute_prepared(self.cursor, "get_dynamic_key_client_config", query, (key_id, tg_user_id))
         result = self.cursor.fetchone()
         if result:
-            return {
-                "server": result[0],
-                "server_port": result[1],
-                "password": result[2],
-                "method": result[3]
-            }
+            version, client_config = result[0], bytes(result[1])
+            # Only found keys are cached, a missing key can be created at any moment. add() leaves the tombstone of
+            # a change committed since the row was read in place.
+            if cache is not None:
+                cache.add(cache_key, pack_client_config(version, client_config), CACHE_TTL)
+            return version, client_config
         return None
 
+    def get_dynamic_key_version(self, key_id: int, tg_user_id: int) -> int | None:
+        """Return the version of an active dynamic key, an index-only lookup used to answer conditional requests."""
+        cache = get_cache()
+        if cache is not None:
+            cached = unpack_client_config(cache.get(dynamic_key_cache_key(key_id, tg_user_id)))
+            if cached is not None:
+                return cached[0]
+
+        query = """
+            SELECT version
+            FROM dynamic_key
+            WHERE id = $1 AND tg_user_id = $2 AND is_active = TRUE
+        """
+        execute_prepared(self.cursor, "get_dynamic_key_version", query, (key_id, tg_user_id))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    @staticmethod
+    def invalidate_dynamic_key(key_id: int, tg_user_id: int) -> None:
+        """Replace the cached details of a dynamic key by a tombstone, called after every committed change."""
+        DatabaseManager.invalidate_dynamic_keys([(key_id, tg_user_id)])
+
+    @staticmethod
+    def invalidate_dynamic_keys(keys: list[tuple[int, int]]) -> None:
+        """Replace the cached details of several (key_id, tg_user_id) dynamic keys by tombstones with one cache call."""
+        cache = get_cache()
+        if cache is not None and keys:
+            cache.set_many([dynamic_key_cache_key(key_id, tg_user_id) for key_id, tg_user_id in keys], TOMBSTONE,
+                           CACHE_TOMBSTONE_TTL)
+
     def close(self) -> None:
-        self.cursor.close()
-        self.conn.close()
+        """Return the connection to the pool (or close it when pooling is off). Safe to call more than once."""
+        conn, cursor = self._conn, self._cursor
+        self._conn, self._cursor = None, None
+
+        if cursor is not None and not cursor.closed:
+            cursor.close()
+        if conn is not None:
+            if POSTGRES_POOL_SIZE > 0:
+                get_pool().putconn(conn)
+            else:
+                conn.close()
+
+
+def release_request_connections(exception: BaseException | None = None) -> None:
+    """Flask teardown handler: return connections of managers that were not closed while handling the request."""
+    for db_manager in g.pop("db_managers", []):
+        db_manager.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+-- Time an outline key was last assigned to a dynamic key, used by the spare key replenisher to forecast demand
+ALTER TABLE outline_key ADD COLUMN IF NOT EXISTS last_allocated_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_outline_key_last_allocated_at ON outline_key (fk_outline_server_id, last_allocated_at)
+WHERE last_allocated_at IS NOT NULL;
@@ -0,0 +1,18 @@
+-- Split an Outline access url (ss://base64(method:password)@server:server_port/...) into dynamic key fields.
+-- Unpadded and url-safe base64 is accepted as well.
+CREATE OR REPLACE FUNCTION parse_access_url(access_url VARCHAR,
+                                            OUT server VARCHAR, OUT server_port INTEGER,
+                                            OUT password VARCHAR, OUT method VARCHAR)
+LANGUAGE sql IMMUTABLE STRICT AS $$
+    SELECT split_part(host_port, ':', 1), split_part(host_port, ':', 2)::INTEGER,
+           split_part(credentials, ':', 2), split_part(credentials, ':', 1)
+    FROM (
+        SELECT convert_from(decode(rpad(translate(user_info, '-_', '+/'), (length(user_info) + 3) / 4 * 4, '='),
+                                   'base64'), 'UTF8') AS credentials,
+               host_port
+        FROM (
+            SELECT split_part(substr(access_url, 6), '@', 1) AS user_info,
+                   split_part(split_part(access_url, '@', 2), '/', 1) AS host_port
+        ) AS url_parts
+    ) AS parts;
+$$;
@@ -0,0 +1,2 @@
+-- Index for the one dynamic key per telegram user check done when a key is created
+CREATE INDEX IF NOT EXISTS idx_dynamic_key_tg_user_id ON dynamic_key (tg_user_id);
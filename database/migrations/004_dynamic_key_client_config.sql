@@ -0,0 +1,12 @@
+-- Response body of GET /keys/<key_id> (Outline client config), same bytes as Flask's jsonify() of the key fields.
+-- Stored in dynamic_key.client_config whenever a key is written, so lookups serve it without any JSON work.
+CREATE OR REPLACE FUNCTION dynamic_key_client_config(server VARCHAR, server_port INTEGER,
+                                                     password VARCHAR, method VARCHAR)
+RETURNS BYTEA
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT convert_to(format('{"method":%s,"password":%s,"server":%s,"server_port":%s}',
+                             to_json(method), to_json(password), to_json(server), server_port) || E'\n', 'UTF8');
+$$;
+
+ALTER TABLE dynamic_key ADD COLUMN IF NOT EXISTS client_config BYTEA
+GENERATED ALWAYS AS (dynamic_key_client_config(server, server_port, password, method)) STORED;
@@ -0,0 +1,6 @@
+-- Version of a dynamic key, bumped by every change and used as the ETag of GET /keys/<key_id>
+ALTER TABLE dynamic_key ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+-- Covering index for the version lookup that answers conditional GET /keys/<key_id> with an index-only scan
+CREATE INDEX IF NOT EXISTS idx_dynamic_key_version ON dynamic_key (id, tg_user_id) INCLUDE (version)
+WHERE is_active = TRUE;
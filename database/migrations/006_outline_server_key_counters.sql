@@ -0,0 +1,82 @@
+-- Per-server key counters maintained by triggers, replaces counting outline_key rows in GET /servers
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS unused_keys INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS used_keys INTEGER NOT NULL DEFAULT 0;
+
+-- Per-server unused/used key counters (outline_server.unused_keys, used_keys), kept up to date by statement level
+-- triggers on outline_key: a batch insert or a claim changes each affected server row once per statement.
+CREATE OR REPLACE FUNCTION outline_server_key_counters_trigger() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    changes TEXT := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT fk_outline_server_id, currently_used, 1 AS delta FROM new_keys'
+        WHEN 'DELETE' THEN 'SELECT fk_outline_server_id, currently_used, -1 AS delta FROM old_keys'
+        ELSE 'SELECT fk_outline_server_id, currently_used, 1 AS delta FROM new_keys
+              UNION ALL
+              SELECT fk_outline_server_id, currently_used, -1 AS delta FROM old_keys'
+    END;
+BEGIN
+    EXECUTE format('
+        UPDATE outline_server os
+        SET unused_keys = os.unused_keys + c.unused_delta, used_keys = os.used_keys + c.used_delta
+        FROM (
+            SELECT fk_outline_server_id,
+                   COALESCE(SUM(delta) FILTER (WHERE NOT currently_used), 0) AS unused_delta,
+                   COALESCE(SUM(delta) FILTER (WHERE currently_used), 0) AS used_delta
+            FROM (%s) AS changes
+            GROUP BY fk_outline_server_id
+        ) c
+        WHERE os.id = c.fk_outline_server_id AND (c.unused_delta <> 0 OR c.used_delta <> 0)', changes);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS outline_key_counters_insert ON outline_key;
+CREATE TRIGGER outline_key_counters_insert AFTER INSERT ON outline_key
+REFERENCING NEW TABLE AS new_keys
+FOR EACH STATEMENT EXECUTE FUNCTION outline_server_key_counters_trigger();
+
+DROP TRIGGER IF EXISTS outline_key_counters_update ON outline_key;
+CREATE TRIGGER outline_key_counters_update AFTER UPDATE ON outline_key
+REFERENCING OLD TABLE AS old_keys NEW TABLE AS new_keys
+FOR EACH STATEMENT EXECUTE FUNCTION outline_server_key_counters_trigger();
+
+DROP TRIGGER IF EXISTS outline_key_counters_delete ON outline_key;
+CREATE TRIGGER outline_key_counters_delete AFTER DELETE ON outline_key
+REFERENCING OLD TABLE AS old_keys
+FOR EACH STATEMENT EXECUTE FUNCTION outline_server_key_counters_trigger();
+
+-- Recount the key counters of every server and fix the ones that drifted, returning the corrections.
+-- Server rows are locked first, so key changes committed meanwhile are either counted or applied afterwards.
+CREATE OR REPLACE FUNCTION repair_outline_server_key_counters()
+RETURNS TABLE (server_id INTEGER, unused_keys_drift INTEGER, used_keys_drift INTEGER)
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM 1 FROM outline_server ORDER BY id FOR UPDATE;
+
+    RETURN QUERY
+    WITH counts AS (
+        SELECT os.id,
+               COUNT(ok.uuid) FILTER (WHERE ok.currently_used = FALSE)::INTEGER AS unused_keys,
+               COUNT(ok.uuid) FILTER (WHERE ok.currently_used = TRUE)::INTEGER AS used_keys
+        FROM outline_server os
+        LEFT JOIN outline_key ok ON os.id = ok.fk_outline_server_id
+        GROUP BY os.id
+    ),
+    drifted AS (
+        SELECT c.id, c.unused_keys, c.used_keys, os.unused_keys AS old_unused_keys, os.used_keys AS old_used_keys
+        FROM counts c
+        JOIN outline_server os ON os.id = c.id
+        WHERE os.unused_keys <> c.unused_keys OR os.used_keys <> c.used_keys
+    ),
+    repaired AS (
+        UPDATE outline_server os
+        SET unused_keys = d.unused_keys, used_keys = d.used_keys
+        FROM drifted d
+        WHERE os.id = d.id
+    )
+    SELECT d.id, d.old_unused_keys - d.unused_keys, d.old_used_keys - d.used_keys FROM drifted d ORDER BY d.id;
+END;
+$$;
+
+-- Initialize the counters of existing servers
+SELECT * FROM repair_outline_server_key_counters();
@@ -0,0 +1,26 @@
+-- Workers keep locations, providers and servers in memory (database/reference_data.py) and reload them when notified
+-- on reference_data_changed. outline_server only notifies for the columns they cache, not for key counter updates.
+CREATE OR REPLACE FUNCTION notify_reference_data_changed() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM pg_notify('reference_data_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS server_location_reference_data_changed ON server_location;
+CREATE TRIGGER server_location_reference_data_changed AFTER INSERT OR UPDATE OR DELETE ON server_location
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+DROP TRIGGER IF EXISTS server_provider_reference_data_changed ON server_provider;
+CREATE TRIGGER server_provider_reference_data_changed AFTER INSERT OR UPDATE OR DELETE ON server_provider
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+DROP TRIGGER IF EXISTS outline_server_info_reference_data_changed ON outline_server_info;
+CREATE TRIGGER outline_server_info_reference_data_changed AFTER INSERT OR UPDATE OR DELETE ON outline_server_info
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
+
+DROP TRIGGER IF EXISTS outline_server_reference_data_changed ON outline_server;
+CREATE TRIGGER outline_server_reference_data_changed
+AFTER INSERT OR DELETE OR UPDATE OF hostname, port, api_url, is_active ON outline_server
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
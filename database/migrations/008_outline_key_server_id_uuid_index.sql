@@ -0,0 +1,5 @@
+-- Index on fk_outline_server_id, ordered by uuid for the keyset pagination of GET /outline_keys/<server_id>
+CREATE INDEX IF NOT EXISTS idx_outline_key_server_id_uuid ON outline_key (fk_outline_server_id, uuid);
+
+-- Replaced by idx_outline_key_server_id_uuid, which serves the same lookups
+DROP INDEX IF EXISTS idx_outline_key_server_id;
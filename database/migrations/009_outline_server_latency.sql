@@ -0,0 +1,2 @@
+-- Smoothed response time of the Outline management API of each server, one of the server selection weights
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS latency_ms REAL;
@@ -0,0 +1,6 @@
+-- Results of the last 32 health checks of each server (outline/health_checker.py), newest in the lowest bit, 1 for
+-- a successful check. Servers start as healthy. health_deactivated marks servers the health checker took out of
+-- service, only those are put back into service when they recover.
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS health_history INTEGER NOT NULL DEFAULT -1;
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS health_checked_at TIMESTAMPTZ;
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS health_deactivated BOOLEAN NOT NULL DEFAULT FALSE;
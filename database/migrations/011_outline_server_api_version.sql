@@ -0,0 +1,8 @@
+-- Version of the Outline server reported by GET /server when it was registered, used to detect API capabilities.
+-- Workers cache it with the server list, so changing it notifies them like the other cached columns.
+ALTER TABLE outline_server ADD COLUMN IF NOT EXISTS api_version VARCHAR;
+
+DROP TRIGGER IF EXISTS outline_server_reference_data_changed ON outline_server;
+CREATE TRIGGER outline_server_reference_data_changed
+AFTER INSERT OR DELETE OR UPDATE OF hostname, port, api_url, is_active, api_version ON outline_server
+FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed();
@@ -0,0 +1,79 @@
+-- Bytes transferred by every outline key since the previous sample of the transfer metrics collector
+-- (outline/transfer_metrics.py), only keys that transferred something get a row. Append-only and partitioned by UTC
+-- day, so expired samples are dropped as whole partitions. Columns are ordered by alignment to avoid padding, and the
+-- dynamic key is the one the outline key belonged to when it was sampled.
+CREATE TABLE IF NOT EXISTS transfer_sample (
+    sampled_at TIMESTAMPTZ NOT NULL,
+    bytes BIGINT NOT NULL,
+    dynamic_key_id BIGINT,
+    outline_key_uuid UUID NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL
+) PARTITION BY RANGE (sampled_at);
+
+-- Samples are appended in time order, a BRIN index finds the last hours for the rollups in a few pages
+CREATE INDEX IF NOT EXISTS idx_transfer_sample_sampled_at ON transfer_sample USING BRIN (sampled_at);
+
+-- Create the missing daily partitions of transfer_sample from first_day to last_day
+CREATE OR REPLACE FUNCTION create_transfer_sample_partitions(first_day DATE, last_day DATE) RETURNS VOID
+LANGUAGE plpgsql AS $$
+DECLARE
+    day DATE;
+BEGIN
+    FOR day IN SELECT generate_series(first_day, last_day, INTERVAL '1 day')::DATE LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF transfer_sample FOR VALUES FROM (%L) TO (%L)',
+                       'transfer_sample_' || to_char(day, 'YYYYMMDD'),
+                       day::TIMESTAMP AT TIME ZONE 'UTC', (day + 1)::TIMESTAMP AT TIME ZONE 'UTC');
+    END LOOP;
+END;
+$$;
+
+-- Drop the daily partitions of transfer_sample before before_day, returning their names
+CREATE OR REPLACE FUNCTION drop_transfer_sample_partitions(before_day DATE) RETURNS SETOF TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'transfer_sample'::REGCLASS
+          AND to_date(right(c.relname, 8), 'YYYYMMDD') < before_day
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$;
+
+-- Hourly and daily (UTC) transfer of every outline key, rolled up from transfer_sample by the collector. The dynamic
+-- key is the one of the latest sample of the period.
+CREATE TABLE IF NOT EXISTS transfer_hourly (
+    period_start TIMESTAMPTZ NOT NULL,
+    bytes BIGINT NOT NULL,
+    dynamic_key_id BIGINT,
+    outline_key_uuid UUID NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+
+    PRIMARY KEY (period_start, outline_key_uuid)
+);
+
+CREATE TABLE IF NOT EXISTS transfer_daily (
+    period_start TIMESTAMPTZ NOT NULL,
+    bytes BIGINT NOT NULL,
+    dynamic_key_id BIGINT,
+    outline_key_uuid UUID NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+
+    PRIMARY KEY (period_start, outline_key_uuid)
+);
+
+-- Index for the usage of one dynamic key over time
+CREATE INDEX IF NOT EXISTS idx_transfer_daily_dynamic_key_id ON transfer_daily (dynamic_key_id, period_start)
+WHERE dynamic_key_id IS NOT NULL;
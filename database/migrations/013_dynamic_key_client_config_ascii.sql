@@ -0,0 +1,28 @@
+-- JSON text of a value with non-ASCII characters escaped as \uXXXX, surrogate pairs above U+FFFF, like the
+-- ensure_ascii output of Python's json.dumps that Flask's jsonify() uses. ASCII text is returned as it is.
+CREATE OR REPLACE FUNCTION json_ascii(value JSON) RETURNS TEXT
+LANGUAGE sql IMMUTABLE STRICT AS $$
+    SELECT CASE WHEN octet_length(value::TEXT) = length(value::TEXT) THEN value::TEXT ELSE (
+        SELECT string_agg(CASE WHEN code < 128 THEN c
+                               WHEN code < 65536 THEN '\u' || lpad(to_hex(code), 4, '0')
+                               ELSE '\u' || to_hex(55296 + (code - 65536) / 1024) ||
+                                    '\u' || to_hex(56320 + (code - 65536) % 1024) END, '' ORDER BY n)
+        FROM regexp_split_to_table(value::TEXT, '') WITH ORDINALITY AS chars(c, n), ascii(c) AS code
+    ) END;
+$$;
+
+-- Response body of GET /keys/<key_id> (Outline client config), same bytes as Flask's jsonify() of the key fields.
+-- Stored in dynamic_key.client_config whenever a key is written, so lookups serve it without any JSON work.
+CREATE OR REPLACE FUNCTION dynamic_key_client_config(server VARCHAR, server_port INTEGER,
+                                                     password VARCHAR, method VARCHAR)
+RETURNS BYTEA
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT convert_to(format('{"method":%s,"password":%s,"server":%s,"server_port":%s}',
+                             json_ascii(to_json(method)), json_ascii(to_json(password)),
+                             json_ascii(to_json(server)), server_port) || E'\n', 'UTF8');
+$$;
+
+-- Stored configs of keys with non-ASCII fields are computed again, only an update of a column they are made of does
+-- that. The new body gets a new version.
+UPDATE dynamic_key SET server = server, version = version + 1
+WHERE octet_length(server || password || method) <> length(server || password || method);
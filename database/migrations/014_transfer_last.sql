@@ -0,0 +1,17 @@
+-- Last transfer metrics report of every server seen by the transfer metrics collector (outline/transfer_metrics.py),
+-- the bytes each Outline key id transferred in the 30 days before reported_at. Samples are the growth since this
+-- report, and it is replaced in the same transaction as the samples are stored, so collectors taking turns all
+-- compute against the latest report.
+CREATE TABLE IF NOT EXISTS transfer_last (
+    bytes BIGINT NOT NULL,
+    fk_outline_server_id INTEGER NOT NULL,
+    outline_key_id INTEGER NOT NULL,
+
+    PRIMARY KEY (fk_outline_server_id, outline_key_id)
+);
+
+-- Servers with a report in transfer_last, the first report of a server only primes it
+CREATE TABLE IF NOT EXISTS transfer_last_report (
+    fk_outline_server_id INTEGER PRIMARY KEY,
+    reported_at TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,3 @@
+-- One server per api_url, so concurrent POST /servers requests can't register the same server twice. Servers
+-- registered twice already have to be merged by hand before this index can be created.
+CREATE UNIQUE INDEX IF NOT EXISTS outline_server_api_url_key ON outline_server (api_url);
@@ -0,0 +1,68 @@
+import re
+from psycopg2 import errors, extensions
+from config import POSTGRES_PREPARED_STATEMENTS
+
+"""
+Server-side prepared statements for the fixed, frequently executed DatabaseManager queries.
+
+A statement is prepared with PREPARE the first time it is used on a connection and executed by name afterwards,
+so Postgres parses and plans it once per session instead of once per call. Connections created with
+`PreparedStatementsConnection` remember which statements they hold. Statement text uses `$1`, `$2`, ... parameters.
+
+Transaction-pooling proxies (PgBouncer in transaction mode and similar) hand every transaction a different server
+session, so statements prepared in one are missing in the next. Set POSTGRES_PREPARED_STATEMENTS=false there to
+send the same queries as plain statements.
+"""
+
+_PARAMETER = re.compile(r"\$(\d+)")
+
+
+class PreparedStatementsConnection(extensions.connection):
+    """psycopg2 connection that keeps track of the statements prepared in its session."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared_statements: set[str] = set()
+
+
+def to_plain_query(query: str) -> str:
+    """Rewrite `$n` parameters as psycopg2 placeholders, for executing a statement without preparing it."""
+    return _PARAMETER.sub(r"%(\1)s", query)
+
+
+def execute_prepared(cursor: extensions.cursor, name: str, query: str, params: tuple = ()) -> None:
+    """
+    Execute `query` as the prepared statement `name` on the connection of `cursor`.
+
+    Falls back to a plain execute when prepared statements are disabled or the connection does not track them.
+    A statement that has disappeared from the session (DISCARD ALL, a proxy switching server sessions) is prepared
+    again once, as long as no transaction is open that the failure would have aborted.
+    """
+    conn = cursor.connection
+    if not POSTGRES_PREPARED_STATEMENTS or not isinstance(conn, PreparedStatementsConnection):
+        cursor.execute(to_plain_query(query), {str(i): value for i, value in enumerate(params, start=1)})
+        return
+
+    execute_query = f"EXECUTE {name} ({', '.join(['%s'] * len(params))});" if params else f"EXECUTE {name};"
+
+    if name not in conn.prepared_statements:
+        _prepare(cursor, name, query)
+
+    try:
+        cursor.execute(execute_query, params)
+    except errors.InvalidSqlStatementName:
+        conn.prepared_statements.discard(name)
+        if not conn.autocommit:
+            raise
+        _prepare(cursor, name, query)
+        cursor.execute(execute_query, params)
+
+
+def _prepare(cursor: extensions.cursor, name: str, query: str) -> None:
+    try:
+        cursor.execute(f"PREPARE {name} AS {query}")
+    except errors.DuplicatePreparedStatement:
+        # already prepared in this session, e.g. by an earlier client of a session reused by a proxy
+        if not cursor.connection.autocommit:
+            raise
+    cursor.connection.prepared_statements.add(name)
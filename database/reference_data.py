@@ -0,0 +1,171 @@
+import logging
+import os
+import select
+import threading
+import time
+import psycopg2
+from config import POSTGRES_CREDENTIALS, REFERENCE_DATA_REFRESH_INTERVAL
+
+"""
+In-process registry of rarely changing reference data: locations, providers and Outline servers.
+
+Each worker loads the tables once and answers lookups from memory. Triggers in database.sql send
+NOTIFY reference_data_changed on every change of these tables, and a listener thread reloads the registry when it
+receives one. As a safety net for missed notifications (connection loss, proxies without LISTEN support) the
+registry is also reloaded every REFERENCE_DATA_REFRESH_INTERVAL seconds.
+"""
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL: str = "reference_data_changed"
+
+
+class ReferenceDataSnapshot:
+    """Immutable view of the reference tables, replaced as a whole on every reload."""
+
+    def __init__(self, locations: list[tuple], provider_ids: list[int], servers: list[tuple]) -> None:
+        # locations: (id, location, location_ru, iso, has_active_server), servers: (id, api_url, api_version)
+        self.locations: list[dict[str, str]] = [
+            {"location": row[1], "location_ru": row[2], "iso": row[3]} for row in locations
+        ]
+        self.active_locations: list[dict[str, str]] = [
+            {"location": row[1], "location_ru": row[2], "iso": row[3]} for row in locations if row[4]
+        ]
+        self.inactive_locations: list[dict[str, str]] = [
+            {"location": row[1], "location_ru": row[2], "iso": row[3]} for row in locations if not row[4]
+        ]
+        self.location_ids: dict[str, int] = {row[1]: row[0] for row in locations}
+        self.provider_ids: frozenset[int] = frozenset(provider_ids)
+        self.server_api_urls: dict[int, str] = {row[0]: row[1] for row in servers}
+        self.server_api_versions: dict[int, str | None] = {row[0]: row[2] for row in servers}
+
+
+class ReferenceDataRegistry:
+
+    def __init__(self, refresh_interval: float = REFERENCE_DATA_REFRESH_INTERVAL,
+                 credentials: dict[str, any] = POSTGRES_CREDENTIALS) -> None:
+        self.refresh_interval = refresh_interval
+        self._credentials = credentials
+        self._snapshot: ReferenceDataSnapshot | None = None
+        self._lock = threading.Lock()
+        self._listener: threading.Thread | None = None
+
+    @property
+    def snapshot(self) -> ReferenceDataSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                    self._start_listener()
+                snapshot = self._snapshot
+        return snapshot
+
+    def reload(self) -> None:
+        """Load the tables again, called on change notifications and after local writes."""
+        snapshot = self._load()
+        with self._lock:
+            self._snapshot = snapshot
+
+    def location_exists(self, location_name: str) -> bool:
+        return location_name in self.snapshot.location_ids
+
+    def get_location_id(self, location_name: str) -> int | None:
+        return self.snapshot.location_ids.get(location_name)
+
+    def get_locations(self, active_servers: bool | None = None) -> list[dict[str, str]]:
+        snapshot = self.snapshot
+        if active_servers is True:
+            locations = snapshot.active_locations
+        elif active_servers is False:
+            locations = snapshot.inactive_locations
+        else:
+            locations = snapshot.locations
+        return [dict(location) for location in locations]
+
+    def provider_exists(self, provider_id: int) -> bool:
+        return provider_id in self.snapshot.provider_ids
+
+    def server_exists(self, server_id: int) -> bool:
+        return server_id in self.snapshot.server_api_urls
+
+    def get_server_api_url(self, server_id: int) -> str | None:
+        return self.snapshot.server_api_urls.get(server_id)
+
+    def get_server_api_version(self, server_id: int) -> str | None:
+        return self.snapshot.server_api_versions.get(server_id)
+
+    def _load(self) -> ReferenceDataSnapshot:
+        # Reloads are rare, a short-lived connection keeps them from taking pool slots from requests
+        conn = psycopg2.connect(**self._credentials)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT sl.id, sl.location, sl.location_ru, sl.iso,
+                           EXISTS (
+                               SELECT 1 FROM outline_server_info osi
+                               INNER JOIN outline_server os ON osi.fk_outline_server_id = os.id
+                               WHERE osi.fk_server_location_id = sl.id AND os.is_active = TRUE
+                           )
+                    FROM server_location sl
+                    ORDER BY sl.id;
+                """)
+                locations = cursor.fetchall()
+                cursor.execute("SELECT id FROM server_provider;")
+                provider_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute("SELECT id, api_url, api_version FROM outline_server;")
+                servers = cursor.fetchall()
+        finally:
+            conn.close()
+
+        return ReferenceDataSnapshot(locations, provider_ids, servers)
+
+    def _start_listener(self) -> None:
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = threading.Thread(target=self._listen, name="reference-data-listener", daemon=True)
+            self._listener.start()
+
+    def _listen(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self._credentials)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {NOTIFY_CHANNEL};")
+                # changes made while the listener was not connected were missed
+                self.reload()
+
+                while True:
+                    readable, _, _ = select.select([conn], [], [], self.refresh_interval or None)
+                    if readable:
+                        conn.poll()
+                        if not conn.notifies:
+                            continue
+                        # one reload covers any number of queued notifications
+                        conn.notifies.clear()
+                    self.reload()
+            except Exception:
+                logger.exception("Reference data listener failed, reconnecting")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+_registry: ReferenceDataRegistry | None = None
+_registry_pid: int | None = None
+_registry_lock = threading.Lock()
+
+
+def get_reference_data() -> ReferenceDataRegistry:
+    """Return the registry of the current process; a forked worker gets its own, since threads don't survive fork."""
+    global _registry, _registry_pid
+
+    pid = os.getpid()
+    if _registry is None or _registry_pid != pid:
+        with _registry_lock:
+            if _registry is None or _registry_pid != pid:
+                _registry = ReferenceDataRegistry()
+                _registry_pid = pid
+    return _registry
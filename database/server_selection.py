@@ -0,0 +1,107 @@
+import os
+import random
+import threading
+import time
+from collections.abc import Callable
+from config import (SERVER_SELECTION_REFRESH_INTERVAL, SERVER_SELECTION_SPARE_KEYS_REFERENCE,
+                    SERVER_SELECTION_LATENCY_REFERENCE_MS)
+
+"""
+Load-aware choice of the Outline server a new dynamic key is assigned to when only its location is given.
+
+Every active server of the location gets a weight from its active dynamic keys (used_keys), its spare inventory
+(unused_keys) and the smoothed latency of its management API (latency_ms). The server is drawn at random in
+proportion to the weights, so workers deciding on the same cached scores still spread new keys instead of all
+picking the same server. Scores are read from the trigger-maintained counters of outline_server, no aggregate
+query, at most every SERVER_SELECTION_REFRESH_INTERVAL seconds per worker; in between every pick is counted in
+the cached scores of the worker.
+"""
+
+
+def server_weight(unused_keys: int, used_keys: int, latency_ms: float | None,
+                  spare_keys_reference: int = SERVER_SELECTION_SPARE_KEYS_REFERENCE,
+                  latency_reference_ms: float = SERVER_SELECTION_LATENCY_REFERENCE_MS) -> float:
+    if unused_keys <= 0:
+        return 0.0
+
+    # new keys are shared in inverse proportion to the keys a server already serves
+    load_factor = 1 / (1 + used_keys)
+    # halved at `spare_keys_reference` spare keys, a server running out is spared until it is replenished
+    inventory_factor = unused_keys / (unused_keys + spare_keys_reference)
+    # halved at `latency_reference_ms`, a slow management API is the first sign of an overloaded VPS;
+    # servers without observed latency are taken as average
+    if latency_ms is None:
+        latency_ms = latency_reference_ms
+    latency_factor = latency_reference_ms / (latency_reference_ms + latency_ms)
+
+    return load_factor * inventory_factor * latency_factor
+
+
+class ServerSelector:
+
+    def __init__(self, refresh_interval: float = SERVER_SELECTION_REFRESH_INTERVAL) -> None:
+        self.refresh_interval = refresh_interval
+        self._servers: list[dict[str, any]] | None = None
+        self._loaded_at: float = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def pick(self, location: str, load_servers: Callable[[], list[dict[str, any]]]) -> int | None:
+        """
+        Return the id of an active server of `location` drawn by weight, None if none of them has spare keys.
+
+        `load_servers` returns the current {"id", "location", "unused_keys", "used_keys", "latency_ms"} of the
+        active servers, it is called when the cached scores are older than the refresh interval.
+        """
+        self._refresh(load_servers)
+
+        with self._lock:
+            candidates = [server for server in self._servers if server["location"] == location]
+            weights = [server_weight(server["unused_keys"], server["used_keys"], server["latency_ms"])
+                       for server in candidates]
+            if not any(weights):
+                return None
+
+            server = random.choices(candidates, weights)[0]
+            # count the assignment until the next refresh brings the real counters
+            server["unused_keys"] -= 1
+            server["used_keys"] += 1
+            return server["id"]
+
+    def invalidate(self) -> None:
+        """Reload the scores on the next pick, e.g. after servers were activated or deactivated."""
+        self._loaded_at = 0.0
+
+    def _refresh(self, load_servers: Callable[[], list[dict[str, any]]]) -> None:
+        if self._servers is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+
+        # One caller reloads, the others keep using the previous scores meanwhile
+        if not self._refresh_lock.acquire(blocking=self._servers is None):
+            return
+        try:
+            if self._servers is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+                servers = load_servers()
+                with self._lock:
+                    self._servers = servers
+                    self._loaded_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+
+_selector: ServerSelector | None = None
+_selector_pid: int | None = None
+_selector_lock = threading.Lock()
+
+
+def get_server_selector() -> ServerSelector:
+    """Return the server selector of the current process."""
+    global _selector, _selector_pid
+
+    pid = os.getpid()
+    if _selector is None or _selector_pid != pid:
+        with _selector_lock:
+            if _selector is None or _selector_pid != pid:
+                _selector = ServerSelector()
+                _selector_pid = pid
+    return _selector
@@ -0,0 +1,14 @@
+import os
+import shutil
+
+"""
+gunicorn settings, read from the working directory by every gunicorn started in it.
+"""
+
+
+def on_starting(server) -> None:
+    # Metric files of the workers of a previous run would be added to the ones of this run, see metrics.py
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
@@ -0,0 +1,98 @@
+import os
+import re
+import time
+from flask import Response, g, request
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest,
+                               multiprocess)
+from psycopg2 import extensions
+
+"""
+Prometheus metrics of the app, served by GET /metrics (routes/metrics.py).
+
+- http_request_duration_seconds: every Flask request by blueprint, route rule, method and status
+- db_pool_wait_seconds, db_connect_seconds, db_pool_timeouts_total: waiting for a pooled connection, opening one
+- db_query_duration_seconds: every statement of a DatabaseManager by its first keyword, `_count` is the query count
+- outline_api_calls_total, outline_api_request_duration_seconds: every attempt of a call to an Outline server by
+  outcome, key ids in paths are replaced by {id}
+
+Each gunicorn worker counts in its own process. With PROMETHEUS_MULTIPROC_DIR set (Dockerfile.flask_app), the
+workers write their values to files in that directory and GET /metrics adds up the files of all of them, so whichever
+worker answers a scrape reports the totals of the replica. gunicorn.conf.py empties the directory when gunicorn
+starts. Without it, e.g. under `flask run` and in tests, the values of the current process are served.
+"""
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Duration of HTTP requests",
+                             ["blueprint", "route", "method", "status"])
+
+DB_POOL_WAIT = Histogram("db_pool_wait_seconds", "Time waited for a free slot of the database connection pool",
+                         buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+DB_CONNECT = Histogram("db_connect_seconds", "Time to open a new database connection")
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "Requests for a pooled connection that timed out")
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Duration of database statements", ["statement"],
+                              buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+OUTLINE_API_CALLS = Counter("outline_api_calls_total", "Attempted calls to the Outline management API",
+                            ["method", "path", "outcome"])
+OUTLINE_API_DURATION = Histogram("outline_api_request_duration_seconds",
+                                 "Duration of calls to the Outline management API that were sent",
+                                 ["method", "path"])
+
+# first keywords counted by name, anything else is "other" so the label can't grow without bound
+_STATEMENTS = {"select", "insert", "update", "delete", "with", "execute", "prepare", "copy", "create", "truncate"}
+_PATH_ID = re.compile(r"/\d+")
+
+
+def statement_label(query: any) -> str:
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    if not isinstance(query, str):
+        return "other"
+    words = query.split(None, 1)
+    keyword = words[0].lower() if words else ""
+    return keyword if keyword in _STATEMENTS else "other"
+
+
+def outline_path_label(path: str) -> str:
+    """Return /access-keys/12/name as /access-keys/{id}/name."""
+    return _PATH_ID.sub("/{id}", path)
+
+
+class InstrumentedCursor(extensions.cursor):
+    """psycopg2 cursor that times its statements in db_query_duration_seconds."""
+
+    def execute(self, query, vars=None):
+        started_at = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            DB_QUERY_DURATION.labels(statement_label(query)).observe(time.perf_counter() - started_at)
+
+    def copy_expert(self, sql, file, size=8192):
+        started_at = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            DB_QUERY_DURATION.labels("copy").observe(time.perf_counter() - started_at)
+
+
+def start_request_timer() -> None:
+    g.request_started_at = time.perf_counter()
+
+
+def observe_request(response: Response) -> Response:
+    started_at = g.pop("request_started_at", None)
+    if started_at is not None:
+        # the rule, not the path, so /keys/<key_id> is one series for all keys
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_DURATION.labels(request.blueprint or "", route, request.method,
+                                str(response.status_code)).observe(time.perf_counter() - started_at)
+    return response
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    """Return the metrics in the Prometheus text format and its content type."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,301 @@
+import os
+import random
+import ssl
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.ssl_ import create_urllib3_context
+from metrics import OUTLINE_API_CALLS, OUTLINE_API_DURATION, outline_path_label
+from config import (OUTLINE_API_TIMEOUT, OUTLINE_PROVISIONING_CONCURRENCY, OUTLINE_API_RETRIES,
+                    OUTLINE_API_RETRY_BACKOFF, OUTLINE_CIRCUIT_FAILURE_THRESHOLD, OUTLINE_CIRCUIT_RESET_TIMEOUT)
+
+"""
+Client of the Outline management API, every call to an Outline server goes through it.
+
+There is one client per server and process, see get_client. It keeps connections to the server alive in a session
+whose connections share one TLS context, applies OUTLINE_API_TIMEOUT to every call and retries idempotent calls
+(GET, PUT, DELETE) up to OUTLINE_API_RETRIES times after a random part of an exponentially growing delay. Creating
+a key is never retried, a retry could create a second key. Servers that are not registered yet are called through
+probe_server, which keeps no client.
+
+Capabilities are derived from the server version reported by GET /server, stored when the server is registered and
+passed to get_client. For servers registered without one, the client asks the server once.
+
+A circuit breaker stops calling a server after OUTLINE_CIRCUIT_FAILURE_THRESHOLD failed calls in a row: calls fail
+right away with CircuitOpenError for OUTLINE_CIRCUIT_RESET_TIMEOUT seconds, then one trial call decides whether the
+server is called again. Timeouts, connection errors and 5xx responses count as failures.
+"""
+
+
+# first Outline server version that accepts the name of a new key in POST /access-keys
+NAMED_KEYS_MIN_VERSION: tuple[int, ...] = (1, 8, 0)
+
+
+class OutlineAPIError(Exception):
+    """A call to the Outline management API failed, status_code is set when the server answered with an error."""
+
+    def __init__(self, message: str, status_code: int | None = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(OutlineAPIError):
+    """The server is not called because its recent calls failed."""
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int = OUTLINE_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = OUTLINE_CIRCUIT_RESET_TIMEOUT) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures: int = 0
+        self.opened_at: float | None = None
+        self._trial_in_flight: bool = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """"closed", "open" or "half_open" (open, but a trial call is allowed)."""
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        """Return whether a call may be made now, in the half-open state only one trial call at a time."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            # a failed trial call opens the circuit for another reset_timeout
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """Give back a trial call that ended without a result, e.g. with an unexpected exception."""
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class _OutlineAdapter(HTTPAdapter):
+    """Connection pool whose connections share the TLS context of the process."""
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        kwargs["ssl_context"] = _tls_context()
+        super().init_poolmanager(*args, **kwargs)
+
+
+class OutlineClient:
+
+    def __init__(self, api_url: str, breaker: CircuitBreaker | None = None, api_version: str | None = None) -> None:
+        self.api_url = api_url.rstrip("/")
+        self.breaker = breaker or CircuitBreaker()
+        self.api_version = api_version
+        self._version_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount(self.api_url, _OutlineAdapter(pool_connections=1,
+                                                         pool_maxsize=max(OUTLINE_PROVISIONING_CONCURRENCY, 1)))
+
+    def get_server(self, timeout: float | None = None, retries: int | None = None,
+                   check_circuit: bool = True) -> dict[str, any]:
+        """
+        Return the server information, e.g. hostnameForAccessKeys and portForNewAccessKeys.
+
+        Health checks pass check_circuit=False: they are sent while the circuit is open too, and their result
+        still closes or opens it.
+        """
+        return _json(self._request("get", "/server", idempotent=True, timeout=timeout, retries=retries,
+                                   check_circuit=check_circuit))
+
+    def supports_named_keys(self) -> bool:
+        """Return whether the server sets the name of a new key given to create_access_key."""
+        if self.api_version is None:
+            with self._version_lock:
+                if self.api_version is None:
+                    try:
+                        self.api_version = str(self.get_server().get("version", ""))
+                    except OutlineAPIError:
+                        # unknown for now, asked again on the next call
+                        return False
+
+        version = _parse_version(self.api_version)
+        return version is not None and version >= NAMED_KEYS_MIN_VERSION
+
+    def create_access_key(self, name: str | None = None) -> dict[str, any]:
+        """
+        Create an access key, return its data with "id", "accessUrl" and "name".
+
+        The name is only sent when given, servers older than NAMED_KEYS_MIN_VERSION ignore it, see
+        supports_named_keys.
+        """
+        kwargs = {} if name is None else {"json": {"name": name}}
+        return _json(self._request("post", "/access-keys", idempotent=False, **kwargs))
+
+    def list_access_keys(self, timeout: float | None = None) -> list[dict[str, any]]:
+        """Return all access keys of the server, each with "id", "name" and "accessUrl"."""
+        return _json(self._request("get", "/access-keys", idempotent=True, timeout=timeout)).get("accessKeys", [])
+
+    def get_transfer_metrics(self, timeout: float | None = None) -> dict[str, int]:
+        """Return the bytes transferred by each access key id in the last 30 days, keys without transfer are left out."""
+        return _json(self._request("get", "/metrics/transfer", idempotent=True,
+                                   timeout=timeout)).get("bytesTransferredByUserId", {})
+
+    def rename_access_key(self, key_id: str, name: str) -> None:
+        self._request("put", f"/access-keys/{key_id}/name", idempotent=True, json={"name": name})
+
+    def delete_access_key(self, key_id: str) -> None:
+        """Delete an access key, a key that does not exist counts as deleted."""
+        try:
+            self._request("delete", f"/access-keys/{key_id}", idempotent=True)
+        except OutlineAPIError as e:
+            if e.status_code != 404:
+                raise
+
+    def _request(self, method: str, path: str, idempotent: bool, timeout: float | None = None,
+                 retries: int | None = None, check_circuit: bool = True, **kwargs) -> requests.Response:
+        attempts = 1 + ((OUTLINE_API_RETRIES if retries is None else retries) if idempotent else 0)
+        error: OutlineAPIError | None = None
+        path_label = outline_path_label(path)
+
+        for attempt in range(attempts):
+            if attempt:
+                # full jitter, retries of concurrent callers don't hit a recovering server at the same moment
+                time.sleep(random.uniform(0, OUTLINE_API_RETRY_BACKOFF * 2 ** (attempt - 1)))
+
+            if check_circuit and not self.breaker.allow():
+                OUTLINE_API_CALLS.labels(method, path_label, "circuit_open").inc()
+                raise CircuitOpenError(f"Circuit open for {self.api_url}, the server failed recently")
+
+            started_at = time.perf_counter()
+            try:
+                # the method helpers rather than session.request, so tests can patch requests.Session.<method>.
+                # Outline servers use self-signed certificates. verify is passed per call, a session.verify of False
+                # would be overridden by REQUESTS_CA_BUNDLE.
+                response: requests.Response = getattr(self.session, method)(
+                    f"{self.api_url}{path}", timeout=OUTLINE_API_TIMEOUT if timeout is None else timeout,
+                    verify=False, **kwargs)
+                response.raise_for_status()
+
+            except requests.exceptions.Timeout:
+                error = OutlineAPIError("Request timed out")
+                outcome = "timeout"
+
+            except requests.exceptions.HTTPError as e:
+                error = OutlineAPIError(str(e), response.status_code)
+                outcome = f"{response.status_code // 100}xx"
+                if response.status_code < 500:
+                    # the server is up, the request itself is wrong and would fail again
+                    self.breaker.record_success()
+                    _observe_call(method, path_label, outcome, started_at)
+                    raise error
+
+            except RequestException as e:
+                error = OutlineAPIError(str(e))
+                outcome = "connection_error"
+
+            except BaseException:
+                # neither success nor failure of the server, a half-open circuit would wait for this trial forever
+                if check_circuit:
+                    self.breaker.release_trial()
+                raise
+
+            else:
+                self.breaker.record_success()
+                _observe_call(method, path_label, "success", started_at)
+                return response
+
+            self.breaker.record_failure()
+            _observe_call(method, path_label, outcome, started_at)
+
+        raise error
+
+
+def _observe_call(method: str, path_label: str, outcome: str, started_at: float) -> None:
+    OUTLINE_API_CALLS.labels(method, path_label, outcome).inc()
+    OUTLINE_API_DURATION.labels(method, path_label).observe(time.perf_counter() - started_at)
+
+
+def _parse_version(version: any) -> tuple[int, ...] | None:
+    """Return "1.8.2" as (1, 8, 2), None if it is not a version number."""
+    if not isinstance(version, str):
+        return None
+    try:
+        return tuple(int(part) for part in version.split("."))
+    except ValueError:
+        return None
+
+
+def _json(response: requests.Response) -> dict[str, any]:
+    try:
+        return response.json()
+    except ValueError as e:
+        raise OutlineAPIError(f"Invalid response: {e}", response.status_code)
+
+
+_clients: dict[str, OutlineClient] = {}
+_clients_pid: int | None = None
+_clients_lock = threading.Lock()
+_context: ssl.SSLContext | None = None
+
+
+def _tls_context() -> ssl.SSLContext:
+    global _context
+    if _context is None:
+        context = create_urllib3_context(cert_reqs=ssl.CERT_NONE)
+        context.check_hostname = False
+        _context = context
+    return _context
+
+
+def get_client(api_url: str, api_version: str | None = None) -> OutlineClient:
+    """
+    Return the client of the Outline server behind `api_url` in the current process.
+
+    `api_version` is the version stored when the server was registered, it replaces the one the client knows.
+    """
+    global _clients_pid
+
+    with _clients_lock:
+        # Sessions hold sockets, a forked worker must not share them with its parent
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+
+        client = _clients.get(api_url)
+        if client is None:
+            client = OutlineClient(api_url)
+            _clients[api_url] = client
+        if api_version is not None:
+            client.api_version = api_version
+        return client
+
+
+def probe_server(api_url: str, timeout: float | None = None) -> dict[str, any]:
+    """
+    Return the server information of an Outline server that may not be registered, see OutlineClient.get_server.
+
+    The call goes through a client of its own that is closed right after, so probing arbitrary URLs leaves no pooled
+    client behind in get_client.
+    """
+    client = OutlineClient(api_url)
+    try:
+        return client.get_server(timeout=timeout)
+    finally:
+        client.session.close()
@@ -0,0 +1,107 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
+from database.database_manager import DatabaseManager
+from outline.client import get_client, OutlineAPIError
+from config import (HEALTH_CHECK_INTERVAL, HEALTH_CHECK_TIMEOUT, HEALTH_CHECK_CONCURRENCY,
+                    HEALTH_CHECK_FAILURE_THRESHOLD, HEALTH_CHECK_RECOVERY_THRESHOLD)
+
+"""
+Background health checker of the Outline servers.
+
+Every HEALTH_CHECK_INTERVAL seconds the management API (`GET {api_url}/server`) of every active server is called,
+all servers at once with a HEALTH_CHECK_TIMEOUT second timeout, so one round takes about one timeout at most.
+The results are kept in outline_server.health_history, the response times in outline_server.latency_ms.
+
+A server failing HEALTH_CHECK_FAILURE_THRESHOLD checks in a row is set inactive: GET /servers, GET /locations and new
+dynamic keys leave it out. The checker keeps polling the servers it deactivated and sets them active again after
+HEALTH_CHECK_RECOVERY_THRESHOLD successful checks in a row. Servers deactivated otherwise, e.g. by
+POST /servers/<server_id>/evacuate, are not polled.
+
+Run it with `python -m outline.health_checker`. Several instances may run at once, a Postgres advisory lock makes
+sure only one of them works on a round.
+"""
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock id of the health checker, any constant that is not used by another lock
+HEALTH_CHECKER_LOCK_ID: int = 404_002
+
+
+def check_server(api_url: str, timeout: float = HEALTH_CHECK_TIMEOUT) -> dict[str, any]:
+    """Call the management API of a server once, return {"healthy", "latency_ms", "error"}."""
+    try:
+        started_at = time.monotonic()
+        # not retried and sent also while the circuit breaker of the server is open, the result updates it
+        get_client(api_url).get_server(timeout=timeout, retries=0, check_circuit=False)
+        return {"healthy": True, "latency_ms": (time.monotonic() - started_at) * 1000, "error": None}
+
+    except OutlineAPIError as e:
+        return {"healthy": False, "latency_ms": None, "error": str(e)}
+
+
+def check_servers(servers: list[dict[str, any]],
+                  concurrency: int = HEALTH_CHECK_CONCURRENCY) -> list[dict[str, any]]:
+    """Check all `servers` concurrently, return {"server_id", "healthy", "latency_ms", "error"} in their order."""
+    if not servers:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(servers))) as executor:
+        results = executor.map(lambda server: check_server(server["api_url"]), servers)
+        return [{"server_id": server["id"], **result} for server, result in zip(servers, results)]
+
+
+def run_cycle() -> bool:
+    """Check every server once. Return False if another instance holds the lock."""
+    lock_manager = DatabaseManager()
+    try:
+        if not lock_manager.try_advisory_lock(HEALTH_CHECKER_LOCK_ID):
+            return False
+
+        try:
+            db_manager = DatabaseManager()
+            servers = db_manager.get_servers_to_check()
+            # Give the connection back to the pool while waiting for the Outline servers
+            db_manager.close()
+
+            checks = check_servers(servers)
+            for check in checks:
+                if not check["healthy"]:
+                    logger.warning("Server %s: health check failed: %s", check["server_id"], check["error"])
+
+            if checks:
+                try:
+                    for server in db_manager.record_health_checks(checks, HEALTH_CHECK_FAILURE_THRESHOLD,
+                                                                  HEALTH_CHECK_RECOVERY_THRESHOLD):
+                        if server["is_active"]:
+                            logger.info("Server %s: recovered, set active", server["id"])
+                        else:
+                            logger.warning("Server %s: unreachable, set inactive", server["id"])
+                finally:
+                    db_manager.close()
+
+            return True
+        finally:
+            lock_manager.advisory_unlock(HEALTH_CHECKER_LOCK_ID)
+    finally:
+        lock_manager.close()
+
+
+def run_forever(interval: float = HEALTH_CHECK_INTERVAL) -> None:
+    while True:
+        started_at = time.monotonic()
+        try:
+            if not run_cycle():
+                logger.debug("Another health checker is running, skipping round")
+        except Exception:
+            logger.exception("Health check round failed")
+
+        time.sleep(max(interval - (time.monotonic() - started_at), 0))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # suppress warning about self-signed certificate on an outline server
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    run_forever()
@@ -0,0 +1,171 @@
+import logging
+import os
+import statistics
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from database.database_manager import DatabaseManager
+from outline.client import get_client, OutlineAPIError
+from config import OUTLINE_PROVISIONING_CONCURRENCY, OUTLINE_KEYS_INSERT_BATCH_SIZE
+
+"""
+Creation of access keys on Outline servers.
+
+Keys are created concurrently, at most OUTLINE_PROVISIONING_CONCURRENCY at a time per Outline server, also when
+several requests provision the same server at once. All calls go through the server's OutlineClient, which keeps
+connections alive, retries and stops calling a failing server, see outline/client.py.
+"""
+
+logger = logging.getLogger(__name__)
+
+_server_slots: dict[str, threading.BoundedSemaphore] = {}
+_state_pid: int | None = None
+_state_lock = threading.Lock()
+
+
+def _server_slot(api_url: str) -> threading.BoundedSemaphore:
+    global _state_pid
+    with _state_lock:
+        if _state_pid != os.getpid():
+            _server_slots.clear()
+            _state_pid = os.getpid()
+
+        slot = _server_slots.get(api_url)
+        if slot is None:
+            slot = threading.BoundedSemaphore(OUTLINE_PROVISIONING_CONCURRENCY)
+            _server_slots[api_url] = slot
+        return slot
+
+
+def create_access_key(api_url: str, key_uuid: str) -> dict[str, any]:
+    """
+    Create one access key named `shadowtrail:<key_uuid>` on the Outline server.
+
+    Servers supporting it get the name with the creation call, older ones get it with a second call.
+    Return {"uuid", "id", "access_url", "latency_ms"} on success or {"uuid", "error"} if any of the calls failed,
+    latency_ms being the response time of the key creation call.
+    """
+    client = get_client(api_url)
+    name = f"shadowtrail:{key_uuid}"
+
+    with _server_slot(api_url):
+        try:
+            started_at = time.monotonic()
+            key_data: dict[str, any] = client.create_access_key(name if client.supports_named_keys() else None)
+            latency_ms = (time.monotonic() - started_at) * 1000
+            key_id: str = key_data['id']
+            access_url: str = key_data['accessUrl']
+
+            # Set the name for the key if the server did not take it with the creation call
+            if key_data.get('name') != name:
+                client.rename_access_key(key_id, name)
+
+            return {"uuid": key_uuid, "id": key_id, "access_url": access_url, "latency_ms": latency_ms}
+
+        except OutlineAPIError as e:
+            return {"uuid": key_uuid, "error": str(e)}
+
+
+def rename_access_key(api_url: str, key_id: str, key_uuid: str) -> str | None:
+    """Name an access key `shadowtrail:<key_uuid>`, return an error message or None on success."""
+    with _server_slot(api_url):
+        try:
+            get_client(api_url).rename_access_key(key_id, f"shadowtrail:{key_uuid}")
+            return None
+
+        except OutlineAPIError as e:
+            return str(e)
+
+
+def delete_access_key(api_url: str, key_id: str) -> str | None:
+    """Delete an access key from the Outline server, return an error message or None on success."""
+    with _server_slot(api_url):
+        try:
+            get_client(api_url).delete_access_key(key_id)
+            return None
+
+        except OutlineAPIError as e:
+            return str(e)
+
+
+def provision_keys(api_url: str, key_uuids: list[str],
+                   concurrency: int = OUTLINE_PROVISIONING_CONCURRENCY) -> Iterator[dict[str, any]]:
+    """
+    Create one access key per uuid concurrently.
+
+    Results are yielded in the order of `key_uuids` as soon as they are ready, so the caller can store the first
+    keys while the rest are still being created.
+    """
+    if not key_uuids:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(key_uuids))) as executor:
+        yield from executor.map(lambda key_uuid: create_access_key(api_url, key_uuid), key_uuids)
+
+
+def provision_and_store_keys(db_manager: DatabaseManager, server_id: int, api_url: str, number_of_keys: int,
+                             batch_size: int = OUTLINE_KEYS_INSERT_BATCH_SIZE) -> tuple[list[dict], list[dict]]:
+    """
+    Create `number_of_keys` keys on the Outline server and store them in the outline_key table.
+
+    Created keys are written in batches of `batch_size` rows, each batch with a single INSERT. If a batch cannot be
+    stored, all of its keys are reported as failed and the remaining batches are still written; such keys exist
+    on the Outline server only and are left for reconciliation. A key stored with a fresh uuid because its own was
+    taken meanwhile is renamed to it on the server.
+
+    Return (keys_created, keys_failed): lists of {"uuid"} and {"uuid", "error"}.
+    """
+    keys_created: list[dict[str, str]] = []
+    keys_failed: list[dict[str, str]] = []
+    batch: list[dict[str, any]] = []
+    latencies: list[float] = []
+
+    def flush() -> None:
+        try:
+            stored_uuids = db_manager.insert_keys(
+                [(key["uuid"], key["id"], server_id, key["access_url"], False) for key in batch])
+            keys_created.extend({"uuid": stored_uuid} for stored_uuid in stored_uuids)
+        except Exception as e:
+            keys_failed.extend({"uuid": key["uuid"], "error": f"Failed to save key in database: {e}"}
+                               for key in batch)
+            batch.clear()
+            return
+
+        # A key whose uuid was taken meanwhile is stored with a fresh one, its name on the server follows it
+        for key, stored_uuid in zip(batch, stored_uuids):
+            if stored_uuid != key["uuid"]:
+                error = rename_access_key(api_url, key["id"], stored_uuid)
+                if error is not None:
+                    logger.warning("Failed to rename key %s of server %s to its stored uuid %s: %s",
+                                   key["id"], server_id, stored_uuid, error)
+        batch.clear()
+
+    key_uuids: list[str] = [db_manager.generate_unique_uuid() for _ in range(number_of_keys)]
+    # the client learns the capabilities of the server from the version stored at registration
+    get_client(api_url, db_manager.get_server_api_version(server_id))
+
+    # Give the connection back to the pool while waiting for the Outline server, it is borrowed again on insert
+    db_manager.close()
+
+    for key in provision_keys(api_url, key_uuids):
+        if "error" in key:
+            keys_failed.append(key)
+            continue
+
+        latencies.append(key["latency_ms"])
+        batch.append(key)
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    # Observed API latency feeds the server selection weights, losing one observation is harmless
+    if latencies:
+        try:
+            db_manager.record_server_latency(server_id, statistics.median(latencies))
+        except Exception as e:
+            logger.warning("Failed to record latency of server %s: %s", server_id, e)
+
+    return keys_created, keys_failed
@@ -0,0 +1,209 @@
+import argparse
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import urllib3
+from database.database_manager import DatabaseManager
+from outline.client import get_client, OutlineAPIError
+from outline.provisioning import delete_access_key
+from config import (RECONCILER_INTERVAL, RECONCILER_REPAIR, RECONCILER_CONCURRENCY, RECONCILER_API_TIMEOUT,
+                    RECONCILER_MAX_REPAIR_FRACTION, OUTLINE_PROVISIONING_CONCURRENCY)
+
+"""
+Background reconciler of the access keys on the Outline servers and the outline_key table.
+
+Every RECONCILER_INTERVAL seconds the key list of every server is fetched, RECONCILER_CONCURRENCY servers at a time.
+The md5 of the Outline ids of the server's keys named `shadowtrail:<uuid>` is compared with the same digest computed
+by the database, so servers in sync cost one request and one single-row query. Only for the others the id sets are
+fetched and diffed:
+- orphaned keys are named `shadowtrail:<uuid>` on the server but not in outline_key, e.g. keys whose insert failed
+  after they were created or that could not be deleted when a server was trimmed. They take capacity of the server.
+- dead keys are in outline_key but not on the server, e.g. deleted by hand. They must not be handed out.
+Keys with other names are left alone, they were not created by this service.
+
+With RECONCILER_REPAIR=true, differences seen in two passes in a row are repaired in bulk: orphaned keys are deleted
+on the server, unused dead keys are deleted from outline_key. Requiring two passes keeps keys that are being created
+or trimmed during a pass from being taken for orphaned or dead. Dead keys in use are only reported, their dynamic
+keys have to be moved, see POST /servers/<server_id>/evacuate. Servers where more than RECONCILER_MAX_REPAIR_FRACTION
+of the keys differ are only reported as well, that much drift points to a misconfigured server rather than to leaks.
+
+Run it with `python -m outline.reconciler`, or `python -m outline.reconciler --once` to print one report without
+repairing anything. Several instances may run at once, a Postgres advisory lock makes sure only one of them works
+on a pass.
+"""
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock id of the reconciler, any constant that is not used by another lock
+RECONCILER_LOCK_ID: int = 404_003
+
+KEY_NAME_PREFIX: str = "shadowtrail:"
+
+# orphaned and dead key ids per server found by the previous pass of this process, see reconcile_server
+_previous_differences: dict[int, dict[str, set[int]]] = {}
+
+
+def key_ids_digest(key_ids: set[int]) -> str:
+    """md5 of the ids sorted numerically and joined by newlines, the same as DatabaseManager.get_outline_key_digest."""
+    return hashlib.md5("\n".join(str(key_id) for key_id in sorted(key_ids)).encode()).hexdigest()
+
+
+def exceeds_repair_limit(differences: int, total: int, max_fraction: float = RECONCILER_MAX_REPAIR_FRACTION) -> bool:
+    # small servers may always be repaired, a handful of keys is no sign of misconfiguration
+    return differences > max(max_fraction * total, 10)
+
+
+def reconcile_server(server: dict[str, any], repair: bool = RECONCILER_REPAIR) -> dict[str, any]:
+    """
+    Compare the keys of one server with outline_key and repair confirmed differences if `repair` is set.
+
+    Return {"server_id", "in_sync", "server_keys", "database_keys", "orphaned", "dead", "deleted_on_server",
+    "deleted_in_database", "dead_in_use"}; the lists hold Outline ids, dead_in_use holds {"uuid", "id"}.
+    """
+    server_id = server["id"]
+    report = {"server_id": server_id, "in_sync": True, "server_keys": 0, "database_keys": 0, "orphaned": [],
+              "dead": [], "deleted_on_server": [], "deleted_in_database": [], "dead_in_use": []}
+
+    server_keys = get_client(server["api_url"]).list_access_keys(timeout=RECONCILER_API_TIMEOUT)
+    all_ids = {int(key["id"]) for key in server_keys}
+    managed_ids = {int(key["id"]) for key in server_keys if (key.get("name") or "").startswith(KEY_NAME_PREFIX)}
+    report["server_keys"] = len(managed_ids)
+
+    db_manager = DatabaseManager()
+    try:
+        report["database_keys"], digest = db_manager.get_outline_key_digest(server_id)
+        if digest == key_ids_digest(managed_ids):
+            _previous_differences.pop(server_id, None)
+            return report
+
+        database_ids = db_manager.get_outline_key_ids(server_id)
+    finally:
+        db_manager.close()
+
+    orphaned = managed_ids - database_ids
+    # a key renamed on the server still exists, it is not dead
+    dead = database_ids - all_ids
+    report.update(in_sync=not orphaned and not dead, orphaned=sorted(orphaned), dead=sorted(dead))
+
+    previous = _previous_differences.get(server_id, {"orphaned": set(), "dead": set()})
+    _previous_differences[server_id] = {"orphaned": orphaned, "dead": dead}
+    if not repair:
+        return report
+
+    confirmed_orphaned = sorted(orphaned & previous["orphaned"])
+    confirmed_dead = sorted(dead & previous["dead"])
+
+    if exceeds_repair_limit(len(confirmed_orphaned), len(managed_ids)) or \
+            exceeds_repair_limit(len(confirmed_dead), report["database_keys"]):
+        logger.warning("Server %s: %s orphaned and %s dead keys are too many to be repaired automatically",
+                       server_id, len(confirmed_orphaned), len(confirmed_dead))
+        return report
+
+    if confirmed_dead:
+        db_manager = DatabaseManager()
+        try:
+            deleted, kept = db_manager.delete_dead_keys(server_id, confirmed_dead)
+        finally:
+            db_manager.close()
+        report["deleted_in_database"] = [key["id"] for key in deleted]
+        report["dead_in_use"] = kept
+
+    if confirmed_orphaned:
+        with ThreadPoolExecutor(max_workers=min(OUTLINE_PROVISIONING_CONCURRENCY, len(confirmed_orphaned))) as executor:
+            errors = list(executor.map(lambda key_id: delete_access_key(server["api_url"], str(key_id)),
+                                       confirmed_orphaned))
+        report["deleted_on_server"] = [key_id for key_id, error in zip(confirmed_orphaned, errors) if error is None]
+
+    # repaired keys are no differences any more, the next pass starts confirming them anew
+    _previous_differences[server_id] = {"orphaned": orphaned - set(report["deleted_on_server"]),
+                                        "dead": dead - set(report["deleted_in_database"])}
+    return report
+
+
+def reconcile(repair: bool = RECONCILER_REPAIR,
+              concurrency: int = RECONCILER_CONCURRENCY) -> list[dict[str, any]] | None:
+    """
+    Reconcile the servers the health checker polls once. Return their reports, None if another instance holds the
+    lock. Servers whose keys could not be listed are logged and left out.
+    """
+    lock_manager = DatabaseManager()
+    try:
+        if not lock_manager.try_advisory_lock(RECONCILER_LOCK_ID):
+            return None
+
+        try:
+            db_manager = DatabaseManager()
+            servers = db_manager.get_servers_to_check()
+            db_manager.close()
+
+            def reconcile_or_log(server: dict[str, any]) -> dict[str, any] | None:
+                try:
+                    return reconcile_server(server, repair)
+                except OutlineAPIError as e:
+                    logger.warning("Server %s: keys could not be listed: %s", server["id"], e)
+                except Exception:
+                    logger.exception("Server %s: reconciliation failed", server["id"])
+                return None
+
+            if not servers:
+                return []
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(servers))) as executor:
+                reports = [report for report in executor.map(reconcile_or_log, servers) if report is not None]
+
+            for report in reports:
+                log_report(report)
+            return reports
+        finally:
+            lock_manager.advisory_unlock(RECONCILER_LOCK_ID)
+    finally:
+        lock_manager.close()
+
+
+def log_report(report: dict[str, any]) -> None:
+    if report["in_sync"]:
+        logger.info("Server %s: %s keys in sync", report["server_id"], report["database_keys"])
+        return
+
+    logger.warning("Server %s: %s keys on the server, %s in the database, %s orphaned, %s dead",
+                   report["server_id"], report["server_keys"], report["database_keys"], len(report["orphaned"]),
+                   len(report["dead"]))
+    if report["deleted_on_server"] or report["deleted_in_database"]:
+        logger.info("Server %s: deleted %s orphaned keys on the server and %s dead keys in the database",
+                    report["server_id"], len(report["deleted_on_server"]), len(report["deleted_in_database"]))
+    for key in report["dead_in_use"]:
+        logger.warning("Server %s: key %s (Outline id %s) is in use but missing on the server",
+                       report["server_id"], key["uuid"], key["id"])
+
+
+def run_forever(interval: float = RECONCILER_INTERVAL) -> None:
+    while True:
+        started_at = time.monotonic()
+        try:
+            if reconcile() is None:
+                logger.debug("Another reconciler is running, skipping pass")
+        except Exception:
+            logger.exception("Reconciliation pass failed")
+
+        time.sleep(max(interval - (time.monotonic() - started_at), 0))
+
+
+def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
+    # the module text follows the imports, so it is not __doc__ and can't serve as the description
+    parser = argparse.ArgumentParser(
+        prog="python -m outline.reconciler",
+        description="Background reconciler of the access keys on the Outline servers and the outline_key table.")
+    parser.add_argument("--once", action="store_true", help="report the differences once without repairing them")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # suppress warning about self-signed certificate on an outline server
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    if arguments.once:
+        reconcile(repair=False)
+    else:
+        run_forever()
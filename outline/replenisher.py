@@ -0,0 +1,165 @@
+import logging
+import math
+import time
+import urllib3
+from database.database_manager import DatabaseManager
+from outline.provisioning import provision_and_store_keys, delete_access_key
+from config import (REPLENISHER_INTERVAL, REPLENISHER_WINDOW_HOURS, REPLENISHER_LEAD_TIME_HOURS,
+                    REPLENISHER_MIN_UNUSED_KEYS, REPLENISHER_MAX_UNUSED_KEYS, REPLENISHER_TRIM_FACTOR,
+                    REPLENISHER_MAX_KEYS_PER_CYCLE, REPLENISHER_COUNTER_CHECK_INTERVAL)
+
+"""
+Background scheduler that keeps enough unused outline keys on every active Outline server, so that
+POST /keys never has to wait for key creation.
+
+For each server the allocation rate over the last REPLENISHER_WINDOW_HOURS is used to forecast how many keys will
+be taken during the next REPLENISHER_LEAD_TIME_HOURS. That forecast, clamped to
+[REPLENISHER_MIN_UNUSED_KEYS, REPLENISHER_MAX_UNUSED_KEYS], is the low watermark: servers below it are topped up.
+Servers with more than REPLENISHER_TRIM_FACTOR times the low watermark are trimmed back to that high watermark.
+
+Every REPLENISHER_COUNTER_CHECK_INTERVAL seconds it also checks the trigger-maintained per-server key counters
+against the outline_key table and repairs drift.
+
+Run it with `python -m outline.replenisher`. Several instances may run at once, a Postgres advisory lock makes sure
+only one of them works on a cycle.
+"""
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock id of the replenisher, any constant that is not used by another lock
+REPLENISHER_LOCK_ID: int = 404_001
+
+# time.monotonic() of the last key counter check in this process
+_last_counter_check: float | None = None
+
+
+def plan_server(unused_keys: int, recent_allocations: int,
+                window_hours: float = REPLENISHER_WINDOW_HOURS,
+                lead_time_hours: float = REPLENISHER_LEAD_TIME_HOURS,
+                min_unused_keys: int = REPLENISHER_MIN_UNUSED_KEYS,
+                max_unused_keys: int = REPLENISHER_MAX_UNUSED_KEYS,
+                trim_factor: float = REPLENISHER_TRIM_FACTOR,
+                max_keys_per_cycle: int = REPLENISHER_MAX_KEYS_PER_CYCLE) -> dict[str, any]:
+    """
+    Decide how many keys to create or delete on one server.
+
+    Return {"allocation_rate", "hours_to_depletion", "low_watermark", "high_watermark", "create", "delete"};
+    allocation_rate is in keys per hour, hours_to_depletion is None when no keys are being allocated.
+    """
+    allocation_rate = recent_allocations / window_hours if window_hours > 0 else 0.0
+    hours_to_depletion = unused_keys / allocation_rate if allocation_rate > 0 else None
+
+    low_watermark = min(max(math.ceil(allocation_rate * lead_time_hours), min_unused_keys), max_unused_keys)
+    high_watermark = min(max(math.ceil(low_watermark * trim_factor), low_watermark), max_unused_keys)
+
+    create = delete = 0
+    if unused_keys < low_watermark:
+        create = min(low_watermark - unused_keys, max_keys_per_cycle)
+    elif unused_keys > high_watermark:
+        delete = min(unused_keys - high_watermark, max_keys_per_cycle)
+
+    return {
+        "allocation_rate": allocation_rate,
+        "hours_to_depletion": hours_to_depletion,
+        "low_watermark": low_watermark,
+        "high_watermark": high_watermark,
+        "create": create,
+        "delete": delete
+    }
+
+
+def trim_server(db_manager: DatabaseManager, server_id: int, api_url: str, count: int) -> tuple[int, int]:
+    """
+    Delete `count` unused keys of a server, return (deleted, failed).
+
+    Keys are removed from the database first so they can no longer be handed out; keys that then fail to be
+    deleted on the Outline server are only logged and left for reconciliation.
+    """
+    keys = db_manager.delete_unused_keys(server_id, count)
+    db_manager.close()
+
+    failed = 0
+    for key in keys:
+        error = delete_access_key(api_url, key["id"])
+        if error:
+            failed += 1
+            logger.warning("Server %s: key %s was removed from the database but not from the Outline server: %s",
+                           server_id, key["uuid"], error)
+
+    return len(keys), failed
+
+
+def check_key_counters(db_manager: DatabaseManager, interval: float = REPLENISHER_COUNTER_CHECK_INTERVAL) -> None:
+    """Repair drifted per-server key counters, at most once per `interval` seconds."""
+    global _last_counter_check
+
+    if interval <= 0 or (_last_counter_check is not None and time.monotonic() - _last_counter_check < interval):
+        return
+
+    for correction in db_manager.repair_server_key_counters():
+        logger.warning("Server %s: key counters drifted by %s unused and %s used keys, repaired",
+                       correction["server_id"], correction["unused_keys_drift"], correction["used_keys_drift"])
+    _last_counter_check = time.monotonic()
+
+
+def run_cycle() -> bool:
+    """Top up or trim every active server once. Return False if another instance holds the lock."""
+    lock_manager = DatabaseManager()
+    try:
+        if not lock_manager.try_advisory_lock(REPLENISHER_LOCK_ID):
+            return False
+
+        try:
+            db_manager = DatabaseManager()
+            check_key_counters(db_manager)
+            inventory = db_manager.get_key_inventory(REPLENISHER_WINDOW_HOURS)
+            db_manager.close()
+
+            for server in inventory:
+                plan = plan_server(server["unused_keys"], server["recent_allocations"])
+                logger.info("Server %s: %s unused keys, %.2f keys/hour, depletion in %s hours, watermarks %s-%s",
+                            server["id"], server["unused_keys"], plan["allocation_rate"],
+                            "n/a" if plan["hours_to_depletion"] is None else f"{plan['hours_to_depletion']:.1f}",
+                            plan["low_watermark"], plan["high_watermark"])
+
+                try:
+                    if plan["create"]:
+                        keys_created, keys_failed = provision_and_store_keys(
+                            db_manager, server["id"], server["api_url"], plan["create"])
+                        logger.info("Server %s: created %s keys, %s failed",
+                                    server["id"], len(keys_created), len(keys_failed))
+
+                    elif plan["delete"]:
+                        deleted, failed = trim_server(db_manager, server["id"], server["api_url"], plan["delete"])
+                        logger.info("Server %s: deleted %s keys, %s not removed from the Outline server",
+                                    server["id"], deleted, failed)
+
+                except Exception:
+                    logger.exception("Server %s: replenishment failed", server["id"])
+                finally:
+                    db_manager.close()
+
+            return True
+        finally:
+            lock_manager.advisory_unlock(REPLENISHER_LOCK_ID)
+    finally:
+        lock_manager.close()
+
+
+def run_forever(interval: float = REPLENISHER_INTERVAL) -> None:
+    while True:
+        started_at = time.monotonic()
+        try:
+            if not run_cycle():
+                logger.debug("Another replenisher is running, skipping cycle")
+        except Exception:
+            logger.exception("Replenisher cycle failed")
+
+        time.sleep(max(interval - (time.monotonic() - started_at), 0))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # suppress warning about self-signed certificate on an outline server
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    run_forever()
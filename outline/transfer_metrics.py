@@ -0,0 +1,115 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import urllib3
+from database.database_manager import DatabaseManager
+from outline.client import get_client, OutlineAPIError
+from config import (TRANSFER_METRICS_INTERVAL, TRANSFER_METRICS_CONCURRENCY, TRANSFER_METRICS_API_TIMEOUT,
+                    TRANSFER_SAMPLE_RETENTION_DAYS, TRANSFER_HOURLY_RETENTION_DAYS)
+
+"""
+Background collector of the data transferred by every key.
+
+Every TRANSFER_METRICS_INTERVAL seconds the transfer metrics (`GET {api_url}/metrics/transfer`) of every server are
+fetched, TRANSFER_METRICS_CONCURRENCY servers at a time. Outline reports the bytes of each key over the last 30 days,
+the last report of every server is kept in the transfer_last table and the growth since then is stored as one sample
+per key that transferred something. A report is a sliding window, so a sample is the transfer of the interval minus
+what left the window meanwhile, and a decrease counts as 0. The first report of a server only primes it.
+
+The reports of one round are streamed with COPY to the database, which stores the samples in the transfer_sample
+table, partitioned by day, and replaces the last reports in the same transaction. The samples are rolled up by the
+database into transfer_hourly and transfer_daily. Every round recomputes the current and the previous hour and day,
+so late samples are included. Sample partitions older than TRANSFER_SAMPLE_RETENTION_DAYS are dropped, hourly
+rollups older than TRANSFER_HOURLY_RETENTION_DAYS deleted.
+
+Run it with `python -m outline.transfer_metrics`. Several instances may run at once, a Postgres advisory lock makes
+sure only one of them works on a round, and as the last reports are in the database it makes no difference which one.
+"""
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock id of the transfer metrics collector, any constant that is not used by another lock
+TRANSFER_METRICS_LOCK_ID: int = 404_004
+
+
+def fetch_transfer(api_url: str, timeout: float = TRANSFER_METRICS_API_TIMEOUT) -> dict[int, int] | None:
+    """Return the bytes transferred by each Outline key id of a server in the last 30 days, None on failure."""
+    try:
+        transfer = get_client(api_url).get_transfer_metrics(timeout=timeout)
+        return {int(key_id): int(bytes_) for key_id, bytes_ in transfer.items()}
+
+    except OutlineAPIError as e:
+        logger.warning("%s: transfer metrics could not be fetched: %s", api_url, e)
+        return None
+
+
+def fetch_all_transfer(servers: list[dict[str, any]],
+                       concurrency: int = TRANSFER_METRICS_CONCURRENCY) -> list[dict[int, int] | None]:
+    """Fetch the transfer of all `servers` concurrently, return the results in their order."""
+    if not servers:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(servers))) as executor:
+        return list(executor.map(lambda server: fetch_transfer(server["api_url"]), servers))
+
+
+def run_cycle() -> bool:
+    """Sample every server once and update the rollups. Return False if another instance holds the lock."""
+    lock_manager = DatabaseManager()
+    try:
+        if not lock_manager.try_advisory_lock(TRANSFER_METRICS_LOCK_ID):
+            return False
+
+        try:
+            db_manager = DatabaseManager()
+            servers = db_manager.get_servers_to_check()
+            # Give the connection back to the pool while waiting for the Outline servers
+            db_manager.close()
+
+            sampled_at = datetime.now(timezone.utc)
+            # unreachable servers keep their last report, their next sample covers the gap
+            reports = {server["id"]: transfer for server, transfer in zip(servers, fetch_all_transfer(servers))
+                       if transfer is not None}
+
+            hour = sampled_at.replace(minute=0, second=0, microsecond=0)
+            day = hour.replace(hour=0)
+            try:
+                db_manager.create_transfer_sample_partitions(day.date(), (day + timedelta(days=1)).date())
+                if reports:
+                    stored = db_manager.store_transfer_reports(sampled_at, reports)
+                    logger.info("Stored %s transfer samples of %s servers", stored, len(reports))
+
+                db_manager.rollup_transfer(hour - timedelta(hours=1), day - timedelta(days=1))
+                # samples are kept at least for the rolled up days
+                for partition in db_manager.expire_transfer_metrics(
+                        (day - timedelta(days=max(TRANSFER_SAMPLE_RETENTION_DAYS, 2))).date(),
+                        hour - timedelta(days=TRANSFER_HOURLY_RETENTION_DAYS)):
+                    logger.info("Dropped expired transfer samples %s", partition)
+            finally:
+                db_manager.close()
+
+            return True
+        finally:
+            lock_manager.advisory_unlock(TRANSFER_METRICS_LOCK_ID)
+    finally:
+        lock_manager.close()
+
+
+def run_forever(interval: float = TRANSFER_METRICS_INTERVAL) -> None:
+    while True:
+        started_at = time.monotonic()
+        try:
+            if not run_cycle():
+                logger.debug("Another transfer metrics collector is running, skipping round")
+        except Exception:
+            logger.exception("Transfer metrics round failed")
+
+        time.sleep(max(interval - (time.monotonic() - started_at), 0))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # suppress warning about self-signed certificate on an outline server
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    run_forever()
@@ -2,14 +2,58 @@ import requests
 from requests.exceptions import RequestException
 from flask import Blueprint, jsonify, request, Response
 from database.database_manager import DatabaseManager
+from config import DYNAMIC_KEYS_BATCH_MAX_SIZE, DYNAMIC_KEYS_BATCH_CHUNK_SIZE
 from flask_cors import cross_origin
 # import urllib3
 # from urllib.parse import urlparse
 import uuid
-from config import auth
+from auth import auth
 
 dynamic_keys_bp = Blueprint('dynamic_keys', __name__)
 
+# Clients may keep the config but have to revalidate it on every connect, it is personal and changes on PUT/PATCH
+CLIENT_CONFIG_CACHE_CONTROL = "private, no-cache"
+
+
+# Error message and status code of every failed insert_dynamic_key / update_dynamic_key_with_new_outline_key status
+CREATE_ERRORS: dict[str, tuple[str, int]] = {
+    "outline_key_not_found": ("Outline key uuid not found", 404),
+    "no_unused_outline_keys": ("No unused outline keys found for provided server or location", 404),
+    "outline_key_in_use": ("Outline key is already used by another dynamic key", 409),
+    "dynamic_key_exists": ("Dynamic key with provided tg_user_id already exists in database", 409),
+}
+UPDATE_ERRORS: dict[str, tuple[str, int]] = {
+    "outline_key_not_found": ("Outline key uuid not found", 404),
+    "dynamic_key_not_found": ("Dynamic key not found", 404),
+}
+
+
+def dynamic_key_etag(key_id: int, version: int) -> str:
+    """Strong ETag of a dynamic key config, unquoted."""
+    return f"{key_id}-{version}"
+
+
+def validate_create_params(data: dict) -> str | None:
+    """Return the error of a POST /keys body, None if it is valid."""
+    # The outline key is either given explicitly or claimed from the unused keys of a server or a location
+    key_sources = [key for key in ("outline_key_uuid", "outline_server_id", "location") if key in data]
+    missing_keys = [] if "tg_user_id" in data else ["tg_user_id"]
+    if not key_sources:
+        missing_keys.append("outline_key_uuid, outline_server_id or location")
+    if missing_keys:
+        return f"Missing required parameters: {', '.join(missing_keys)}"
+
+    if "outline_key_uuid" in data and len(key_sources) > 1:
+        return "Parameter outline_key_uuid can't be combined with outline_server_id or location"
+
+    if "outline_server_id" in data and not is_integer(data["outline_server_id"], bits=32):
+        return "Invalid 'outline_server_id' parameter. It must be an integer."
+
+    if "location" in data and not isinstance(data["location"], str):
+        return "Invalid 'location' parameter. It must be a string."
+
+    return None
+
 
 @dynamic_keys_bp.route("/keys/<int:key_id>", methods=['GET'])
 @cross_origin()  # turn on CORS to make this endpoint available from Outline Client
@@ -21,11 +65,25 @@ def get_dynamic_key(key_id) -> tuple[Response, int]:
         return jsonify({"error": "Both key_id and tg_user_id are required"}), 400
 
     try:
-        key_details = db_manager.get_dynamic_key_details(key_id, tg_user_id)
-        if not key_details:
+        # Conditional request, the version lookup is cheaper than fetching the config
+        if request.if_none_match:
+            version = db_manager.get_dynamic_key_version(key_id, tg_user_id)
+            if version is not None and request.if_none_match.contains_weak(dynamic_key_etag(key_id, version)):
+                response = Response(status=304)
+                response.set_etag(dynamic_key_etag(key_id, version))
+                response.headers["Cache-Control"] = CLIENT_CONFIG_CACHE_CONTROL
+                return response, 304
+
+        result = db_manager.get_dynamic_key_client_config(key_id, tg_user_id)
+        if result is None:
             return jsonify({"error": "Key not found or inactive"}), 404
 
-        return jsonify(key_details), 200
+        # Pre-serialized JSON, sent as is
+        version, client_config = result
+        response = Response(client_config, mimetype="application/json")
+        response.set_etag(dynamic_key_etag(key_id, version))
+        response.headers["Cache-Control"] = CLIENT_CONFIG_CACHE_CONTROL
+        return response, 200
 
     except Exception as e:
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
@@ -42,35 +100,22 @@ def create_dynamic_key() -> tuple[Response, int]:
 
     try:
         data = request.get_json()
-        required_keys = {"tg_user_id", "outline_key_uuid"}
-        missing_keys = [key for key in required_keys if key not in data]
-        if missing_keys:
-            return jsonify({"error": f"Missing required parameters: {', '.join(missing_keys)}"}), 400
-
-        tg_user_id, outline_key_uuid = data.get("tg_user_id"), data.get("outline_key_uuid")
-        if not db_manager.check_outline_key_exists(outline_key_uuid):
-            return jsonify({"error": "Outline key uuid not found"}), 404
-
-        # Check if dynamic key already exists for the user
-        if db_manager.check_dynamic_key_exists_for_user(tg_user_id):
-            return jsonify(
-                {"error": "Dynamic key with provided tg_user_id already exists in database"}), 409
-
-        unique_id = db_manager.generate_unique_dynamic_key_id()
-        access_url = db_manager.get_access_url_by_outline_key(outline_key_uuid)
-        key_details = db_manager.parse_access_url(access_url)
-
-        # Insert data into dynamic_key table
-        db_manager.insert_dynamic_key(
-            unique_id,
-            tg_user_id,
-            key_details["server"],
-            key_details["server_port"],
-            key_details["password"],
-            key_details["method"],
-            True,
-            outline_key_uuid
-        )
+        error = validate_create_params(data)
+        if error:
+            return jsonify({"error": error}), 400
+
+        tg_user_id = data.get("tg_user_id")
+
+        # Checks, insert into dynamic_key table and outline_key update are done by a single statement
+        if "outline_key_uuid" in data:
+            status, unique_id = db_manager.insert_dynamic_key(tg_user_id, data["outline_key_uuid"])
+        else:
+            status, unique_id = db_manager.insert_dynamic_key(
+                tg_user_id, server_id=data.get("outline_server_id"), location=data.get("location"))
+
+        if status in CREATE_ERRORS:
+            error, status_code = CREATE_ERRORS[status]
+            return jsonify({"error": error}), status_code
 
         return jsonify({"id": unique_id}), 201
 
@@ -89,12 +134,9 @@ def patch_dynamic_key(key_id) -> tuple[Response, int]:
     db_manager = DatabaseManager()
 
     try:
-        # Check if dynamic key exists
-        if not db_manager.check_dynamic_key_exists_by_id(key_id):
-            return jsonify({"error": "Dynamic key not found"}), 404
-
         # Update the dynamic key and the associated outline key
-        db_manager.deactivate_dynamic_key_and_outline_key(key_id)
+        if not db_manager.deactivate_dynamic_key_and_outline_key(key_id):
+            return jsonify({"error": "Dynamic key not found"}), 404
 
         return jsonify({"message": "Dynamic key and associated outline key updated successfully"}), 200
 
@@ -115,18 +157,13 @@ def modify_dynamic_key(key_id) -> tuple[Response, int]:
             return jsonify({"error": "Missing required parameter: 'outline_key_uuid'"}), 400
 
         outline_key_uuid = data["outline_key_uuid"]
-        if not db_manager.check_outline_key_exists(outline_key_uuid):
-            return jsonify({"error": "Outline key uuid not found"}), 404
 
-        if not db_manager.check_dynamic_key_exists_by_id(key_id):
-            return jsonify({"error": "Dynamic key not found"}), 404
+        # Update the dynamic key with details of the new outline key and swap the outline keys in one statement
+        status = db_manager.update_dynamic_key_with_new_outline_key(key_id, outline_key_uuid)
 
-        # Extract details from access_url for the new outline key
-        access_url = db_manager.get_access_url_by_outline_key(outline_key_uuid)
-        key_details = db_manager.parse_access_url(access_url)
-
-        # Update the dynamic key and associated outline key
-        db_manager.update_dynamic_key_with_new_outline_key(key_id, outline_key_uuid, key_details)
+        if status in UPDATE_ERRORS:
+            error, status_code = UPDATE_ERRORS[status]
+            return jsonify({"error": error}), status_code
 
         return jsonify({"message": "Dynamic key and associated outline key updated successfully"}), 200
 
@@ -136,3 +173,227 @@ def modify_dynamic_key(key_id) -> tuple[Response, int]:
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
     finally:
         db_manager.close()
+
+
+def read_batch(data: dict | None, parameter: str) -> tuple[list, str | None]:
+    """Return the list of batch operations in `parameter` of a request body and the error of the body, if any."""
+    if not isinstance(data, dict) or parameter not in data:
+        return [], f"Missing required parameter: '{parameter}'"
+
+    operations = data[parameter]
+    if not isinstance(operations, list) or not operations:
+        return [], f"Invalid '{parameter}' parameter. It must be a non-empty list."
+
+    if len(operations) > DYNAMIC_KEYS_BATCH_MAX_SIZE:
+        return [], f"Too many operations in '{parameter}', at most {DYNAMIC_KEYS_BATCH_MAX_SIZE} are allowed"
+
+    return operations, None
+
+
+def is_uuid(value: any) -> bool:
+    try:
+        uuid.UUID(value)
+        return True
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def is_integer(value: any, bits: int = 64) -> bool:
+    """Return whether `value` is an integer that fits a signed column of `bits`, BIGINT by default."""
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** (bits - 1) <= value < 2 ** (bits - 1)
+
+
+def fail_chunk(results: list[dict[str, any] | None], chunk: dict[int, dict[str, any]], error: Exception) -> None:
+    """
+    Report the operations of a chunk that could not be applied, `chunk` maps their positions to the fields that
+    identify them in the results. The chunks before stay applied, the ones after are still tried.
+    """
+    for position, identifier in chunk.items():
+        results[position] = {**identifier, "status": 500, "error": "An unexpected error occurred",
+                             "details": str(error)}
+
+
+def batch_response(results: list[dict[str, any]], success_status: int) -> tuple[Response, int]:
+    """Per-operation results in request order, 207 Multi-Status when some of the operations failed."""
+    total_failed = sum(1 for result in results if "error" in result)
+    response_data = {
+        "total_success": len(results) - total_failed,
+        "total_failed": total_failed,
+        "results": results
+    }
+    return jsonify(response_data), success_status if not total_failed else 207
+
+
+@dynamic_keys_bp.route("/keys/batch", methods=['POST'])
+@auth.login_required
+def create_dynamic_keys() -> tuple[Response, int]:
+
+    db_manager = DatabaseManager()
+
+    try:
+        keys, error = read_batch(request.get_json(silent=True), "keys")
+        if error:
+            return jsonify({"error": error}), 400
+
+        # Invalid operations fail on their own, the valid ones are applied
+        results: list[dict[str, any] | None] = [None] * len(keys)
+        valid: list[int] = []
+        tg_user_ids: set[int] = set()
+        outline_key_uuids: set[str] = set()
+        for position, key in enumerate(keys):
+            error = validate_create_params(key) if isinstance(key, dict) else "Each key must be an object"
+            if error is None and not is_integer(key["tg_user_id"]):
+                error = "Invalid 'tg_user_id' parameter. It must be an integer."
+            elif error is None and "outline_key_uuid" in key and not is_uuid(key["outline_key_uuid"]):
+                error = "Invalid 'outline_key_uuid' parameter. It must be an outline key uuid."
+            elif error is None and key["tg_user_id"] in tg_user_ids:
+                error = "Duplicate tg_user_id in the batch"
+            elif error is None and "outline_key_uuid" in key and \
+                    str(uuid.UUID(key["outline_key_uuid"])) in outline_key_uuids:
+                error = "Duplicate outline_key_uuid in the batch"
+
+            if error:
+                results[position] = {"tg_user_id": key.get("tg_user_id") if isinstance(key, dict) else None,
+                                     "status": 400, "error": error}
+                continue
+
+            tg_user_ids.add(key["tg_user_id"])
+            if "outline_key_uuid" in key:
+                outline_key_uuids.add(str(uuid.UUID(key["outline_key_uuid"])))
+            valid.append(position)
+
+        # Every chunk is created by a few set-based statements in its own transaction
+        for start in range(0, len(valid), DYNAMIC_KEYS_BATCH_CHUNK_SIZE):
+            chunk = valid[start:start + DYNAMIC_KEYS_BATCH_CHUNK_SIZE]
+            try:
+                statuses = db_manager.insert_dynamic_keys([
+                    {"tg_user_id": keys[i]["tg_user_id"], "outline_key_uuid": keys[i].get("outline_key_uuid"),
+                     "server_id": keys[i].get("outline_server_id"), "location": keys[i].get("location")}
+                    for i in chunk
+                ])
+            except Exception as e:
+                fail_chunk(results, {i: {"tg_user_id": keys[i]["tg_user_id"]} for i in chunk}, e)
+                continue
+
+            for position, (status, unique_id) in zip(chunk, statuses):
+                tg_user_id = keys[position]["tg_user_id"]
+                if status in CREATE_ERRORS:
+                    error, status_code = CREATE_ERRORS[status]
+                    results[position] = {"tg_user_id": tg_user_id, "status": status_code, "error": error}
+                else:
+                    results[position] = {"tg_user_id": tg_user_id, "status": 201, "id": unique_id}
+
+        return batch_response(results, 201)
+
+    except Exception as e:
+        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    finally:
+        db_manager.close()
+
+
+@dynamic_keys_bp.route("/keys/batch", methods=['PATCH'])
+@auth.login_required
+def patch_dynamic_keys() -> tuple[Response, int]:
+
+    db_manager = DatabaseManager()
+
+    try:
+        key_ids, error = read_batch(request.get_json(silent=True), "ids")
+        if error:
+            return jsonify({"error": error}), 400
+
+        results: list[dict[str, any] | None] = [None] * len(key_ids)
+        valid: list[int] = []
+        for position, key_id in enumerate(key_ids):
+            if is_integer(key_id):
+                valid.append(position)
+            else:
+                results[position] = {"id": key_id, "status": 400,
+                                     "error": "Invalid dynamic key id. It must be an integer."}
+
+        # Every chunk is deactivated by one statement
+        for start in range(0, len(valid), DYNAMIC_KEYS_BATCH_CHUNK_SIZE):
+            chunk = valid[start:start + DYNAMIC_KEYS_BATCH_CHUNK_SIZE]
+            try:
+                found = db_manager.deactivate_dynamic_keys([key_ids[i] for i in chunk])
+            except Exception as e:
+                fail_chunk(results, {i: {"id": key_ids[i]} for i in chunk}, e)
+                continue
+
+            for position, key_found in zip(chunk, found):
+                if key_found:
+                    results[position] = {"id": key_ids[position], "status": 200}
+                else:
+                    results[position] = {"id": key_ids[position], "status": 404, "error": "Dynamic key not found"}
+
+        return batch_response(results, 200)
+
+    except Exception as e:
+        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    finally:
+        db_manager.close()
+
+
+@dynamic_keys_bp.route("/keys/batch", methods=['PUT'])
+@auth.login_required
+def modify_dynamic_keys() -> tuple[Response, int]:
+
+    db_manager = DatabaseManager()
+
+    try:
+        keys, error = read_batch(request.get_json(silent=True), "keys")
+        if error:
+            return jsonify({"error": error}), 400
+
+        results: list[dict[str, any] | None] = [None] * len(keys)
+        valid: list[int] = []
+        key_ids: set[int] = set()
+        outline_key_uuids: set[str] = set()
+        for position, key in enumerate(keys):
+            error = None
+            if not isinstance(key, dict):
+                error = "Each key must be an object"
+            elif "id" not in key or "outline_key_uuid" not in key:
+                error = "Missing required parameters: id, outline_key_uuid"
+            elif not is_integer(key["id"]):
+                error = "Invalid dynamic key id. It must be an integer."
+            elif not is_uuid(key["outline_key_uuid"]):
+                error = "Invalid 'outline_key_uuid' parameter. It must be an outline key uuid."
+            elif key["id"] in key_ids:
+                error = "Duplicate id in the batch"
+            elif str(uuid.UUID(key["outline_key_uuid"])) in outline_key_uuids:
+                error = "Duplicate outline_key_uuid in the batch"
+
+            if error:
+                results[position] = {"id": key.get("id") if isinstance(key, dict) else None,
+                                     "status": 400, "error": error}
+                continue
+
+            key_ids.add(key["id"])
+            outline_key_uuids.add(str(uuid.UUID(key["outline_key_uuid"])))
+            valid.append(position)
+
+        # Every chunk is moved to the new outline keys by one statement
+        for start in range(0, len(valid), DYNAMIC_KEYS_BATCH_CHUNK_SIZE):
+            chunk = valid[start:start + DYNAMIC_KEYS_BATCH_CHUNK_SIZE]
+            try:
+                statuses = db_manager.update_dynamic_keys_with_new_outline_keys(
+                    [(keys[i]["id"], keys[i]["outline_key_uuid"]) for i in chunk])
+            except Exception as e:
+                fail_chunk(results, {i: {"id": keys[i]["id"]} for i in chunk}, e)
+                continue
+
+            for position, status in zip(chunk, statuses):
+                key_id = keys[position]["id"]
+                if status in UPDATE_ERRORS:
+                    error, status_code = UPDATE_ERRORS[status]
+                    results[position] = {"id": key_id, "status": status_code, "error": error}
+                else:
+                    results[position] = {"id": key_id, "status": 200}
+
+        return batch_response(results, 200)
+
+    except Exception as e:
+        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    finally:
+        db_manager.close()
@@ -1,7 +1,7 @@
 from flask import Blueprint, jsonify, request, Response, current_app
 from database.database_manager import DatabaseManager
 # from app import auth
-from config import auth
+from auth import auth
 
 locations_bp = Blueprint('locations', __name__)
 
@@ -27,5 +27,6 @@ def get_locations() -> tuple[Response, int]:
         return jsonify({"total_count": total_count, "locations": locations}), 200
 
     except Exception as e:
-        db_manager.close()
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    finally:
+        db_manager.close()
@@ -0,0 +1,12 @@
+from flask import Blueprint, Response
+from metrics import generate_metrics
+from auth import auth
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+@metrics_bp.route("/metrics", methods=['GET'])
+@auth.login_required
+def get_metrics() -> Response:
+    body, content_type = generate_metrics()
+    return Response(body, status=200, content_type=content_type)
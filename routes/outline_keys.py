@@ -1,11 +1,12 @@
-import requests
-from requests.exceptions import RequestException
-from flask import Blueprint, jsonify, request, Response
+from collections.abc import Iterator
+from flask import Blueprint, jsonify, request, Response, current_app, stream_with_context, url_for
 from database.database_manager import DatabaseManager
+from outline.provisioning import provision_and_store_keys
+from config import OUTLINE_KEYS_INSERT_BATCH_SIZE
 import urllib3
 # from urllib.parse import urlparse
 import uuid
-from config import auth
+from auth import auth
 
 outline_keys_bp = Blueprint('outline_keys', __name__)
 
@@ -15,11 +16,10 @@ outline_keys_bp = Blueprint('outline_keys', __name__)
 def get_outline_keys(outline_server_id: int) -> tuple[Response, int]:
 
     db_manager: DatabaseManager = DatabaseManager()
+    # A streamed response closes the database manager itself once the last key is sent
+    streaming: bool = False
 
     try:
-        if not db_manager.check_server_exists_using_id(outline_server_id):
-            return jsonify({"error": "Server not found"}), 404
-
         # Validate 'currently_used' parameter
         currently_used_query = request.args.get('currently_used')
         currently_used: bool | None = None
@@ -38,13 +38,58 @@ def get_outline_keys(outline_server_id: int) -> tuple[Response, int]:
             else:
                 return jsonify({"error": "Invalid 'limit' parameter. It must be a positive integer."}), 400
 
-        keys: list[dict[str, any]] = db_manager.get_outline_keys(outline_server_id, currently_used, limit)
+        # Validate 'after' parameter, the uuid of the last key of the previous page
+        after: str | None = request.args.get('after')
+        if after is not None:
+            try:
+                after = str(uuid.UUID(after))
+            except ValueError:
+                return jsonify({"error": "Invalid 'after' parameter. It must be an outline key uuid."}), 400
+
+        # Validate 'stream' parameter
+        stream_query = request.args.get('stream', 'false')
+        if stream_query.lower() not in ['true', 'false']:
+            return jsonify({"error": "Invalid 'stream' parameter. It must be 'true' or 'false'."}), 400
+
+        if not db_manager.check_server_exists_using_id(outline_server_id):
+            return jsonify({"error": "Server not found"}), 404
+
+        if stream_query.lower() == 'true':
+            streaming = True
+            keys_iterator = db_manager.iter_outline_keys(outline_server_id, currently_used, limit, after)
+            return Response(stream_with_context(stream_outline_keys(db_manager, keys_iterator)),
+                            mimetype="application/json"), 200
+
+        keys: list[dict[str, any]] = db_manager.get_outline_keys(outline_server_id, currently_used, limit, after)
         total_keys_count = len(keys)
 
-        return jsonify({"total_count": total_keys_count, "keys": keys}), 200
+        response = jsonify({"total_count": total_keys_count, "keys": keys})
+        # A full page may be followed by another one
+        if limit is not None and total_keys_count == limit:
+            next_args = {**request.args.to_dict(), "after": keys[-1]["uuid"]}
+            response.headers["Link"] = f'<{url_for(request.endpoint, **request.view_args, **next_args)}>; rel="next"'
+
+        return response, 200
 
     except Exception as e:
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    finally:
+        if not streaming:
+            db_manager.close()
+
+
+def stream_outline_keys(db_manager: DatabaseManager, keys: Iterator[dict[str, any]]) -> Iterator[str]:
+    """
+    Yield the same JSON document as the non-streamed response key by key. The status is already sent when a
+    database error happens mid-stream, the response is cut off instead, which leaves the document invalid.
+    """
+    try:
+        total_keys_count = 0
+        yield '{"keys":['
+        for key in keys:
+            yield ("," if total_keys_count else "") + current_app.json.dumps(key, separators=(",", ":"))
+            total_keys_count += 1
+        yield f'],"total_count":{total_keys_count}}}\n'
     finally:
         db_manager.close()
 
@@ -56,8 +101,6 @@ def create_outline_keys() -> tuple[Response, int]:
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     db_manager: DatabaseManager = DatabaseManager()
-    keys_created: list[dict[str, uuid.uuid4]] = []
-    keys_failed: list[dict[str, str]] = []
 
     try:
         data: dict = request.get_json()
@@ -93,43 +136,11 @@ def create_outline_keys() -> tuple[Response, int]:
 
         api_url: str = db_manager.get_server_api_url(server_id)
 
-        # Key creation logic
-        for _ in range(number_of_keys):
-            unique_uuid: uuid.uuid4 = db_manager.generate_unique_uuid()
-            try:
-
-                # Specify the timeout duration (e.g., 3 seconds)
-                timeout_duration = 2
-
-                post_response: requests.Response = requests.post(
-                    f"{api_url}/access-keys",
-                    verify=False,
-                    timeout=timeout_duration
-                )
-
-                post_response.raise_for_status()
-                key_data = post_response.json()
-                key_id: str = key_data['id']
-                access_url: str = key_data['accessUrl']
-
-                # Set the name for the key
-                put_response: requests.Response = requests.put(
-                    f"{api_url}/access-keys/{key_id}/name",
-                    json={"name": f"shadowtrail:{unique_uuid}"},
-                    verify=False
-                )
-                put_response.raise_for_status()
-
-                # Insert key data into database
-                db_manager.insert_key(unique_uuid, key_id, server_id, access_url, False)
-                keys_created.append({"uuid": unique_uuid})
-
-            except requests.exceptions.Timeout:
-                # Handle the timeout case
-                keys_failed.append({"uuid": unique_uuid, "error": "Request timed out"})
-
-            except RequestException as e:
-                keys_failed.append({"uuid": unique_uuid, "error": str(e)})
+        # Key creation logic: keys are created on the Outline server concurrently and stored in batches
+        keys_created: list[dict[str, uuid.uuid4]]
+        keys_failed: list[dict[str, str]]
+        keys_created, keys_failed = provision_and_store_keys(db_manager, server_id, api_url, number_of_keys,
+                                                             batch_size=OUTLINE_KEYS_INSERT_BATCH_SIZE)
 
         db_manager.close()
 
@@ -1,10 +1,9 @@
-import requests
-from requests.exceptions import RequestException
 from flask import Blueprint, jsonify, request, Response
 from database.database_manager import DatabaseManager
+from outline.client import probe_server, OutlineAPIError
 import urllib3
 from urllib.parse import urlparse
-from config import auth
+from auth import auth
 
 servers_bp = Blueprint('servers', __name__)
 
@@ -62,22 +61,17 @@ def create_outline_server() -> tuple[Response, int]:
         if parsed_url.scheme not in ['http', 'https']:
             return jsonify({"error": "Invalid URL scheme"}), 422
 
-        # if requests package throws error, return 500 error with error details
         try:
-            response: requests.Response = requests.get(f"{api_url}/server", verify=False)
-        except RequestException as e:
-            # This will catch any RequestException, which includes exceptions like ConnectionError,
-            # HTTPError, Timeout, TooManyRedirects which are raised for failed requests.
-            # Return a 500 error for these unexpected issues.
+            response_data: dict = probe_server(api_url)
+        except OutlineAPIError as e:
+            # if the server answers with an error, return 404 error
+            if e.status_code is not None:
+                return jsonify({"error": "Server was found but unexpected error occurred"}), 404
+            # connection errors and timeouts are unexpected issues, return 500 error with error details
             return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
 
-        # if we get anything except 200 response, return 404 error
-        if response.status_code != 200:
-            return jsonify({"error": "Server was found but unexpected error occurred"}), 404
-
         # main logic
         db_manager: DatabaseManager = DatabaseManager()
-        response_data: dict = response.json()
 
         # Check if a server with the provided api_url already exists
         if db_manager.check_server_exists_using_api_url(api_url):
@@ -87,14 +81,13 @@ def create_outline_server() -> tuple[Response, int]:
         # try to insert data into database, if everything ok - return 201 response code and row identifier in database
         # if some error occurred - return 500 and error details
         try:
-
-            db_manager: DatabaseManager = DatabaseManager()
             outline_server_id: int = db_manager.create_outline_server(
                 hostname=response_data.get("hostnameForAccessKeys"),
                 port=response_data.get("portForNewAccessKeys"),
                 api_url=data.get('api_url'),
                 location_name=data.get('location'),
-                provider_id=data.get('provider_id')
+                provider_id=data.get('provider_id'),
+                api_version=response_data.get("version")
             )
 
         except Exception as e:
@@ -103,7 +96,44 @@ def create_outline_server() -> tuple[Response, int]:
 
         db_manager.close()  # Ensure the database connection is closed
 
+        # registered by a concurrent request since the check above
+        if outline_server_id is None:
+            return jsonify({"error": "Server with provided api_url already exists in database"}), 409
+
         return jsonify({"id": outline_server_id}), 201
 
     except Exception as e:
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+
+
+@servers_bp.route("/servers/<int:server_id>/evacuate", methods=['POST'])
+@auth.login_required
+def evacuate_outline_server(server_id: int) -> tuple[Response, int]:
+
+    db_manager: DatabaseManager = DatabaseManager()
+
+    try:
+        data: dict = request.get_json(silent=True) or {}
+
+        # validate 'drain' parameter, the server is deactivated unless it is false
+        drain: any = data.get("drain", True)
+        if not isinstance(drain, bool):
+            return jsonify({"error": "Invalid 'drain' parameter. It must be a boolean."}), 400
+
+        # validate 'limit' parameter, the max number of dynamic keys moved by this call
+        limit: any = data.get("limit")
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+            return jsonify({"error": "Invalid 'limit' parameter. It must be a positive integer."}), 400
+
+        if not db_manager.check_server_exists_using_id(server_id):
+            return jsonify({"error": "Server not found"}), 404
+
+        # Dynamic keys are moved to spare keys of the other active servers of the location by one statement
+        result: dict[str, int] = db_manager.evacuate_server(server_id, drain, limit)
+
+        return jsonify({"server_id": server_id, **result}), 200
+
+    except Exception as e:
+        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
+    finally:
+        db_manager.close()
@@ -1,6 +1,6 @@
 from flask_swagger_ui import get_swaggerui_blueprint
 from flask import Blueprint, redirect, url_for
-from config import auth
+from auth import auth
 
 
 API_URL: str = '/static/api.yml'
@@ -0,0 +1,27 @@
+from flask import Blueprint, jsonify, request, Response
+from auth import basic_auth, issue_token
+from config import AUTH_TOKEN_SECRET
+
+tokens_bp = Blueprint('tokens', __name__)
+
+
+@tokens_bp.route("/auth/token", methods=['POST'])
+@basic_auth.login_required  # tokens can only be issued with the admin password, not with another token
+def create_token() -> tuple[Response, int]:
+
+    if not AUTH_TOKEN_SECRET:
+        return jsonify({"error": "Token authentication is not configured"}), 501
+
+    try:
+        data: dict = request.get_json(silent=True) or {}
+        subject: any = data.get("subject", "bot")
+
+        if not isinstance(subject, str) or not subject or ":" in subject:
+            return jsonify({"error": "Invalid subject. It must be a non-empty string without ':'"}), 400
+
+        token, expires_at = issue_token(subject)
+
+        return jsonify({"token": token, "expires_at": expires_at}), 201
+
+    except Exception as e:
+        return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
@@ -0,0 +1,82 @@
+import pytest
+from unittest.mock import patch
+from app import app
+import base64
+import auth
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+
+
+@pytest.fixture
+def auth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # Encode credentials
+        credentials = base64.b64encode(f"{BASIC_AUTH_USERNAME}:{BASIC_AUTH_PASSWORD}".encode()).decode('utf-8')
+        # Set the Authorization header for all requests
+        test_client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+        yield test_client
+
+
+@pytest.fixture
+def unauth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # No Authorization header
+        yield test_client
+
+
+def test_post_auth_token_error_unauthorized_access(unauth_client):
+    response = unauth_client.post("/auth/token")
+    assert response.status_code == 401
+
+
+@patch('routes.tokens.AUTH_TOKEN_SECRET', None)
+def test_post_auth_token_error_not_configured(auth_client):
+    response = auth_client.post("/auth/token")
+    assert response.status_code == 501
+
+
+@patch('auth.AUTH_TOKEN_SECRET', "test-secret")
+@patch('routes.tokens.AUTH_TOKEN_SECRET', "test-secret")
+@patch('routes.locations.DatabaseManager')
+def test_post_auth_token_success_token_is_accepted(mock_db_manager, auth_client, unauth_client):
+    mock_db_manager.return_value.get_locations.return_value = []
+
+    response = auth_client.post("/auth/token", json={"subject": "bot"})
+    assert response.status_code == 201
+    token = response.json["token"]
+
+    response = unauth_client.get("/locations", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+
+@patch('auth.AUTH_TOKEN_SECRET', "test-secret")
+def test_post_auth_token_error_tampered_or_expired_token(unauth_client):
+    token, _ = auth.issue_token("bot")
+    expired_token, _ = auth.issue_token("bot", ttl=-1)
+    forged_token, _ = auth.issue_token("bot", secret="another-secret")
+
+    for bad_token in [token + "x", expired_token, forged_token, "not-a-token"]:
+        response = unauth_client.get("/locations", headers={"Authorization": f"Bearer {bad_token}"})
+        assert response.status_code == 401
+
+
+@patch('routes.locations.DatabaseManager')
+def test_basic_auth_password_is_hashed_once_per_ttl(mock_db_manager, auth_client):
+    mock_db_manager.return_value.get_locations.return_value = []
+    auth.verified_credentials.clear()
+
+    with patch('auth.check_password_hash', wraps=auth.check_password_hash) as mock_check:
+        assert auth_client.get("/locations").status_code == 200
+        assert auth_client.get("/locations").status_code == 200
+
+    assert mock_check.call_count == 1
+
+
+def test_basic_auth_verified_credentials_cache_is_bounded():
+    cache = auth.VerifiedCredentialsCache(ttl=60, max_size=2)
+    for password in ["a", "b", "c"]:
+        cache.add("user", password)
+
+    assert not cache.contains("user", "a")
+    assert cache.contains("user", "b") and cache.contains("user", "c")
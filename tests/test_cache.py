@@ -0,0 +1,136 @@
+import asyncio
+import pytest
+from unittest.mock import patch, MagicMock
+from database.cache import LocalCache, RedisCache, create_cache, dynamic_key_cache_key, TOMBSTONE
+from database.database_manager import DatabaseManager
+from database.async_database_manager import AsyncDatabaseManager
+
+
+@pytest.fixture
+def cache():
+    local_cache = LocalCache()
+    with patch('database.database_manager.get_cache', return_value=local_cache):
+        yield local_cache
+
+
+@pytest.fixture
+def db_manager():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    return db_manager
+
+
+def test_local_cache_expires_entries():
+    local_cache = LocalCache()
+    local_cache.set("a", b"1", ttl=60)
+    local_cache.set("b", b"2", ttl=-1)
+
+    assert local_cache.get("a") == b"1"
+    assert local_cache.get("b") is None
+
+
+def test_local_cache_add_keeps_live_entries():
+    local_cache = LocalCache()
+
+    assert local_cache.add("a", b"1", ttl=60) is True
+    assert local_cache.add("a", b"2", ttl=60) is False
+    local_cache.set_many(["a", "b"], b"-", ttl=-1)
+    # expired entries are replaced
+    assert local_cache.add("a", b"3", ttl=60) is True
+    assert local_cache.get("a") == b"3"
+
+
+def test_create_cache_selects_backend():
+    assert create_cache("") is None
+    assert isinstance(create_cache("local://"), LocalCache)
+    assert isinstance(create_cache("redis://localhost:6379/0"), RedisCache)
+    with pytest.raises(ValueError):
+        create_cache("memcached://localhost")
+
+
+def test_redis_cache_outage_is_a_miss():
+    redis_cache = RedisCache("redis://127.0.0.1:1/0")
+
+    assert redis_cache.get("a") is None
+    redis_cache.set("a", b"1", ttl=60)
+    redis_cache.delete("a")
+    assert asyncio.run(redis_cache.aget("a")) is None
+    asyncio.run(redis_cache.aset("a", b"1", ttl=60))
+    assert redis_cache.add("a", b"1", ttl=60) is False
+    redis_cache.set_many(["a", "b"], b"-", ttl=10)
+    assert asyncio.run(redis_cache.aadd("a", b"1", ttl=60)) is False
+
+
+def test_get_dynamic_key_client_config_is_served_from_cache(cache, db_manager):
+    db_manager.cursor.fetchone.return_value = (2, memoryview(b'{"server":"example.com"}\n'))
+
+    first = db_manager.get_dynamic_key_client_config(1, 123)
+    second = db_manager.get_dynamic_key_client_config(1, 123)
+
+    assert first == second == (2, b'{"server":"example.com"}\n')
+    assert db_manager.get_dynamic_key_version(1, 123) == 2
+    assert db_manager.cursor.execute.call_count == 1
+
+
+def test_async_get_dynamic_key_client_config_shares_cache_entries(cache, db_manager):
+    db_manager.cursor.fetchone.return_value = (2, memoryview(b'{"server":"example.com"}\n'))
+    client_config = db_manager.get_dynamic_key_client_config(1, 123)
+
+    with patch('database.async_database_manager.get_cache', return_value=cache):
+        # served from the entry written by DatabaseManager, the pool is never opened
+        assert asyncio.run(AsyncDatabaseManager().get_dynamic_key_client_config(1, 123)) == client_config
+        assert asyncio.run(AsyncDatabaseManager().get_dynamic_key_version(1, 123)) == 2
+
+
+def test_get_dynamic_key_client_config_does_not_cache_missing_key(cache, db_manager):
+    db_manager.cursor.fetchone.return_value = None
+
+    assert db_manager.get_dynamic_key_client_config(1, 123) is None
+    assert cache.get(dynamic_key_cache_key(1, 123)) is None
+
+
+def test_deactivate_dynamic_key_invalidates_cache(cache, db_manager):
+    cache.set(dynamic_key_cache_key(1, 123), b"{}", ttl=60)
+    db_manager.cursor.fetchone.return_value = (123,)
+
+    assert db_manager.deactivate_dynamic_key_and_outline_key(1)
+
+    assert cache.get(dynamic_key_cache_key(1, 123)) == TOMBSTONE
+
+
+def test_update_dynamic_key_invalidates_cache(cache, db_manager):
+    cache.set(dynamic_key_cache_key(1, 123), b"{}", ttl=60)
+    db_manager.cursor.fetchone.return_value = (True, True, 123)
+
+    assert db_manager.update_dynamic_key_with_new_outline_key(1, "uuid2") == "updated"
+
+    assert cache.get(dynamic_key_cache_key(1, 123)) == TOMBSTONE
+
+
+def test_change_committed_during_lookup_is_not_overwritten_by_stale_row(cache, db_manager):
+    def read_row_then_commit_change():
+        # the lookup has read the row, a deactivation commits and invalidates before the lookup caches it
+        DatabaseManager.invalidate_dynamic_key(1, 123)
+        return 2, memoryview(b'{"server":"old.example.com"}\n')
+
+    db_manager.cursor.fetchone.side_effect = read_row_then_commit_change
+    assert db_manager.get_dynamic_key_client_config(1, 123) == (2, b'{"server":"old.example.com"}\n')
+
+    assert cache.get(dynamic_key_cache_key(1, 123)) == TOMBSTONE
+    db_manager.cursor.fetchone.side_effect = None
+    db_manager.cursor.fetchone.return_value = None
+    assert db_manager.get_dynamic_key_client_config(1, 123) is None
+
+
+def test_async_lookup_does_not_overwrite_tombstone(cache):
+    DatabaseManager.invalidate_dynamic_key(1, 123)
+    async_db_manager = AsyncDatabaseManager()
+    row = {"version": 2, "client_config": b'{"server":"old.example.com"}\n'}
+
+    with patch('database.async_database_manager.get_cache', return_value=cache), \
+            patch.object(async_db_manager, "_fetchrow", return_value=row) as fetchrow:
+        assert asyncio.run(async_db_manager.get_dynamic_key_client_config(1, 123)) == (2, row["client_config"])
+        assert asyncio.run(async_db_manager.get_dynamic_key_version(1, 123)) == 2
+
+    assert cache.get(dynamic_key_cache_key(1, 123)) == TOMBSTONE
+    assert fetchrow.call_count == 2
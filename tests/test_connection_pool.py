@@ -0,0 +1,86 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from psycopg2 import extensions
+from database import connection_pool
+from database.connection_pool import ConnectionPool, PoolTimeoutError
+
+
+def make_connection(transaction_status=extensions.TRANSACTION_STATUS_IDLE):
+    conn = MagicMock()
+    conn.closed = 0
+    conn.info.transaction_status = transaction_status
+    return conn
+
+
+@pytest.fixture
+def pool():
+    return ConnectionPool(max_size=2, timeout=0.05, ping_interval=30, credentials={})
+
+
+@patch('database.connection_pool.psycopg2.connect')
+def test_connection_pool_reuses_returned_connection(mock_connect, pool):
+    mock_connect.return_value = make_connection()
+
+    first = pool.getconn()
+    pool.putconn(first)
+    second = pool.getconn()
+
+    assert first is second
+    assert mock_connect.call_count == 1
+    assert second.autocommit is True
+
+
+@patch('database.connection_pool.psycopg2.connect')
+def test_connection_pool_times_out_when_exhausted(mock_connect, pool):
+    mock_connect.side_effect = [make_connection(), make_connection()]
+
+    pool.getconn()
+    pool.getconn()
+
+    with pytest.raises(PoolTimeoutError):
+        pool.getconn()
+
+
+@patch('database.connection_pool.psycopg2.connect')
+def test_connection_pool_rolls_back_unfinished_transaction(mock_connect, pool):
+    conn = make_connection(extensions.TRANSACTION_STATUS_INTRANS)
+    mock_connect.return_value = conn
+
+    pool.putconn(pool.getconn())
+
+    conn.rollback.assert_called_once()
+    assert pool.getconn() is conn
+
+
+@patch('database.connection_pool.psycopg2.connect')
+def test_connection_pool_replaces_broken_connection(mock_connect, pool):
+    broken, fresh = make_connection(), make_connection()
+    mock_connect.side_effect = [broken, fresh]
+
+    pool.putconn(pool.getconn())
+    broken.closed = 1  # e.g. the server restarted while the connection was idle
+
+    assert pool.getconn() is fresh
+    assert mock_connect.call_count == 2
+
+
+@patch('database.connection_pool.psycopg2.connect')
+def test_connection_pool_pings_long_idle_connection(mock_connect):
+    pool = ConnectionPool(max_size=1, timeout=0.05, ping_interval=0, credentials={})
+    conn = make_connection()
+    mock_connect.return_value = conn
+
+    pool.putconn(pool.getconn())
+    pool.getconn()
+
+    conn.cursor.return_value.__enter__.return_value.execute.assert_called_once_with("SELECT 1;")
+
+
+@patch('database.connection_pool.os.getpid')
+def test_get_pool_creates_new_pool_after_fork(mock_getpid):
+    mock_getpid.return_value = 1
+    parent_pool = connection_pool.get_pool()
+    assert connection_pool.get_pool() is parent_pool
+
+    mock_getpid.return_value = 2
+    assert connection_pool.get_pool() is not parent_pool
@@ -0,0 +1,88 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from app import app
+from database.database_manager import DatabaseManager
+import base64
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+
+
+@pytest.fixture
+def auth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # Encode credentials
+        credentials = base64.b64encode(f"{BASIC_AUTH_USERNAME}:{BASIC_AUTH_PASSWORD}".encode()).decode('utf-8')
+        # Set the Authorization header for all requests
+        test_client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+        yield test_client
+
+
+@pytest.fixture
+def unauth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # No Authorization header
+        yield test_client
+
+
+def test_patch_dynamic_keys_batch_error_unauthorized_access(unauth_client):
+    response = unauth_client.patch("/keys/batch", json={"ids": [100000001]})
+    assert response.status_code == 401
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_patch_dynamic_keys_batch_success(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.deactivate_dynamic_keys.return_value = [True, True]
+
+    response = auth_client.patch("/keys/batch", json={"ids": [100000001, 100000002]})
+
+    assert response.status_code == 200
+    assert response.json == {"total_success": 2, "total_failed": 0,
+                             "results": [{"id": 100000001, "status": 200}, {"id": 100000002, "status": 200}]}
+    mock_db_instance.deactivate_dynamic_keys.assert_called_once_with([100000001, 100000002])
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_patch_dynamic_keys_batch_partial_failure(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.deactivate_dynamic_keys.return_value = [True, False]
+
+    response = auth_client.patch("/keys/batch", json={"ids": [100000001, "100000002", 100000003]})
+
+    assert response.status_code == 207
+    assert response.json["results"] == [
+        {"id": 100000001, "status": 200},
+        {"id": "100000002", "status": 400, "error": "Invalid dynamic key id. It must be an integer."},
+        {"id": 100000003, "status": 404, "error": "Dynamic key not found"},
+    ]
+    mock_db_instance.deactivate_dynamic_keys.assert_called_once_with([100000001, 100000003])
+
+
+def test_patch_dynamic_keys_batch_error_missing_ids(auth_client):
+    response = auth_client.patch("/keys/batch", json={})
+    assert response.status_code == 400
+    assert response.json == {"error": "Missing required parameter: 'ids'"}
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_patch_dynamic_keys_batch_failed_chunk_fails_its_keys(mock_db_manager, auth_client):
+    mock_db_manager.return_value.deactivate_dynamic_keys.side_effect = Exception("Internal error")
+
+    response = auth_client.patch("/keys/batch", json={"ids": [100000001, 2 ** 63]})
+    assert response.status_code == 207
+    assert response.json["results"] == [
+        {"id": 100000001, "status": 500, "error": "An unexpected error occurred", "details": "Internal error"},
+        {"id": 2 ** 63, "status": 400, "error": "Invalid dynamic key id. It must be an integer."},
+    ]
+
+
+def test_deactivate_dynamic_keys_invalidates_cache():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    db_manager.cursor.fetchall.return_value = [(100000002, 7)]
+
+    with patch.object(DatabaseManager, "invalidate_dynamic_keys") as invalidate:
+        assert db_manager.deactivate_dynamic_keys([100000001, 100000002]) == [False, True]
+
+    invalidate.assert_called_once_with([(100000002, 7)])
@@ -0,0 +1,191 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from app import app
+from database.database_manager import DatabaseManager
+import base64
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+
+
+@pytest.fixture
+def auth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # Encode credentials
+        credentials = base64.b64encode(f"{BASIC_AUTH_USERNAME}:{BASIC_AUTH_PASSWORD}".encode()).decode('utf-8')
+        # Set the Authorization header for all requests
+        test_client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+        yield test_client
+
+
+@pytest.fixture
+def unauth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # No Authorization header
+        yield test_client
+
+
+def test_post_dynamic_keys_batch_error_unauthorized_access(unauth_client):
+    response = unauth_client.post("/keys/batch", json={"keys": [{"tg_user_id": 1, "location": "Austria"}]})
+    assert response.status_code == 401
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_batch_success(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_keys.return_value = [("created", 100000001), ("created", 100000002)]
+
+    response = auth_client.post("/keys/batch", json={"keys": [
+        {"tg_user_id": 1, "outline_key_uuid": "08e97dff-0751-40bf-ac8a-45551a7415d6"},
+        {"tg_user_id": 2, "outline_server_id": 3, "location": "Austria"},
+    ]})
+
+    assert response.status_code == 201
+    assert response.json == {
+        "total_success": 2,
+        "total_failed": 0,
+        "results": [{"tg_user_id": 1, "status": 201, "id": 100000001},
+                    {"tg_user_id": 2, "status": 201, "id": 100000002}]
+    }
+    mock_db_instance.insert_dynamic_keys.assert_called_once_with([
+        {"tg_user_id": 1, "outline_key_uuid": "08e97dff-0751-40bf-ac8a-45551a7415d6", "server_id": None,
+         "location": None},
+        {"tg_user_id": 2, "outline_key_uuid": None, "server_id": 3, "location": "Austria"},
+    ])
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_batch_partial_failure(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_keys.return_value = [("created", 100000001), ("dynamic_key_exists", None),
+                                                         ("no_unused_outline_keys", None)]
+
+    response = auth_client.post("/keys/batch", json={"keys": [
+        {"tg_user_id": 1, "location": "Austria"},
+        {"tg_user_id": 2, "location": "Austria"},
+        {"tg_user_id": 1, "location": "Austria"},
+        {"tg_user_id": 3, "location": "Austria"},
+        {"tg_user_id": 4, "outline_key_uuid": "invalid"},
+        {"tg_user_id": 5},
+    ]})
+
+    assert response.status_code == 207
+    assert response.json["total_success"] == 1
+    assert response.json["total_failed"] == 5
+    assert response.json["results"] == [
+        {"tg_user_id": 1, "status": 201, "id": 100000001},
+        {"tg_user_id": 2, "status": 409, "error": "Dynamic key with provided tg_user_id already exists in database"},
+        {"tg_user_id": 1, "status": 400, "error": "Duplicate tg_user_id in the batch"},
+        {"tg_user_id": 3, "status": 404, "error": "No unused outline keys found for provided server or location"},
+        {"tg_user_id": 4, "status": 400,
+         "error": "Invalid 'outline_key_uuid' parameter. It must be an outline key uuid."},
+        {"tg_user_id": 5, "status": 400,
+         "error": "Missing required parameters: outline_key_uuid, outline_server_id or location"},
+    ]
+    # Only valid keys reach the database
+    assert len(mock_db_instance.insert_dynamic_keys.call_args[0][0]) == 3
+
+
+@patch('routes.dynamic_keys.DYNAMIC_KEYS_BATCH_CHUNK_SIZE', 2)
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_batch_is_chunked(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_keys.side_effect = lambda keys: [("created", key["tg_user_id"]) for key in keys]
+
+    response = auth_client.post("/keys/batch", json={"keys": [{"tg_user_id": i, "location": "Austria"}
+                                                              for i in range(5)]})
+
+    assert response.status_code == 201
+    assert [result["id"] for result in response.json["results"]] == [0, 1, 2, 3, 4]
+    assert [len(call[0][0]) for call in mock_db_instance.insert_dynamic_keys.call_args_list] == [2, 2, 1]
+
+
+@pytest.mark.parametrize("data, error", [
+    ({}, "Missing required parameter: 'keys'"),
+    ({"keys": []}, "Invalid 'keys' parameter. It must be a non-empty list."),
+    ({"keys": {"tg_user_id": 1}}, "Invalid 'keys' parameter. It must be a non-empty list."),
+])
+def test_post_dynamic_keys_batch_error_invalid_body(auth_client, data, error):
+    response = auth_client.post("/keys/batch", json=data)
+    assert response.status_code == 400
+    assert response.json == {"error": error}
+
+
+@patch('routes.dynamic_keys.DYNAMIC_KEYS_BATCH_MAX_SIZE', 2)
+def test_post_dynamic_keys_batch_error_too_many_keys(auth_client):
+    response = auth_client.post("/keys/batch", json={"keys": [{"tg_user_id": i, "location": "Austria"}
+                                                              for i in range(3)]})
+    assert response.status_code == 400
+    assert response.json == {"error": "Too many operations in 'keys', at most 2 are allowed"}
+
+
+@patch('routes.dynamic_keys.DYNAMIC_KEYS_BATCH_CHUNK_SIZE', 2)
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_batch_failed_chunk_fails_its_keys_only(mock_db_manager, auth_client):
+    mock_db_manager.return_value.insert_dynamic_keys.side_effect = [
+        [("created", 100000001), ("created", 100000002)], Exception("Internal error"), [("created", 100000005)]]
+
+    response = auth_client.post("/keys/batch", json={"keys": [{"tg_user_id": i, "location": "Austria"}
+                                                              for i in range(1, 6)]})
+
+    assert response.status_code == 207
+    assert response.json["results"] == [
+        {"tg_user_id": 1, "status": 201, "id": 100000001},
+        {"tg_user_id": 2, "status": 201, "id": 100000002},
+        {"tg_user_id": 3, "status": 500, "error": "An unexpected error occurred", "details": "Internal error"},
+        {"tg_user_id": 4, "status": 500, "error": "An unexpected error occurred", "details": "Internal error"},
+        {"tg_user_id": 5, "status": 201, "id": 100000005},
+    ]
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_batch_malformed_keys_fail_on_their_own(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_keys.side_effect = lambda keys: [("created", 100000001) for _ in keys]
+
+    response = auth_client.post("/keys/batch", json={"keys": [
+        {"tg_user_id": 1, "location": ["Austria"]},
+        {"tg_user_id": 2 ** 63, "location": "Austria"},
+        {"tg_user_id": 3, "outline_server_id": 2 ** 31},
+        {"tg_user_id": 4, "outline_server_id": True},
+        {"tg_user_id": 5, "location": "Austria"},
+    ]})
+
+    assert response.status_code == 207
+    assert [(result["status"], result.get("error")) for result in response.json["results"]] == [
+        (400, "Invalid 'location' parameter. It must be a string."),
+        (400, "Invalid 'tg_user_id' parameter. It must be an integer."),
+        (400, "Invalid 'outline_server_id' parameter. It must be an integer."),
+        (400, "Invalid 'outline_server_id' parameter. It must be an integer."),
+        (201, None),
+    ]
+    assert mock_db_instance.insert_dynamic_keys.call_args[0][0] == [
+        {"tg_user_id": 5, "outline_key_uuid": None, "server_id": None, "location": "Austria"}]
+
+
+@patch('database.database_manager.get_server_selector')
+def test_insert_dynamic_keys_groups_and_retries_taken_ids(mock_get_server_selector):
+    # no load scores, keys given by location are claimed from any server of it
+    mock_get_server_selector.return_value.pick.return_value = None
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # rows are (position, dynamic_key_exists, outline_key_used, id)
+    db_manager.cursor.fetchall.side_effect = [
+        [(1, False, False, 100000001)],
+        [(0, False, False, None), (2, True, None, None)],
+        [(0, False, False, 100000002)],
+    ]
+
+    results = db_manager.insert_dynamic_keys([
+        {"tg_user_id": 1, "location": "Austria"},
+        {"tg_user_id": 2, "outline_key_uuid": "08e97dff-0751-40bf-ac8a-45551a7415d6"},
+        {"tg_user_id": 3, "location": "Austria"},
+    ])
+
+    assert results == [("created", 100000002), ("created", 100000001), ("dynamic_key_exists", None)]
+    params = [call[0][1] for call in db_manager.cursor.execute.call_args_list]
+    # explicit outline keys first, then one statement per server/location pair, retried for the taken id only
+    assert [p["positions"] for p in params] == [[1], [0, 2], [0]]
+    assert params[1]["location"] == "Austria"
+    db_manager.conn.commit.assert_called_once()
+    assert db_manager.conn.autocommit is True
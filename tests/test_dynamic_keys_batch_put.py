@@ -0,0 +1,98 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from app import app
+from database.database_manager import DatabaseManager
+import base64
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+
+UUID_1 = "08e97dff-0751-40bf-ac8a-45551a7415d6"
+UUID_2 = "5cb6f2ac-8fe1-4844-bd0c-c41acedc310d"
+
+
+@pytest.fixture
+def auth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # Encode credentials
+        credentials = base64.b64encode(f"{BASIC_AUTH_USERNAME}:{BASIC_AUTH_PASSWORD}".encode()).decode('utf-8')
+        # Set the Authorization header for all requests
+        test_client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+        yield test_client
+
+
+@pytest.fixture
+def unauth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # No Authorization header
+        yield test_client
+
+
+def test_put_dynamic_keys_batch_error_unauthorized_access(unauth_client):
+    response = unauth_client.put("/keys/batch", json={"keys": [{"id": 100000001, "outline_key_uuid": UUID_1}]})
+    assert response.status_code == 401
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_put_dynamic_keys_batch_success(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.update_dynamic_keys_with_new_outline_keys.return_value = ["updated", "updated"]
+
+    # the two dynamic keys swap their outline keys
+    response = auth_client.put("/keys/batch", json={"keys": [{"id": 100000001, "outline_key_uuid": UUID_1},
+                                                             {"id": 100000002, "outline_key_uuid": UUID_2}]})
+
+    assert response.status_code == 200
+    assert response.json == {"total_success": 2, "total_failed": 0,
+                             "results": [{"id": 100000001, "status": 200}, {"id": 100000002, "status": 200}]}
+    mock_db_instance.update_dynamic_keys_with_new_outline_keys.assert_called_once_with(
+        [(100000001, UUID_1), (100000002, UUID_2)])
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_put_dynamic_keys_batch_partial_failure(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.update_dynamic_keys_with_new_outline_keys.return_value = ["outline_key_not_found",
+                                                                               "dynamic_key_not_found"]
+
+    response = auth_client.put("/keys/batch", json={"keys": [
+        {"id": 100000001, "outline_key_uuid": UUID_1},
+        {"id": 100000002, "outline_key_uuid": UUID_1},
+        {"id": 100000001, "outline_key_uuid": UUID_2},
+        {"id": 100000003},
+        {"id": 100000004, "outline_key_uuid": UUID_2},
+    ]})
+
+    assert response.status_code == 207
+    assert response.json["results"] == [
+        {"id": 100000001, "status": 404, "error": "Outline key uuid not found"},
+        {"id": 100000002, "status": 400, "error": "Duplicate outline_key_uuid in the batch"},
+        {"id": 100000001, "status": 400, "error": "Duplicate id in the batch"},
+        {"id": 100000003, "status": 400, "error": "Missing required parameters: id, outline_key_uuid"},
+        {"id": 100000004, "status": 404, "error": "Dynamic key not found"},
+    ]
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_put_dynamic_keys_batch_failed_chunk_fails_its_keys(mock_db_manager, auth_client):
+    mock_db_manager.return_value.update_dynamic_keys_with_new_outline_keys.side_effect = Exception("Internal error")
+
+    response = auth_client.put("/keys/batch", json={"keys": [{"id": 100000001, "outline_key_uuid": UUID_1}]})
+    assert response.status_code == 207
+    assert response.json["results"] == [
+        {"id": 100000001, "status": 500, "error": "An unexpected error occurred", "details": "Internal error"}]
+
+
+def test_update_dynamic_keys_with_new_outline_keys_statuses():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # rows are (id, outline_key_found, dynamic_key_found, tg_user_id), not in request order
+    db_manager.cursor.fetchall.return_value = [(100000002, True, False, None), (100000001, True, True, 7),
+                                               (100000003, False, True, None)]
+
+    with patch.object(DatabaseManager, "invalidate_dynamic_keys") as invalidate:
+        statuses = db_manager.update_dynamic_keys_with_new_outline_keys(
+            [(100000001, UUID_1), (100000002, UUID_2), (100000003, "00000000-0000-0000-0000-000000000000")])
+
+    assert statuses == ["updated", "dynamic_key_not_found", "outline_key_not_found"]
+    invalidate.assert_called_once_with([(100000001, 7)])
@@ -1,8 +1,15 @@
+import os
+import psycopg2
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from flask import jsonify
 from app import app
 import base64
-from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD, POSTGRES_CREDENTIALS
+from database.cache import LocalCache
+from database.database_manager import DatabaseManager
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "database", "migrations")
 
 
 @pytest.fixture
@@ -27,25 +34,25 @@ def unauth_client():
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_get_dynamic_key_success(mock_db_manager, unauth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.get_dynamic_key_details.return_value = {
-        "server": "example.com",
-        "server_port": 1234,
-        "password": "password",
-        "method": "method"
-    }
+    mock_db_instance.get_dynamic_key_client_config.return_value = (
+        3, b'{"method":"method","password":"password","server":"example.com","server_port":1234}\n'
+    )
 
     key_id = 1
     tg_user_id = 123
     response = unauth_client.get(f"/keys/{key_id}?tg_user_id={tg_user_id}")
 
     assert response.status_code == 200
+    assert response.content_type == "application/json"
+    assert response.headers["ETag"] == '"1-3"'
+    assert response.headers["Cache-Control"] == "private, no-cache"
     assert response.json == {
         "server": "example.com",
         "server_port": 1234,
         "password": "password",
         "method": "method"
     }
-    mock_db_instance.get_dynamic_key_details.assert_called_with(key_id, tg_user_id)
+    mock_db_instance.get_dynamic_key_client_config.assert_called_with(key_id, tg_user_id)
 
 
 def test_get_dynamic_key_error_missing_params(unauth_client):
@@ -59,7 +66,7 @@ def test_get_dynamic_key_error_missing_params(unauth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_get_dynamic_key_error_not_found(mock_db_manager, unauth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.get_dynamic_key_details.return_value = None
+    mock_db_instance.get_dynamic_key_client_config.return_value = None
 
     key_id = 1
     tg_user_id = 123
@@ -67,13 +74,13 @@ def test_get_dynamic_key_error_not_found(mock_db_manager, unauth_client):
 
     assert response.status_code == 404
     assert "error" in response.json
-    mock_db_instance.get_dynamic_key_details.assert_called_with(key_id, tg_user_id)
+    mock_db_instance.get_dynamic_key_client_config.assert_called_with(key_id, tg_user_id)
 
 
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_get_dynamic_key_error_internal_error(mock_db_manager, unauth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.get_dynamic_key_details.side_effect = Exception("Internal error")
+    mock_db_instance.get_dynamic_key_client_config.side_effect = Exception("Internal error")
 
     key_id = 1
     tg_user_id = 123
@@ -81,4 +88,99 @@ def test_get_dynamic_key_error_internal_error(mock_db_manager, unauth_client):
 
     assert response.status_code == 500
     assert "error" in response.json
-    mock_db_instance.get_dynamic_key_details.assert_called_with(key_id, tg_user_id)
+    mock_db_instance.get_dynamic_key_client_config.assert_called_with(key_id, tg_user_id)
+
+
+@pytest.mark.parametrize("if_none_match", ['"1-3"', 'W/"1-3"', '"1-2", "1-3"', '*'])
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_get_dynamic_key_not_modified(mock_db_manager, unauth_client, if_none_match):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.get_dynamic_key_version.return_value = 3
+
+    response = unauth_client.get("/keys/1?tg_user_id=123", headers={"If-None-Match": if_none_match})
+
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == '"1-3"'
+    mock_db_instance.get_dynamic_key_version.assert_called_with(1, 123)
+    mock_db_instance.get_dynamic_key_client_config.assert_not_called()
+
+
+@pytest.mark.parametrize("version", [4, None])
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_get_dynamic_key_modified_since_etag(mock_db_manager, unauth_client, version):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.get_dynamic_key_version.return_value = version
+    mock_db_instance.get_dynamic_key_client_config.return_value = (4, b'{"server":"example.com"}\n')
+
+    response = unauth_client.get("/keys/1?tg_user_id=123", headers={"If-None-Match": '"1-3"'})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"1-4"'
+
+
+def test_get_dynamic_key_not_modified_is_not_answered_from_stale_cache_entry(unauth_client):
+    cursor = MagicMock()
+
+    class CursorDatabaseManager(DatabaseManager):
+        def __init__(self) -> None:
+            super().__init__()
+            self._conn, self._cursor = MagicMock(), cursor
+
+        def close(self) -> None:
+            pass
+
+    def read_row_then_commit_change():
+        # version 4 of the key commits and invalidates after the lookup read version 3, before it caches it
+        DatabaseManager.invalidate_dynamic_key(1, 123)
+        return 3, memoryview(b'{"server":"old.example.com"}\n')
+
+    with patch('routes.dynamic_keys.DatabaseManager', CursorDatabaseManager), \
+            patch('database.database_manager.get_cache', return_value=LocalCache()):
+        cursor.fetchone.side_effect = read_row_then_commit_change
+        assert unauth_client.get("/keys/1?tg_user_id=123").headers["ETag"] == '"1-3"'
+
+        cursor.fetchone.side_effect = [(4,), (4, memoryview(b'{"server":"new.example.com"}\n'))]
+        response = unauth_client.get("/keys/1?tg_user_id=123", headers={"If-None-Match": '"1-3"'})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"1-4"'
+    assert response.data == b'{"server":"new.example.com"}\n'
+
+
+@pytest.fixture
+def client_config_schema_cursor():
+    # dynamic_key with the client config of migration 004 in a schema of its own, on a real database
+    try:
+        conn = psycopg2.connect(**POSTGRES_CREDENTIALS)
+    except psycopg2.OperationalError:
+        pytest.skip("no database available")
+    conn.autocommit = True
+    with conn.cursor() as cursor, open(os.path.join(MIGRATIONS, "004_dynamic_key_client_config.sql")) as f:
+        cursor.execute("DROP SCHEMA IF EXISTS client_config_test CASCADE; CREATE SCHEMA client_config_test; "
+                       "SET search_path TO client_config_test;")
+        cursor.execute("CREATE TABLE dynamic_key (id BIGINT, server VARCHAR, server_port INTEGER, password VARCHAR, "
+                       "method VARCHAR, version INTEGER NOT NULL DEFAULT 1);")
+        cursor.execute(f.read())
+        yield cursor
+        cursor.execute("DROP SCHEMA client_config_test CASCADE;")
+    conn.close()
+
+
+def test_client_config_escapes_non_ascii_like_jsonify(client_config_schema_cursor):
+    cursor = client_config_schema_cursor
+    keys = [(1, "example.com", 1234, 'pass"word\\', "chacha20-ietf-poly1305"),
+            (2, "пример.рф", 443, "pässwörd ✓ 😀 \x01", "aes-256-gcm")]
+    cursor.executemany("INSERT INTO dynamic_key (id, server, server_port, password, method) "
+                       "VALUES (%s, %s, %s, %s, %s);", keys)
+
+    with open(os.path.join(MIGRATIONS, "013_dynamic_key_client_config_ascii.sql")) as f:
+        cursor.execute(f.read())
+
+    cursor.execute("SELECT client_config, version FROM dynamic_key ORDER BY id;")
+    with app.app_context():
+        expected = [jsonify({"server": server, "server_port": server_port, "password": password,
+                             "method": method}).get_data() for _, server, server_port, password, method in keys]
+    assert [(bytes(client_config), version) for client_config, version in cursor.fetchall()] == [
+        (expected[0], 1), (expected[1], 2)]
+    assert b"\\ud83d\\ude00" in expected[1]
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import patch, AsyncMock
+from app import app
+import asgi
+
+CLIENT_CONFIG = b'{"method":"method","password":"password","server":"example.com","server_port":1234}\n'
+
+
+def asgi_request(method, path, query_string=b"", headers=()):
+    scope = {"type": "http", "method": method, "path": path, "raw_path": path.encode(), "root_path": "",
+             "query_string": query_string, "headers": list(headers), "scheme": "http", "http_version": "1.1",
+             "server": ("testserver", 80), "client": ("127.0.0.1", 1234)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    start = next(message for message in messages if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return start["status"], dict(start["headers"]), body
+
+
+@pytest.fixture
+def mock_get_details():
+    with patch.object(asgi.db_manager, "get_dynamic_key_client_config", new_callable=AsyncMock) as mock:
+        yield mock
+
+
+@pytest.fixture
+def mock_get_version():
+    with patch.object(asgi.db_manager, "get_dynamic_key_version", new_callable=AsyncMock) as mock:
+        yield mock
+
+
+@pytest.mark.parametrize("client_config, status", [((3, CLIENT_CONFIG), 200), (None, 404)])
+@pytest.mark.parametrize("headers", [(), ((b"origin", b"https://example.com"),)])
+def test_get_dynamic_key_asgi_matches_flask_response(mock_get_details, client_config, status, headers):
+    mock_get_details.return_value = client_config
+
+    asgi_status, asgi_headers, asgi_body = asgi_request("GET", "/keys/1", b"tg_user_id=123", headers)
+
+    with patch('routes.dynamic_keys.DatabaseManager') as mock_db_manager:
+        mock_db_manager.return_value.get_dynamic_key_client_config.return_value = client_config
+        flask_response = app.test_client().get("/keys/1?tg_user_id=123",
+                                               headers={key.decode(): value.decode() for key, value in headers})
+
+    assert asgi_status == flask_response.status_code == status
+    assert asgi_body == flask_response.data
+    assert {key.decode(): value.decode() for key, value in asgi_headers.items()} == \
+           {key.lower(): value for key, value in flask_response.headers.items()}
+    mock_get_details.assert_awaited_once_with(1, 123)
+
+
+@pytest.mark.parametrize("if_none_match, status", [(b'"1-3"', 304), (b'W/"1-2", "1-3"', 304), (b'"1-2"', 200)])
+def test_get_dynamic_key_asgi_conditional_request_matches_flask(mock_get_details, mock_get_version, if_none_match,
+                                                                status):
+    mock_get_version.return_value = 3
+    mock_get_details.return_value = (3, CLIENT_CONFIG)
+
+    asgi_status, asgi_headers, asgi_body = asgi_request("GET", "/keys/1", b"tg_user_id=123",
+                                                        [(b"if-none-match", if_none_match)])
+
+    with patch('routes.dynamic_keys.DatabaseManager') as mock_db_manager:
+        mock_db_manager.return_value.get_dynamic_key_version.return_value = 3
+        mock_db_manager.return_value.get_dynamic_key_client_config.return_value = (3, CLIENT_CONFIG)
+        flask_response = app.test_client().get("/keys/1?tg_user_id=123",
+                                               headers={"If-None-Match": if_none_match.decode()})
+
+    assert asgi_status == flask_response.status_code == status
+    assert asgi_body == flask_response.data
+    assert {key.decode(): value.decode() for key, value in asgi_headers.items()} == \
+           {key.lower(): value for key, value in flask_response.headers.items()}
+    assert mock_get_details.await_count == (status == 200)
+
+
+@pytest.mark.parametrize("query_string", [b"", b"tg_user_id=abc", b"tg_user_id=0"])
+def test_get_dynamic_key_asgi_error_missing_params(mock_get_details, query_string):
+    status, _, body = asgi_request("GET", "/keys/1", query_string)
+
+    assert status == 400
+    assert json.loads(body) == {"error": "Both key_id and tg_user_id are required"}
+    mock_get_details.assert_not_awaited()
+
+
+def test_get_dynamic_key_asgi_error_internal_error(mock_get_details):
+    mock_get_details.side_effect = Exception("Internal error")
+
+    status, _, body = asgi_request("GET", "/keys/1", b"tg_user_id=123")
+
+    assert status == 500
+    assert json.loads(body) == {"error": "An unexpected error occurred", "details": "Internal error"}
+
+
+def test_asgi_passes_other_requests_to_flask(mock_get_details):
+    status, _, _ = asgi_request("POST", "/keys")
+    assert status == 401
+
+    status, headers, _ = asgi_request("OPTIONS", "/keys/1", headers=[(b"origin", b"https://example.com"),
+                                                                      (b"access-control-request-method", b"GET")])
+    assert status == 200
+    assert b"GET" in headers[b"access-control-allow-methods"]
+    mock_get_details.assert_not_awaited()
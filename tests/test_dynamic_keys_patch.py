@@ -34,8 +34,7 @@ def test_patch_dynamic_keys_error_unauthorized_access(unauth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_patch_dynamic_keys_success(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_dynamic_key_exists_by_id.return_value = True
-    mock_db_instance.deactivate_dynamic_key_and_outline_key.side_effect = None  # No exception
+    mock_db_instance.deactivate_dynamic_key_and_outline_key.return_value = True
 
     response = auth_client.patch("/keys/1")
 
@@ -49,7 +48,7 @@ def test_patch_dynamic_keys_success(mock_db_manager, auth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_patch_dynamic_keys_error_not_found(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_dynamic_key_exists_by_id.return_value = False
+    mock_db_instance.deactivate_dynamic_key_and_outline_key.return_value = False
 
     response = auth_client.patch("/keys/1")
 
@@ -60,7 +59,7 @@ def test_patch_dynamic_keys_error_not_found(mock_db_manager, auth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_patch_dynamic_keys_error_internal_error(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_dynamic_key_exists_by_id.side_effect = Exception("Internal error")
+    mock_db_instance.deactivate_dynamic_key_and_outline_key.side_effect = Exception("Internal error")
 
     response = auth_client.patch("/keys/1")
 
@@ -1,6 +1,7 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from app import app
+from database.database_manager import DatabaseManager
 import json
 import base64
 from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
@@ -38,43 +39,21 @@ def test_post_dynamic_keys_error_unauthorized_access(unauth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_post_dynamic_keys_success(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_outline_key_exists.return_value = True
-    mock_db_instance.check_dynamic_key_exists_for_user.return_value = False
-    mock_db_instance.generate_unique_dynamic_key_id.return_value = "000000001"
-    mock_db_instance.get_access_url_by_outline_key.return_value = "some_access_url"
-    mock_db_instance.parse_access_url.return_value = {
-        "server": "example.com",
-        "server_port": 1234,
-        "password": "password",
-        "method": "method"
-    }
-
-    # Mock the update operation as well
-    mock_db_instance.insert_dynamic_key.side_effect = None  # No exception, simulating successful insert and update
+    # Checks, insert and outline key update are done by a single call
+    mock_db_instance.insert_dynamic_key.return_value = ("created", 100000001)
 
     data = {"tg_user_id": 123, "outline_key_uuid": "uuid123"}
     response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
 
     assert response.status_code == 201
-    assert response.json == {"id": "000000001"}
+    assert response.json == {"id": 100000001}
 
-    # Verify that insert_dynamic_key was called, which includes the update operation
-    mock_db_instance.insert_dynamic_key.assert_called()
+    mock_db_instance.insert_dynamic_key.assert_called_once_with(123, "uuid123")
 
 
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_post_dynamic_keys_error_update_failure(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_outline_key_exists.return_value = True
-    mock_db_instance.check_dynamic_key_exists_for_user.return_value = False
-    mock_db_instance.generate_unique_dynamic_key_id.return_value = "000000001"
-    mock_db_instance.get_access_url_by_outline_key.return_value = "some_access_url"
-    mock_db_instance.parse_access_url.return_value = {
-        "server": "example.com",
-        "server_port": 1234,
-        "password": "password",
-        "method": "method"
-    }
 
     # Simulate an exception during the update operation
     mock_db_instance.insert_dynamic_key.side_effect = Exception("Update failure")
@@ -100,8 +79,12 @@ def test_post_dynamic_keys_error_missing_param(auth_client, missing_key):
     response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
 
     # Assert the expected response
+    expected_error = {
+        "tg_user_id": "tg_user_id",
+        "outline_key_uuid": "outline_key_uuid, outline_server_id or location",
+    }[missing_key]
     assert response.status_code == 400
-    assert response.json == {"error": f"Missing required parameters: {missing_key}"}
+    assert response.json == {"error": f"Missing required parameters: {expected_error}"}
 
 
 def test_post_dynamic_keys_error_missing_all_params(auth_client):
@@ -126,7 +109,7 @@ def test_post_dynamic_keys_error_missing_all_params(auth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_post_dynamic_keys_error_outline_key_not_found(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_outline_key_exists.return_value = False
+    mock_db_instance.insert_dynamic_key.return_value = ("outline_key_not_found", None)
 
     data = {"tg_user_id": 123, "outline_key_uuid": "uuid123"}
     response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
@@ -137,8 +120,7 @@ def test_post_dynamic_keys_error_outline_key_not_found(mock_db_manager, auth_cli
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_post_dynamic_keys_error_exists_for_user(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_outline_key_exists.return_value = True
-    mock_db_instance.check_dynamic_key_exists_for_user.return_value = True
+    mock_db_instance.insert_dynamic_key.return_value = ("dynamic_key_exists", None)
 
     data = {"tg_user_id": 123, "outline_key_uuid": "uuid123"}
     response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
@@ -149,9 +131,69 @@ def test_post_dynamic_keys_error_exists_for_user(mock_db_manager, auth_client):
 @patch('routes.dynamic_keys.DatabaseManager')
 def test_post_dynamic_keys_error_internal_error(mock_db_manager, auth_client):
     mock_db_instance = mock_db_manager.return_value
-    mock_db_instance.check_outline_key_exists.side_effect = Exception("Internal error")
+    mock_db_instance.insert_dynamic_key.side_effect = Exception("Internal error")
 
     data = {"tg_user_id": 123, "outline_key_uuid": "uuid123"}
     response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
     assert response.status_code == 500
     assert "error" in response.json
+
+
+@pytest.mark.parametrize("data, expected_kwargs", [
+    ({"tg_user_id": 123, "outline_server_id": 1}, {"server_id": 1, "location": None}),
+    ({"tg_user_id": 123, "location": "Austria"}, {"server_id": None, "location": "Austria"}),
+    ({"tg_user_id": 123, "outline_server_id": 1, "location": "Austria"}, {"server_id": 1, "location": "Austria"}),
+])
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_success_claims_unused_key(mock_db_manager, auth_client, data, expected_kwargs):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_key.return_value = ("created", 100000001)
+
+    response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 201
+    assert response.json == {"id": 100000001}
+    mock_db_instance.insert_dynamic_key.assert_called_once_with(123, **expected_kwargs)
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_error_no_unused_keys(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_key.return_value = ("no_unused_outline_keys", None)
+
+    data = {"tg_user_id": 123, "location": "Austria"}
+    response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 404
+    assert response.json == {"error": "No unused outline keys found for provided server or location"}
+
+
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_post_dynamic_keys_error_outline_key_in_use(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.insert_dynamic_key.return_value = ("outline_key_in_use", None)
+
+    data = {"tg_user_id": 123, "outline_key_uuid": "uuid123"}
+    response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 409
+    assert response.json == {"error": "Outline key is already used by another dynamic key"}
+
+
+@pytest.mark.parametrize("data", [
+    {"tg_user_id": 123, "outline_key_uuid": "uuid123", "location": "Austria"},
+    {"tg_user_id": 123, "outline_server_id": "1"},
+])
+def test_post_dynamic_keys_error_invalid_key_source(auth_client, data):
+    response = auth_client.post("/keys", data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 400
+
+
+def test_insert_dynamic_key_retries_taken_id():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # the first random id is taken, so nothing is inserted although all checks pass
+    db_manager.cursor.fetchone.side_effect = [(False, False, None), (False, False, 100000002)]
+
+    with patch.object(db_manager, 'generate_unique_dynamic_key_id', side_effect=[100000001, 100000002]):
+        assert db_manager.insert_dynamic_key(123, "uuid123") == ("created", 100000002)
+
+    assert db_manager.cursor.execute.call_count == 2
@@ -42,16 +42,7 @@ def test_put_dynamic_keys_success(mock_db_manager, auth_client):
     new_outline_key_uuid = "new_uuid123"
 
     # Setup mock responses
-    mock_db_instance.check_dynamic_key_exists_by_id.return_value = True
-    mock_db_instance.check_outline_key_exists.return_value = True
-    mock_db_instance.get_access_url_by_outline_key.return_value = "some_access_url"
-    mock_db_instance.parse_access_url.return_value = {
-        "server": "new_example.com",
-        "server_port": 5678,
-        "password": "new_password",
-        "method": "new_method"
-    }
-    mock_db_instance.update_dynamic_key_with_new_outline_key.return_value = None
+    mock_db_instance.update_dynamic_key_with_new_outline_key.return_value = "updated"
 
     # Prepare request data
     data = {"outline_key_uuid": new_outline_key_uuid}
@@ -62,9 +53,7 @@ def test_put_dynamic_keys_success(mock_db_manager, auth_client):
     assert response.json == {"message": "Dynamic key and associated outline key updated successfully"}
 
     # Verify that the update method was called with the expected parameters
-    mock_db_instance.update_dynamic_key_with_new_outline_key.assert_called_with(
-        key_id, new_outline_key_uuid, mock_db_instance.parse_access_url.return_value
-    )
+    mock_db_instance.update_dynamic_key_with_new_outline_key.assert_called_with(key_id, new_outline_key_uuid)
 
 
 @patch('routes.dynamic_keys.DatabaseManager')
@@ -74,7 +63,7 @@ def test_put_dynamic_keys_error_not_found(mock_db_manager, auth_client):
     new_outline_key_uuid = "new_uuid123"
 
     # Setup mock response
-    mock_db_instance.check_dynamic_key_exists_by_id.return_value = False
+    mock_db_instance.update_dynamic_key_with_new_outline_key.return_value = "dynamic_key_not_found"
 
     # Prepare request data
     data = {"outline_key_uuid": new_outline_key_uuid}
@@ -85,6 +74,18 @@ def test_put_dynamic_keys_error_not_found(mock_db_manager, auth_client):
     assert response.json == {"error": "Dynamic key not found"}
 
 
+@patch('routes.dynamic_keys.DatabaseManager')
+def test_put_dynamic_keys_error_outline_key_not_found(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.update_dynamic_key_with_new_outline_key.return_value = "outline_key_not_found"
+
+    data = {"outline_key_uuid": "new_uuid123"}
+    response = auth_client.put("/keys/1", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 404
+    assert response.json == {"error": "Outline key uuid not found"}
+
+
 def test_put_dynamic_keys_error_invalid_param(auth_client):
     key_id = 1
     data = {"wrong_param": "some_value"}
@@ -103,7 +104,7 @@ def test_put_dynamic_keys_error_internal_error(mock_db_manager, auth_client):
     new_outline_key_uuid = "new_uuid123"
 
     # Simulate an exception during the update operation
-    mock_db_instance.check_dynamic_key_exists_by_id.side_effect = Exception("Internal error")
+    mock_db_instance.update_dynamic_key_with_new_outline_key.side_effect = Exception("Internal error")
 
     # Prepare request data
     data = {"outline_key_uuid": new_outline_key_uuid}
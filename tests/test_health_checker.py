@@ -0,0 +1,90 @@
+from unittest.mock import patch, MagicMock
+from database.database_manager import DatabaseManager
+from outline.client import OutlineAPIError
+from outline.health_checker import check_server, check_servers, run_cycle
+
+
+@patch('outline.health_checker.get_client')
+def test_check_server(mock_get_client):
+    check = check_server("http://one.example.com/api", timeout=1)
+
+    assert check["healthy"] is True and check["latency_ms"] >= 0 and check["error"] is None
+    # a single call, also while the circuit breaker is open
+    mock_get_client.return_value.get_server.assert_called_once_with(timeout=1, retries=0, check_circuit=False)
+
+    mock_get_client.return_value.get_server.side_effect = OutlineAPIError("Request timed out")
+    assert check_server("http://one.example.com/api") == {"healthy": False, "latency_ms": None,
+                                                          "error": "Request timed out"}
+
+
+@patch('outline.health_checker.check_server')
+def test_check_servers_keeps_order(mock_check_server):
+    mock_check_server.side_effect = lambda api_url: {"healthy": "one" in api_url, "latency_ms": None, "error": None}
+
+    checks = check_servers([{"id": 1, "api_url": "http://one.example.com/api"},
+                            {"id": 2, "api_url": "http://two.example.com/api"}])
+
+    assert [(check["server_id"], check["healthy"]) for check in checks] == [(1, True), (2, False)]
+    assert check_servers([]) == []
+
+
+@patch('outline.health_checker.check_servers')
+@patch('outline.health_checker.DatabaseManager')
+def test_run_cycle_records_checks(mock_db_manager, mock_check_servers):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.try_advisory_lock.return_value = True
+    mock_db_instance.get_servers_to_check.return_value = [{"id": 1, "api_url": "http://one.example.com/api"}]
+    mock_check_servers.return_value = [{"server_id": 1, "healthy": False, "latency_ms": None, "error": "down"}]
+    mock_db_instance.record_health_checks.return_value = [{"id": 1, "is_active": False}]
+
+    assert run_cycle() is True
+
+    mock_check_servers.assert_called_once_with([{"id": 1, "api_url": "http://one.example.com/api"}])
+    assert mock_db_instance.record_health_checks.call_args.args[0] == mock_check_servers.return_value
+    mock_db_instance.advisory_unlock.assert_called_once()
+
+
+@patch('outline.health_checker.check_servers')
+@patch('outline.health_checker.DatabaseManager')
+def test_run_cycle_skips_when_locked_by_another_instance(mock_db_manager, mock_check_servers):
+    mock_db_manager.return_value.try_advisory_lock.return_value = False
+
+    assert run_cycle() is False
+
+    mock_check_servers.assert_not_called()
+
+
+def make_db_manager(recorded_rows, changed_rows=None):
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    db_manager.cursor.fetchall.side_effect = [recorded_rows, changed_rows]
+    return db_manager
+
+
+def test_record_health_checks_applies_hysteresis():
+    # rows are (id, health_history, is_active, health_deactivated) after the checks were recorded
+    db_manager = make_db_manager([
+        (1, 0b1000, True, False),    # 3 failures in a row: deactivated
+        (2, 0b1001, True, False),    # 2 failures, then a success: kept active
+        (3, 0b0111111, False, True),  # 5 successes in a row after its deactivation: reactivated
+        (4, 0b0111111, False, False),  # deactivated by hand: left alone
+        (5, 0b0001111, False, True),  # only 4 successes: kept inactive
+    ], [(1, False), (3, True)])
+    checks = [{"server_id": i, "healthy": True, "latency_ms": 100.0} for i in range(1, 6)]
+
+    changed = db_manager.record_health_checks(checks, failure_threshold=3, recovery_threshold=5)
+
+    assert changed == [{"id": 1, "is_active": False}, {"id": 3, "is_active": True}]
+    change_params = db_manager.cursor.execute.call_args[0][1]
+    assert (change_params["server_ids"], change_params["is_active"]) == ([1, 3], [False, True])
+    db_manager.conn.commit.assert_called_once()
+    assert db_manager.conn.autocommit is True
+
+
+def test_record_health_checks_without_changes_leaves_is_active_untouched():
+    db_manager = make_db_manager([(1, -1, True, False)])
+
+    assert db_manager.record_health_checks([{"server_id": 1, "healthy": True, "latency_ms": 100.0}],
+                                           failure_threshold=3, recovery_threshold=5) == []
+    # is_active is not written, so the workers are not notified to reload their reference data
+    assert db_manager.cursor.execute.call_count == 1
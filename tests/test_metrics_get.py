@@ -0,0 +1,101 @@
+import os
+import pytest
+import subprocess
+import sys
+from unittest.mock import patch, MagicMock
+import base64
+from prometheus_client import REGISTRY
+from app import app  # Import the Flask app
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+from database.connection_pool import ConnectionPool, PoolTimeoutError
+from metrics import statement_label, outline_path_label, generate_metrics
+from outline.client import OutlineClient
+
+
+@pytest.fixture
+def auth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # Encode credentials
+        credentials = base64.b64encode(f"{BASIC_AUTH_USERNAME}:{BASIC_AUTH_PASSWORD}".encode()).decode('utf-8')
+        # Set the Authorization header for all requests
+        test_client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+        yield test_client
+
+
+@pytest.fixture
+def unauth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # No Authorization header
+        yield test_client
+
+
+def test_get_metrics_error_unauthorized_access(unauth_client):
+
+    response = unauth_client.get("/metrics")
+    assert response.status_code == 401
+
+
+@patch('routes.locations.DatabaseManager')
+def test_get_metrics_counts_requests_by_route(mock_db_manager, auth_client):
+    mock_db_manager.return_value.get_locations.return_value = []
+    labels = {"blueprint": "locations", "route": "/locations", "method": "GET", "status": "200"}
+    before = REGISTRY.get_sample_value("http_request_duration_seconds_count", labels) or 0
+
+    auth_client.get("/locations")
+    response = auth_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    assert REGISTRY.get_sample_value("http_request_duration_seconds_count", labels) == before + 1
+    assert b'http_request_duration_seconds_count{blueprint="locations"' in response.data
+
+
+@patch('outline.client.requests.Session.delete')
+def test_outline_api_calls_are_counted_by_outcome(mock_delete):
+    client = OutlineClient("http://one.example.com/api")
+    labels = {"method": "delete", "path": "/access-keys/{id}", "outcome": "success"}
+    before = REGISTRY.get_sample_value("outline_api_calls_total", labels) or 0
+    mock_delete.return_value = MagicMock(status_code=204)
+
+    client.delete_access_key("12")
+
+    assert REGISTRY.get_sample_value("outline_api_calls_total", labels) == before + 1
+
+
+def test_pool_timeouts_are_counted():
+    pool = ConnectionPool(max_size=1, timeout=0.01, ping_interval=30, credentials={})
+    pool._slots.acquire()
+    before = REGISTRY.get_sample_value("db_pool_timeouts_total") or 0
+
+    with pytest.raises(PoolTimeoutError):
+        pool.getconn()
+
+    assert REGISTRY.get_sample_value("db_pool_timeouts_total") == before + 1
+    assert REGISTRY.get_sample_value("db_pool_wait_seconds_count") >= 1
+
+
+@pytest.mark.parametrize("query, expected", [("SELECT 1;", "select"), ("\n  WITH dead AS (...)", "with"),
+                                             (b"EXECUTE get_key (%s);", "execute"), ("VACUUM", "other"),
+                                             ("", "other"), (None, "other")])
+def test_statement_label(query, expected):
+    assert statement_label(query) == expected
+
+
+def test_outline_path_label():
+    assert outline_path_label("/access-keys/12/name") == "/access-keys/{id}/name"
+    assert outline_path_label("/server") == "/server"
+
+
+def test_metrics_of_all_processes_are_added_up(tmp_path, monkeypatch):
+    # two worker processes count in their own files, the scrape adds them up
+    script = "from metrics import DB_POOL_TIMEOUTS; DB_POOL_TIMEOUTS.inc(2)"
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", script], check=True, cwd=os.path.dirname(os.path.dirname(__file__)),
+                       env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)})
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    body, _ = generate_metrics()
+
+    assert b"db_pool_timeouts_total 4.0" in body
@@ -0,0 +1,207 @@
+import pytest
+from unittest.mock import patch, MagicMock
+import requests
+import time
+from outline.client import (OutlineClient, CircuitBreaker, OutlineAPIError, CircuitOpenError, get_client,
+                            probe_server)
+from outline import client as outline_client
+
+API_URL = "http://one.example.com/api"
+
+
+def http_error_response(status_code):
+    response = MagicMock(status_code=status_code)
+    response.raise_for_status.side_effect = requests.exceptions.HTTPError(f"{status_code} Error")
+    return response
+
+
+@pytest.fixture
+def client():
+    return OutlineClient(API_URL, CircuitBreaker(failure_threshold=3, reset_timeout=30))
+
+
+@patch('outline.client.time.sleep')
+@patch('outline.client.requests.Session.get')
+def test_idempotent_calls_are_retried(mock_get, mock_sleep, client):
+    mock_get.side_effect = [requests.exceptions.Timeout(), http_error_response(503),
+                            MagicMock(status_code=200, json=lambda: {"name": "server"})]
+
+    assert client.get_server() == {"name": "server"}
+
+    assert mock_get.call_count == 3
+    assert mock_get.call_args.args == (f"{API_URL}/server",)
+    assert mock_sleep.call_count == 2
+    assert client.breaker.failures == 0
+
+
+@patch('outline.client.time.sleep')
+@patch('outline.client.requests.Session.post')
+def test_key_creation_is_not_retried(mock_post, mock_sleep, client):
+    mock_post.side_effect = requests.exceptions.Timeout()
+
+    with pytest.raises(OutlineAPIError, match="Request timed out"):
+        client.create_access_key()
+
+    mock_post.assert_called_once()
+    mock_sleep.assert_not_called()
+
+
+@patch('outline.client.requests.Session.put')
+def test_client_errors_are_not_retried_nor_counted(mock_put, client):
+    mock_put.return_value = http_error_response(400)
+
+    with pytest.raises(OutlineAPIError) as error:
+        client.rename_access_key("1", "shadowtrail:uuid1")
+
+    assert error.value.status_code == 400
+    mock_put.assert_called_once()
+    assert mock_put.call_args.kwargs["json"] == {"name": "shadowtrail:uuid1"}
+    assert client.breaker.failures == 0
+
+
+@patch('outline.client.requests.Session.delete')
+def test_delete_of_missing_key_succeeds(mock_delete, client):
+    mock_delete.return_value = http_error_response(404)
+
+    client.delete_access_key("1")
+
+
+@patch('outline.client.time.sleep')
+@patch('outline.client.requests.Session.get')
+def test_circuit_opens_after_failures_and_closes_after_trial(mock_get, mock_sleep, client):
+    mock_get.side_effect = requests.exceptions.ConnectionError("Connection refused")
+
+    # 3 attempts of one call reach the threshold
+    with pytest.raises(OutlineAPIError, match="Connection refused"):
+        client.get_server()
+    assert client.breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        client.get_server()
+    assert mock_get.call_count == 3
+
+    # after reset_timeout one trial call is let through, a failed trial opens the circuit again
+    client.breaker.opened_at -= 30
+    assert client.breaker.state == "half_open"
+    with pytest.raises(OutlineAPIError):
+        client.get_server(retries=0)
+    assert mock_get.call_count == 4
+    assert client.breaker.state == "open"
+
+    client.breaker.opened_at -= 30
+    mock_get.side_effect = None
+    mock_get.return_value = MagicMock(status_code=200, json=lambda: {})
+    client.get_server(retries=0)
+    assert client.breaker.state == "closed"
+
+
+def test_half_open_circuit_allows_one_trial_at_a_time():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.record_success()
+    assert breaker.allow() is True
+
+
+@patch('outline.client.requests.Session.get')
+def test_unexpected_error_of_trial_call_gives_trial_back(mock_get, client):
+    client.breaker.failures, client.breaker.opened_at = 3, time.monotonic() - 30
+    mock_get.side_effect = ValueError("Invalid header value")
+
+    with pytest.raises(ValueError):
+        client.get_server(retries=0)
+
+    assert client.breaker.state == "half_open"
+    assert client.breaker.allow() is True
+
+
+@patch('outline.client.requests.Session.get')
+def test_health_checks_bypass_open_circuit(mock_get, client):
+    client.breaker.failures, client.breaker.opened_at = 3, 10 ** 12
+    mock_get.return_value = MagicMock(status_code=200, json=lambda: {})
+
+    client.get_server(retries=0, check_circuit=False)
+
+    assert client.breaker.state == "closed"
+
+
+@patch('outline.client.requests.Session.get')
+def test_invalid_json_is_an_api_error(mock_get, client):
+    mock_get.return_value = MagicMock(status_code=200, json=MagicMock(side_effect=ValueError("Expecting value")))
+
+    with pytest.raises(OutlineAPIError, match="Invalid response"):
+        client.get_server()
+
+
+def test_get_client_reuses_client_per_server():
+    assert get_client(API_URL) is get_client(API_URL)
+    assert get_client(API_URL) is not get_client("http://two.example.com/api")
+
+
+@patch('outline.client.requests.Session.close')
+@patch('outline.client.requests.Session.get')
+def test_probe_server_keeps_no_client(mock_get, mock_close):
+    mock_get.return_value = MagicMock(status_code=200, json=lambda: {"version": "1.8.0"})
+
+    assert probe_server("http://probed.example.com/api") == {"version": "1.8.0"}
+
+    assert "http://probed.example.com/api" not in outline_client._clients
+    mock_close.assert_called_once()
+
+
+@pytest.mark.parametrize("api_version, expected", [("1.8.0", True), ("1.10.2", True), ("1.7.2", False),
+                                                   ("", False)])
+def test_supports_named_keys_from_stored_version(api_version, expected):
+    client = OutlineClient(API_URL, api_version=api_version)
+
+    with patch.object(client, "get_server") as get_server:
+        assert client.supports_named_keys() is expected
+
+    get_server.assert_not_called()
+
+
+def test_supports_named_keys_asks_server_once_without_stored_version(client):
+    with patch.object(client, "get_server", side_effect=OutlineAPIError("Request timed out")) as get_server:
+        assert client.supports_named_keys() is False
+        # a failed lookup is not remembered
+        get_server.side_effect, get_server.return_value = None, {"version": "1.9.0"}
+        assert client.supports_named_keys() is True
+        assert client.supports_named_keys() is True
+
+    assert get_server.call_count == 2
+
+
+@patch('outline.client.requests.Session.post')
+def test_create_access_key_sends_name_only_when_given(mock_post, client):
+    mock_post.return_value = MagicMock(status_code=201, json=lambda: {"id": "1", "accessUrl": "url"})
+
+    client.create_access_key()
+    assert "json" not in mock_post.call_args.kwargs
+
+    client.create_access_key("shadowtrail:uuid1")
+    assert mock_post.call_args.kwargs["json"] == {"name": "shadowtrail:uuid1"}
+
+
+def test_get_client_takes_stored_version():
+    assert get_client("http://three.example.com/api", "1.8.0").api_version == "1.8.0"
+    assert get_client("http://three.example.com/api").api_version == "1.8.0"
+
+
+@patch('outline.client.requests.Session.get')
+def test_list_access_keys(mock_get, client):
+    mock_get.return_value = MagicMock(status_code=200, json=lambda: {"accessKeys": [{"id": "1", "name": ""}]})
+
+    assert client.list_access_keys(timeout=30) == [{"id": "1", "name": ""}]
+    assert mock_get.call_args.args == (f"{API_URL}/access-keys",)
+    assert mock_get.call_args.kwargs["timeout"] == 30
+
+
+@patch('outline.client.requests.Session.get')
+def test_get_transfer_metrics(mock_get, client):
+    mock_get.return_value = MagicMock(status_code=200, json=lambda: {"bytesTransferredByUserId": {"1": 100}})
+
+    assert client.get_transfer_metrics(timeout=10) == {"1": 100}
+    assert mock_get.call_args.args == (f"{API_URL}/metrics/transfer",)
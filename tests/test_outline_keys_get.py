@@ -1,8 +1,9 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from app import app  # Import the Flask app
 import base64
 from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+from database.database_manager import DatabaseManager
 
 
 @pytest.fixture
@@ -95,3 +96,69 @@ def test_get_outline_keys_error_internal_error(mock_db_manager, auth_client):
     response = auth_client.get("/outline_keys/1")
     assert response.status_code == 500
     assert response.json == {"error": "An unexpected error occurred", "details": "Database error"}
+
+
+@patch('routes.outline_keys.DatabaseManager')
+def test_get_outline_keys_next_page_link(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.get_outline_keys.return_value = [
+        {"uuid": "08e97dff-0751-40bf-ac8a-45551a7415d6", "access_url": "url1", "currently_used": False},
+        {"uuid": "5cb6f2ac-8fe1-4844-bd0c-c41acedc310d", "access_url": "url2", "currently_used": False},
+    ]
+
+    response = auth_client.get("/outline_keys/1?currently_used=false&limit=2")
+    assert response.status_code == 200
+    assert response.headers["Link"] == ('</outline_keys/1?currently_used=false&limit=2'
+                                        '&after=5cb6f2ac-8fe1-4844-bd0c-c41acedc310d>; rel="next"')
+    mock_db_instance.get_outline_keys.assert_called_with(1, False, 2, None)
+
+    # The last page is shorter than the limit and has no link
+    mock_db_instance.get_outline_keys.return_value = mock_db_instance.get_outline_keys.return_value[:1]
+    response = auth_client.get("/outline_keys/1?limit=2&after=08E97DFF-0751-40BF-AC8A-45551A7415D6")
+    assert "Link" not in response.headers
+    mock_db_instance.get_outline_keys.assert_called_with(1, None, 2, "08e97dff-0751-40bf-ac8a-45551a7415d6")
+
+
+@patch('routes.outline_keys.DatabaseManager')
+def test_get_outline_keys_stream(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    keys = [{"uuid": "uuid1", "access_url": "url1", "currently_used": True},
+            {"uuid": "uuid2", "access_url": "url2", "currently_used": False}]
+    mock_db_instance.iter_outline_keys.return_value = iter(keys)
+    mock_db_instance.get_outline_keys.return_value = keys
+
+    response = auth_client.get("/outline_keys/1?stream=true")
+    assert response.status_code == 200
+    assert response.is_streamed
+    # Same document as the buffered response
+    assert response.data == auth_client.get("/outline_keys/1").data
+    mock_db_instance.iter_outline_keys.assert_called_with(1, None, None, None)
+    mock_db_instance.close.assert_called()
+
+
+@pytest.mark.parametrize("query, error", [
+    ("after=invalid", "Invalid 'after' parameter. It must be an outline key uuid."),
+    ("stream=yes", "Invalid 'stream' parameter. It must be 'true' or 'false'."),
+])
+@patch('routes.outline_keys.DatabaseManager')
+def test_get_outline_keys_error_invalid_pagination_params(mock_db_manager, auth_client, query, error):
+    response = auth_client.get(f"/outline_keys/1?{query}")
+    assert response.status_code == 400
+    assert response.json == {"error": error}
+    # Parameters are validated before the server lookup
+    mock_db_manager.return_value.check_server_exists_using_id.assert_not_called()
+
+
+def test_iter_outline_keys_uses_named_cursor():
+    db_manager = DatabaseManager()
+    db_manager._conn = MagicMock()
+    named_cursor = db_manager._conn.cursor.return_value.__enter__.return_value
+    named_cursor.__iter__.return_value = iter([("uuid1", "url1", True)])
+
+    keys = list(db_manager.iter_outline_keys(1, batch_size=500))
+
+    assert keys == [{"uuid": "uuid1", "access_url": "url1", "currently_used": True}]
+    db_manager._conn.cursor.assert_called_with(name="outline_keys_stream")
+    assert named_cursor.itersize == 500
+    db_manager._conn.rollback.assert_called_once()
+    assert db_manager._conn.autocommit is True
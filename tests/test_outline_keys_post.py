@@ -1,8 +1,11 @@
 import pytest
 from unittest.mock import patch, MagicMock
 from app import app
+from database.database_manager import DatabaseManager
 import json
 import requests
+import threading
+import time
 import base64
 from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
 
@@ -36,8 +39,8 @@ def test_post_outline_keys_error_unauthorized_access(unauth_client):
     assert response.status_code == 401
 
 
-@patch('routes.outline_keys.requests.post')
-@patch('routes.outline_keys.requests.put')
+@patch('outline.client.requests.Session.post')
+@patch('outline.client.requests.Session.put')
 @patch('routes.outline_keys.DatabaseManager')
 def test_post_outline_keys_success_all_success(mock_db_manager, mock_put, mock_post, auth_client):
     # Mock the database manager methods
@@ -45,6 +48,7 @@ def test_post_outline_keys_success_all_success(mock_db_manager, mock_put, mock_p
     mock_db_instance.check_server_exists_using_id.return_value = True
     mock_db_instance.get_server_api_url.return_value = "http://example.com/api"
     mock_db_instance.generate_unique_uuid.side_effect = ["uuid1", "uuid2"]
+    mock_db_instance.insert_keys.side_effect = lambda keys: [key[0] for key in keys]
 
     # Mock successful responses for POST (key creation) and PUT (setting name) requests
     mock_post.return_value = MagicMock(status_code=201, json=lambda: {"id": "key_id", "accessUrl": "url"})
@@ -66,8 +70,8 @@ def test_post_outline_keys_success_all_success(mock_db_manager, mock_put, mock_p
     }
 
 
-@patch('routes.outline_keys.requests.put')
-@patch('routes.outline_keys.requests.post')
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
 @patch('routes.outline_keys.DatabaseManager')
 def test_post_outline_keys_success_partial_success(mock_db_manager, mock_post, mock_put, auth_client):
     # Mock DatabaseManager methods
@@ -75,6 +79,7 @@ def test_post_outline_keys_success_partial_success(mock_db_manager, mock_post, m
     mock_db_instance.check_server_exists_using_id.return_value = True
     mock_db_instance.get_server_api_url.return_value = "http://example.com/api"
     mock_db_instance.generate_unique_uuid.side_effect = ["uuid1", "uuid2"]
+    mock_db_instance.insert_keys.side_effect = lambda keys: [key[0] for key in keys]
 
     # First key creation succeeds (POST and PUT), second key creation (POST) fails
     mock_post.side_effect = [
@@ -97,6 +102,157 @@ def test_post_outline_keys_success_partial_success(mock_db_manager, mock_post, m
     assert "failed_keys" in response.json and len(response.json["failed_keys"]) == 1
 
 
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
+@patch('routes.outline_keys.DatabaseManager')
+def test_post_outline_keys_error_all_failed_with_timeout(mock_db_manager, mock_post, mock_put, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.get_server_api_url.return_value = "http://example.com/api"
+    mock_db_instance.generate_unique_uuid.side_effect = ["uuid1", "uuid2"]
+
+    mock_post.side_effect = requests.exceptions.Timeout()
+
+    data = {"outline_server_id": 1, "number_of_keys": 2}
+    response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 422
+    assert response.json == {"error": "All key creation attempts failed",
+                             "details": ["Request timed out", "Request timed out"]}
+    mock_db_instance.insert_keys.assert_not_called()
+
+
+@patch('outline.provisioning.OUTLINE_PROVISIONING_CONCURRENCY', 3)
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
+@patch('routes.outline_keys.DatabaseManager')
+def test_post_outline_keys_success_concurrency_limit(mock_db_manager, mock_post, mock_put, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.get_server_api_url.return_value = "http://limited.example.com/api"
+    mock_db_instance.generate_unique_uuid.side_effect = [f"uuid{i}" for i in range(10)]
+    mock_db_instance.insert_keys.side_effect = lambda keys: [key[0] for key in keys]
+
+    lock = threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+
+    def slow_post(*args, **kwargs):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(0.02)
+        with lock:
+            in_flight["now"] -= 1
+        return MagicMock(status_code=201, json=lambda: {"id": "key_id", "accessUrl": "url"})
+
+    mock_post.side_effect = slow_post
+    mock_put.return_value = MagicMock(status_code=204)
+
+    data = {"outline_server_id": 1, "number_of_keys": 10}
+    response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 201
+    assert response.json["successful_keys"] == [{"uuid": f"uuid{i}"} for i in range(10)]
+    assert 1 < in_flight["max"] <= 3
+
+
+@patch('routes.outline_keys.OUTLINE_KEYS_INSERT_BATCH_SIZE', 2)
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
+@patch('routes.outline_keys.DatabaseManager')
+def test_post_outline_keys_success_batched_inserts(mock_db_manager, mock_post, mock_put, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.get_server_api_url.return_value = "http://example.com/api"
+    mock_db_instance.generate_unique_uuid.side_effect = [f"uuid{i}" for i in range(5)]
+    mock_db_instance.insert_keys.side_effect = lambda keys: [key[0] for key in keys]
+
+    mock_post.return_value = MagicMock(status_code=201, json=lambda: {"id": "key_id", "accessUrl": "url"})
+    mock_put.return_value = MagicMock(status_code=204)
+
+    data = {"outline_server_id": 1, "number_of_keys": 5}
+    response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 201
+    assert response.json["total_success"] == 5
+    assert [len(call.args[0]) for call in mock_db_instance.insert_keys.call_args_list] == [2, 2, 1]
+
+
+@patch('routes.outline_keys.OUTLINE_KEYS_INSERT_BATCH_SIZE', 2)
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
+@patch('routes.outline_keys.DatabaseManager')
+def test_post_outline_keys_success_partial_database_failure(mock_db_manager, mock_post, mock_put, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.get_server_api_url.return_value = "http://example.com/api"
+    mock_db_instance.generate_unique_uuid.side_effect = ["uuid1", "uuid2", "uuid3"]
+    mock_db_instance.insert_keys.side_effect = [["uuid1", "uuid2"], Exception("Database error")]
+
+    mock_post.return_value = MagicMock(status_code=201, json=lambda: {"id": "key_id", "accessUrl": "url"})
+    mock_put.return_value = MagicMock(status_code=204)
+
+    data = {"outline_server_id": 1, "number_of_keys": 3}
+    response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 207
+    assert response.json["successful_keys"] == [{"uuid": "uuid1"}, {"uuid": "uuid2"}]
+    assert response.json["failed_keys"] == [
+        {"uuid": "uuid3", "error": "Failed to save key in database: Database error"}
+    ]
+
+
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
+@patch('routes.outline_keys.DatabaseManager')
+def test_post_outline_keys_success_single_call_creation(mock_db_manager, mock_post, mock_put, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.get_server_api_url.return_value = "http://named.example.com/api"
+    mock_db_instance.get_server_api_version.return_value = "1.8.1"
+    mock_db_instance.generate_unique_uuid.side_effect = ["uuid1", "uuid2"]
+    mock_db_instance.insert_keys.side_effect = lambda keys: [key[0] for key in keys]
+
+    mock_post.side_effect = lambda url, **kwargs: MagicMock(status_code=201, json=lambda: {
+        "id": "key_id", "accessUrl": "url", "name": kwargs["json"]["name"]})
+
+    data = {"outline_server_id": 1, "number_of_keys": 2}
+    response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 201
+    assert response.json["total_success"] == 2
+    # the server takes the name with the creation call, no second call is made
+    assert sorted(call.kwargs["json"]["name"] for call in mock_post.call_args_list) == ["shadowtrail:uuid1",
+                                                                                       "shadowtrail:uuid2"]
+    mock_put.assert_not_called()
+
+
+@patch('outline.client.requests.Session.put')
+@patch('outline.client.requests.Session.post')
+@patch('routes.outline_keys.DatabaseManager')
+def test_post_outline_keys_renames_key_stored_with_fresh_uuid(mock_db_manager, mock_post, mock_put, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.get_server_api_url.return_value = "http://example.com/api"
+    mock_db_instance.generate_unique_uuid.side_effect = ["uuid1", "uuid2"]
+    # uuid2 was taken meanwhile, insert_keys stored the key as uuid3
+    mock_db_instance.insert_keys.side_effect = lambda keys: ["uuid1", "uuid3"]
+
+    mock_post.side_effect = [MagicMock(status_code=201, json=lambda: {"id": "1", "accessUrl": "url1"}),
+                             MagicMock(status_code=201, json=lambda: {"id": "2", "accessUrl": "url2"})]
+    mock_put.return_value = MagicMock(status_code=204)
+
+    data = {"outline_server_id": 1, "number_of_keys": 2}
+    response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 201
+    assert response.json["successful_keys"] == [{"uuid": "uuid1"}, {"uuid": "uuid3"}]
+    # the key first named after uuid2 is renamed to the uuid it was stored with
+    renames = [(call.kwargs["json"]["name"], call.args[0]) for call in mock_put.call_args_list]
+    assert renames[-1][0] == "shadowtrail:uuid3"
+    assert renames[-1][1] == dict(renames[:-1])["shadowtrail:uuid2"]
+
+
 def test_post_outline_keys_error_invalid_parameters(auth_client):
     # Invalid parameter types (non-integer values)
     data = {"outline_server_id": "one", "number_of_keys": "two"}
@@ -168,3 +324,38 @@ def test_post_outline_keys_error_internal_error(mock_db_manager, auth_client):
     response = auth_client.post("/outline_keys", data=json.dumps(data), content_type='application/json')
     assert response.status_code == 500
     assert response.json == {"error": "An unexpected error occurred", "details": "Database error"}
+
+
+def test_insert_keys_retries_conflicting_uuid():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    keys = [("uuid1", "1", 1, "url1", False), ("uuid2", "2", 1, "url2", False)]
+
+    with patch('database.database_manager.execute_values') as mock_execute_values, \
+            patch.object(db_manager, 'generate_unique_uuid', return_value="uuid3"):
+        # uuid2 is already taken, the retry stores the key as uuid3
+        mock_execute_values.side_effect = [[("uuid1",)], [("uuid3",)]]
+        stored_uuids = db_manager.insert_keys(keys)
+
+    assert stored_uuids == ["uuid1", "uuid3"]
+    assert mock_execute_values.call_args_list[1].args[2] == [("uuid3", "2", 1, "url2", False)]
+    # both attempts are one transaction
+    db_manager.conn.commit.assert_called_once()
+    assert db_manager.conn.autocommit is True
+
+
+def test_insert_keys_rolls_back_earlier_attempts_on_error():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    keys = [("uuid1", "1", 1, "url1", False), ("uuid2", "2", 1, "url2", False)]
+
+    with patch('database.database_manager.execute_values') as mock_execute_values, \
+            patch.object(db_manager, 'generate_unique_uuid', return_value="uuid3"):
+        mock_execute_values.side_effect = [[("uuid1",)], Exception("Database error")]
+        with pytest.raises(Exception, match="Database error"):
+            db_manager.insert_keys(keys)
+
+    # uuid1 of the first attempt is not left behind, the whole batch failed
+    db_manager.conn.rollback.assert_called_once()
+    db_manager.conn.commit.assert_not_called()
+    assert db_manager.conn.autocommit is True
@@ -0,0 +1,52 @@
+from unittest.mock import patch, MagicMock
+from psycopg2 import errors
+from database.prepared_statements import PreparedStatementsConnection, execute_prepared, to_plain_query
+
+QUERY = "SELECT 1 FROM outline_server WHERE id = $1 AND api_url = $2"
+
+
+def make_cursor(autocommit=True):
+    cursor = MagicMock()
+    cursor.connection = MagicMock(spec=PreparedStatementsConnection)
+    cursor.connection.prepared_statements = set()
+    cursor.connection.autocommit = autocommit
+    return cursor
+
+
+def test_execute_prepared_prepares_statement_once_per_connection():
+    cursor = make_cursor()
+
+    execute_prepared(cursor, "server", QUERY, (1, "url"))
+    execute_prepared(cursor, "server", QUERY, (2, "url"))
+
+    assert [call.args[0] for call in cursor.execute.call_args_list] == [
+        f"PREPARE server AS {QUERY}", "EXECUTE server (%s, %s);", "EXECUTE server (%s, %s);"
+    ]
+    assert cursor.execute.call_args.args[1] == (2, "url")
+
+
+def test_execute_prepared_prepares_again_when_statement_is_gone():
+    cursor = make_cursor()
+    cursor.connection.prepared_statements.add("server")
+    cursor.execute.side_effect = [errors.InvalidSqlStatementName(), None, None]
+
+    execute_prepared(cursor, "server", QUERY, (1, "url"))
+
+    assert [call.args[0] for call in cursor.execute.call_args_list] == [
+        "EXECUTE server (%s, %s);", f"PREPARE server AS {QUERY}", "EXECUTE server (%s, %s);"
+    ]
+
+
+@patch('database.prepared_statements.POSTGRES_PREPARED_STATEMENTS', False)
+def test_execute_prepared_falls_back_to_plain_statement():
+    cursor = make_cursor()
+
+    execute_prepared(cursor, "server", QUERY, (1, "url"))
+
+    cursor.execute.assert_called_once_with(to_plain_query(QUERY), {"1": 1, "2": "url"})
+    assert cursor.connection.prepared_statements == set()
+
+
+def test_to_plain_query_keeps_repeated_parameters():
+    assert to_plain_query("WHERE ($1::BOOLEAN IS NULL OR used = $1) LIMIT $12") == \
+           "WHERE (%(1)s::BOOLEAN IS NULL OR used = %(1)s) LIMIT %(12)s"
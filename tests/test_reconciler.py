@@ -0,0 +1,176 @@
+import os
+import subprocess
+import sys
+import pytest
+from unittest.mock import patch, MagicMock
+from database.database_manager import DatabaseManager
+from outline import reconciler
+from outline.client import OutlineAPIError
+from outline.reconciler import key_ids_digest, exceeds_repair_limit, reconcile_server, reconcile, parse_arguments
+
+SERVER = {"id": 1, "api_url": "http://one.example.com/api"}
+
+
+def outline_keys(*key_ids, name_prefix="shadowtrail:"):
+    return [{"id": str(key_id), "name": f"{name_prefix}uuid{key_id}", "accessUrl": "url"} for key_id in key_ids]
+
+
+@pytest.fixture(autouse=True)
+def clear_previous_differences():
+    reconciler._previous_differences.clear()
+    yield
+    reconciler._previous_differences.clear()
+
+
+@pytest.fixture
+def mock_db_instance():
+    with patch('outline.reconciler.DatabaseManager') as mock_db_manager:
+        yield mock_db_manager.return_value
+
+
+@pytest.fixture
+def mock_client():
+    with patch('outline.reconciler.get_client') as mock_get_client:
+        yield mock_get_client.return_value
+
+
+def test_key_ids_digest_sorts_numerically():
+    assert key_ids_digest({10, 9}) == key_ids_digest({9, 10})
+    assert key_ids_digest({9, 10}) != key_ids_digest({9, 1, 0})
+
+
+def test_exceeds_repair_limit():
+    assert exceeds_repair_limit(10, 5) is False
+    assert exceeds_repair_limit(11, 5) is True
+    assert exceeds_repair_limit(20, 100, max_fraction=0.2) is False
+    assert exceeds_repair_limit(21, 100, max_fraction=0.2) is True
+
+
+def test_server_in_sync_is_checked_by_digest(mock_db_instance, mock_client):
+    mock_client.list_access_keys.return_value = outline_keys(1, 2) + outline_keys(3, name_prefix="manual:")
+    mock_db_instance.get_outline_key_digest.return_value = (2, key_ids_digest({1, 2}))
+
+    report = reconcile_server(SERVER, repair=True)
+
+    assert report["in_sync"] is True and report["database_keys"] == 2
+    mock_db_instance.get_outline_key_ids.assert_not_called()
+    mock_db_instance.delete_dead_keys.assert_not_called()
+
+
+@patch('outline.reconciler.delete_access_key')
+def test_differences_are_reported(mock_delete_access_key, mock_db_instance, mock_client):
+    # key 4 was renamed by hand, it is neither orphaned nor dead
+    mock_client.list_access_keys.return_value = outline_keys(1, 2, 3) + outline_keys(4, name_prefix="manual:")
+    mock_db_instance.get_outline_key_digest.return_value = (3, "digest")
+    mock_db_instance.get_outline_key_ids.return_value = {1, 4, 5}
+
+    report = reconcile_server(SERVER, repair=False)
+
+    assert report["in_sync"] is False
+    assert (report["orphaned"], report["dead"]) == ([2, 3], [5])
+    mock_db_instance.delete_dead_keys.assert_not_called()
+    mock_delete_access_key.assert_not_called()
+
+
+@patch('outline.reconciler.delete_access_key')
+def test_differences_are_repaired_after_two_passes(mock_delete_access_key, mock_db_instance, mock_client):
+    mock_client.list_access_keys.return_value = outline_keys(1, 2, 3)
+    mock_db_instance.get_outline_key_digest.return_value = (3, "digest")
+    mock_db_instance.get_outline_key_ids.return_value = {1, 5, 6}
+    mock_db_instance.delete_dead_keys.return_value = ([{"uuid": "uuid5", "id": 5}], [{"uuid": "uuid6", "id": 6}])
+    mock_delete_access_key.return_value = None
+
+    first = reconcile_server(SERVER, repair=True)
+    assert first["deleted_on_server"] == first["deleted_in_database"] == []
+    mock_db_instance.delete_dead_keys.assert_not_called()
+
+    # key 3 has been stored in the meantime, only differences seen twice are repaired
+    mock_db_instance.get_outline_key_ids.return_value = {1, 3, 5, 6}
+    second = reconcile_server(SERVER, repair=True)
+
+    mock_db_instance.delete_dead_keys.assert_called_once_with(1, [5, 6])
+    mock_delete_access_key.assert_called_once_with(SERVER["api_url"], "2")
+    assert second["deleted_on_server"] == [2]
+    assert second["deleted_in_database"] == [5]
+    assert second["dead_in_use"] == [{"uuid": "uuid6", "id": 6}]
+    # the dead key in use is still a difference, the next pass reports it again
+    assert reconciler._previous_differences[1] == {"orphaned": set(), "dead": {6}}
+
+
+@patch('outline.reconciler.delete_access_key')
+def test_failed_deletes_are_not_reported_as_repaired(mock_delete_access_key, mock_db_instance, mock_client):
+    mock_client.list_access_keys.return_value = outline_keys(1, 2)
+    mock_db_instance.get_outline_key_digest.return_value = (0, "digest")
+    mock_db_instance.get_outline_key_ids.return_value = set()
+    mock_delete_access_key.side_effect = lambda api_url, key_id: "Request timed out" if key_id == "1" else None
+
+    reconcile_server(SERVER, repair=True)
+    report = reconcile_server(SERVER, repair=True)
+
+    assert report["deleted_on_server"] == [2]
+    assert reconciler._previous_differences[1]["orphaned"] == {1}
+
+
+@patch('outline.reconciler.delete_access_key')
+def test_large_differences_are_not_repaired(mock_delete_access_key, mock_db_instance, mock_client):
+    mock_client.list_access_keys.return_value = outline_keys(*range(100))
+    mock_db_instance.get_outline_key_digest.return_value = (100, "digest")
+    mock_db_instance.get_outline_key_ids.return_value = set(range(30, 130))
+
+    reconcile_server(SERVER, repair=True)
+    report = reconcile_server(SERVER, repair=True)
+
+    assert len(report["orphaned"]) == len(report["dead"]) == 30
+    mock_delete_access_key.assert_not_called()
+    mock_db_instance.delete_dead_keys.assert_not_called()
+
+
+@patch('outline.reconciler.reconcile_server')
+def test_reconcile_skips_unreachable_servers(mock_reconcile_server, mock_db_instance):
+    mock_db_instance.try_advisory_lock.return_value = True
+    mock_db_instance.get_servers_to_check.return_value = [SERVER, {"id": 2, "api_url": "http://two.example.com/api"}]
+    report = {"server_id": 1, "in_sync": True, "database_keys": 0}
+    mock_reconcile_server.side_effect = [report, OutlineAPIError("Request timed out")]
+
+    assert reconcile(repair=False) == [report]
+    mock_db_instance.advisory_unlock.assert_called_once()
+
+
+@patch('outline.reconciler.reconcile_server')
+def test_reconcile_skips_when_locked_by_another_instance(mock_reconcile_server, mock_db_instance):
+    mock_db_instance.try_advisory_lock.return_value = False
+
+    assert reconcile() is None
+    mock_reconcile_server.assert_not_called()
+
+
+def make_db_manager(rows):
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    db_manager.cursor.fetchall.return_value = rows
+    return db_manager
+
+
+def test_delete_dead_keys_keeps_referenced_keys():
+    db_manager = make_db_manager([("uuid5", 5, True), ("uuid6", 6, False)])
+
+    deleted, kept = db_manager.delete_dead_keys(1, [5, 6])
+
+    assert (deleted, kept) == ([{"uuid": "uuid5", "id": 5}], [{"uuid": "uuid6", "id": 6}])
+    assert db_manager.cursor.execute.call_args[0][1] == {"server_id": 1, "key_ids": [5, 6]}
+
+
+def test_parse_arguments():
+    assert parse_arguments([]).once is False
+    assert parse_arguments(["--once"]).once is True
+    with pytest.raises(SystemExit):
+        parse_arguments(["--repair"])
+
+
+def test_command_line_help():
+    # the command of the reconciler service in docker-compose.yml
+    result = subprocess.run([sys.executable, "-m", "outline.reconciler", "--help"], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.dirname(__file__)))
+
+    assert result.returncode == 0, result.stderr
+    assert "--once" in result.stdout
@@ -0,0 +1,98 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from database.reference_data import ReferenceDataRegistry, ReferenceDataSnapshot
+from database.database_manager import DatabaseManager
+
+LOCATIONS = [
+    (1, "Austria", "Австрия", "AT", True),
+    (2, "Belgium", "Бельгия", "BE", False),
+]
+PROVIDERS = [1, 2]
+SERVERS = [(1, "https://example.com:1234/secret", "1.8.1")]
+
+
+@pytest.fixture
+def registry():
+    registry = ReferenceDataRegistry()
+    with patch.object(registry, "_load", return_value=ReferenceDataSnapshot(LOCATIONS, PROVIDERS, SERVERS)), \
+            patch.object(registry, "_start_listener"):
+        yield registry
+
+
+@pytest.fixture
+def db_manager(registry):
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    with patch('database.database_manager.get_reference_data', return_value=registry):
+        yield db_manager
+
+
+def test_registry_lookups(registry):
+    assert registry.location_exists("Austria")
+    assert not registry.location_exists("Narnia")
+    assert registry.get_location_id("Belgium") == 2
+    assert registry.provider_exists(2)
+    assert not registry.provider_exists(3)
+    assert registry.server_exists(1)
+    assert not registry.server_exists(2)
+    assert registry.get_server_api_url(1) == "https://example.com:1234/secret"
+    assert registry.get_server_api_url(2) is None
+    assert registry.get_server_api_version(1) == "1.8.1"
+
+
+@pytest.mark.parametrize("active_servers, expected", [
+    (None, ["Austria", "Belgium"]),
+    (True, ["Austria"]),
+    (False, ["Belgium"]),
+])
+def test_registry_get_locations(registry, active_servers, expected):
+    locations = registry.get_locations(active_servers)
+
+    assert [location["location"] for location in locations] == expected
+    # Callers get copies, the snapshot can't be modified through them
+    locations[0]["location"] = "Narnia"
+    assert not registry.location_exists("Narnia")
+    assert registry.get_locations(active_servers)[0]["location"] == expected[0]
+
+
+def test_registry_loads_once_and_reload_swaps_snapshot(registry):
+    registry.snapshot
+    registry.snapshot
+    assert registry._load.call_count == 1
+    registry._start_listener.assert_called_once()
+
+    registry._load.return_value = ReferenceDataSnapshot(LOCATIONS[:1], PROVIDERS, [])
+    registry.reload()
+
+    assert not registry.location_exists("Belgium")
+    assert not registry.server_exists(1)
+
+
+def test_database_manager_lookups_use_registry(db_manager):
+    assert db_manager.location_exists("Austria")
+    assert db_manager.check_server_exists_using_id(1)
+    assert db_manager.get_server_api_url(1) == "https://example.com:1234/secret"
+    assert db_manager.get_locations(active_servers=True) == [
+        {"location": "Austria", "location_ru": "Австрия", "iso": "AT"}
+    ]
+    db_manager._cursor.execute.assert_not_called()
+
+
+def test_create_outline_server_reloads_registry(db_manager, registry):
+    db_manager._cursor.fetchone.return_value = (7,)
+
+    with patch.object(registry, "reload") as reload:
+        assert db_manager.create_outline_server("example.com", 1234, "https://example.com:1234/new",
+                                                "Belgium", 1) == 7
+
+    reload.assert_called_once()
+    server_info_params = db_manager._cursor.execute.call_args_list[-1][0][1]
+    assert server_info_params == (7, 2, 1)
+
+
+def test_create_outline_server_unknown_provider(db_manager):
+    with pytest.raises(ValueError):
+        db_manager.create_outline_server("example.com", 1234, "https://example.com:1234/new", "Belgium", 3)
+
+    db_manager._cursor.execute.assert_not_called()
+    db_manager._conn.rollback.assert_called_once()
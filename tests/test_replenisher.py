@@ -0,0 +1,92 @@
+from unittest.mock import patch, MagicMock
+from outline import replenisher
+from outline.replenisher import plan_server, run_cycle, check_key_counters
+
+PLAN_SETTINGS = {"window_hours": 24, "lead_time_hours": 6, "min_unused_keys": 10, "max_unused_keys": 500,
+                 "trim_factor": 3, "max_keys_per_cycle": 100}
+
+
+def test_plan_server_tops_up_to_minimum_without_demand():
+    plan = plan_server(unused_keys=4, recent_allocations=0, **PLAN_SETTINGS)
+
+    assert plan["hours_to_depletion"] is None
+    assert plan["low_watermark"] == 10
+    assert (plan["create"], plan["delete"]) == (6, 0)
+
+
+def test_plan_server_forecasts_demand_from_allocation_rate():
+    # 240 allocations a day = 10 keys/hour, 6 hours of lead time need 60 spare keys
+    plan = plan_server(unused_keys=20, recent_allocations=240, **PLAN_SETTINGS)
+
+    assert plan["allocation_rate"] == 10
+    assert plan["hours_to_depletion"] == 2
+    assert plan["low_watermark"] == 60
+    assert (plan["create"], plan["delete"]) == (40, 0)
+
+
+def test_plan_server_caps_keys_per_cycle():
+    plan = plan_server(unused_keys=0, recent_allocations=24000, **PLAN_SETTINGS)
+
+    assert plan["low_watermark"] == 500
+    assert plan["create"] == 100
+
+
+def test_plan_server_trims_only_above_high_watermark():
+    assert plan_server(unused_keys=30, recent_allocations=0, **PLAN_SETTINGS)["delete"] == 0
+
+    plan = plan_server(unused_keys=45, recent_allocations=0, **PLAN_SETTINGS)
+    assert plan["high_watermark"] == 30
+    assert (plan["create"], plan["delete"]) == (0, 15)
+
+
+@patch('outline.replenisher.delete_access_key')
+@patch('outline.replenisher.provision_and_store_keys')
+@patch('outline.replenisher.DatabaseManager')
+def test_run_cycle_tops_up_and_trims_servers(mock_db_manager, mock_provision, mock_delete_access_key):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.try_advisory_lock.return_value = True
+    mock_db_instance.get_key_inventory.return_value = [
+        {"id": 1, "api_url": "http://one.example.com/api", "unused_keys": 0, "recent_allocations": 0},
+        {"id": 2, "api_url": "http://two.example.com/api", "unused_keys": 1000, "recent_allocations": 0},
+    ]
+    mock_db_instance.delete_unused_keys.return_value = [{"uuid": "uuid1", "id": "1"}]
+    mock_provision.return_value = ([], [])
+    mock_delete_access_key.return_value = None
+
+    assert run_cycle() is True
+
+    assert mock_provision.call_args.args[1:] == (1, "http://one.example.com/api", 10)
+    mock_db_instance.delete_unused_keys.assert_called_once_with(2, 100)
+    mock_delete_access_key.assert_called_once_with("http://two.example.com/api", "1")
+    mock_db_instance.advisory_unlock.assert_called_once()
+
+
+@patch('outline.replenisher.provision_and_store_keys')
+@patch('outline.replenisher.DatabaseManager')
+def test_run_cycle_skips_when_locked_by_another_instance(mock_db_manager, mock_provision):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.try_advisory_lock.return_value = False
+
+    assert run_cycle() is False
+
+    mock_db_instance.get_key_inventory.assert_not_called()
+    mock_provision.assert_not_called()
+
+
+@patch('outline.replenisher._last_counter_check', None)
+def test_check_key_counters_repairs_at_most_once_per_interval():
+    db_manager = MagicMock()
+    db_manager.repair_server_key_counters.return_value = [
+        {"server_id": 1, "unused_keys_drift": 2, "used_keys_drift": -2}
+    ]
+
+    check_key_counters(db_manager, interval=3600)
+    check_key_counters(db_manager, interval=3600)
+    db_manager.repair_server_key_counters.assert_called_once()
+
+    replenisher._last_counter_check -= 3600
+    check_key_counters(db_manager, interval=3600)
+    assert db_manager.repair_server_key_counters.call_count == 2
+
+    check_key_counters(db_manager, interval=0)
+    assert db_manager.repair_server_key_counters.call_count == 2
@@ -0,0 +1,128 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from database.server_selection import ServerSelector, server_weight
+from database.database_manager import DatabaseManager
+
+SERVERS = [
+    {"id": 1, "location": "Austria", "unused_keys": 50, "used_keys": 10, "latency_ms": 100.0},
+    {"id": 2, "location": "Austria", "unused_keys": 50, "used_keys": 100, "latency_ms": None},
+    {"id": 3, "location": "Belgium", "unused_keys": 5, "used_keys": 0, "latency_ms": 100.0},
+]
+
+
+@pytest.fixture
+def load_servers():
+    return MagicMock(side_effect=lambda: [dict(server) for server in SERVERS])
+
+
+def test_server_weight_ordering():
+    assert server_weight(0, 0, 100.0) == 0
+    # fewer active keys, more spare keys and a faster API each weigh more
+    assert server_weight(50, 10, 100.0) > server_weight(50, 100, 100.0)
+    assert server_weight(50, 10, 100.0) > server_weight(2, 10, 100.0)
+    assert server_weight(50, 10, 100.0) > server_weight(50, 10, 2000.0)
+    # unknown latency counts as the reference latency
+    assert server_weight(50, 10, None, latency_reference_ms=500) == server_weight(50, 10, 500.0,
+                                                                                 latency_reference_ms=500)
+
+
+def test_pick_is_weighted_within_location(load_servers):
+    selector = ServerSelector(refresh_interval=60)
+
+    with patch('database.server_selection.random.choices', side_effect=lambda candidates, weights: [
+            candidates[weights.index(max(weights))]]) as choices:
+        assert selector.pick("Austria", load_servers) == 1
+
+    candidates, weights = choices.call_args[0]
+    assert [server["id"] for server in candidates] == [1, 2]
+    assert weights[0] > weights[1] > 0
+    assert selector.pick("Narnia", load_servers) is None
+
+
+def test_pick_counts_assignments_until_refresh(load_servers):
+    selector = ServerSelector(refresh_interval=60)
+
+    # the only Belgian server runs out of spare keys after 5 picks
+    assert [selector.pick("Belgium", load_servers) for _ in range(6)] == [3, 3, 3, 3, 3, None]
+    load_servers.assert_called_once()
+
+    selector.invalidate()
+    assert selector.pick("Belgium", load_servers) == 3
+    assert load_servers.call_count == 2
+
+
+def test_pick_reloads_after_refresh_interval(load_servers):
+    selector = ServerSelector(refresh_interval=10)
+
+    with patch('database.server_selection.time.monotonic', return_value=100.0):
+        selector.pick("Austria", load_servers)
+    with patch('database.server_selection.time.monotonic', return_value=105.0):
+        selector.pick("Austria", load_servers)
+    assert load_servers.call_count == 1
+
+    with patch('database.server_selection.time.monotonic', return_value=111.0):
+        selector.pick("Austria", load_servers)
+    assert load_servers.call_count == 2
+
+
+@patch('database.database_manager.get_server_selector')
+def test_insert_dynamic_key_uses_selected_server(mock_get_server_selector):
+    mock_get_server_selector.return_value.pick.return_value = 2
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # rows are (dynamic_key_exists, outline_key_used, id)
+    db_manager.cursor.fetchone.return_value = (False, False, 100000001)
+
+    assert db_manager.insert_dynamic_key(1, location="Austria") == ("created", 100000001)
+
+    params = db_manager.cursor.execute.call_args[0][1]
+    assert (params["server_id"], params["location"]) == (2, "Austria")
+    assert db_manager.cursor.execute.call_count == 1
+
+
+@patch('database.database_manager.get_server_selector')
+def test_insert_dynamic_key_falls_back_to_location(mock_get_server_selector):
+    mock_get_server_selector.return_value.pick.return_value = 2
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # the picked server ran out of spare keys since the scores were loaded
+    db_manager.cursor.fetchone.side_effect = [(False, None, None), (False, False, 100000001)]
+
+    assert db_manager.insert_dynamic_key(1, location="Austria") == ("created", 100000001)
+
+    params = [call[0][1] for call in db_manager.cursor.execute.call_args_list]
+    assert [(p["server_id"], p["location"]) for p in params] == [(2, "Austria"), (None, "Austria")]
+
+
+@patch('database.database_manager.get_server_selector')
+def test_insert_dynamic_keys_falls_back_to_location(mock_get_server_selector):
+    mock_get_server_selector.return_value.pick.side_effect = [2, 3]
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # rows are (position, dynamic_key_exists, outline_key_used, id)
+    db_manager.cursor.fetchall.side_effect = [
+        [(0, False, False, 100000001)],
+        [(1, False, None, None)],
+        [(1, False, False, 100000002)],
+    ]
+
+    results = db_manager.insert_dynamic_keys([
+        {"tg_user_id": 1, "location": "Austria"},
+        {"tg_user_id": 2, "location": "Austria"},
+    ])
+
+    assert results == [("created", 100000001), ("created", 100000002)]
+    params = [call[0][1] for call in db_manager.cursor.execute.call_args_list]
+    assert [(p["positions"], p["server_id"]) for p in params] == [([0], 2), ([1], 3), ([1], None)]
+    db_manager.conn.commit.assert_called_once()
+
+
+def test_record_server_latency_is_smoothed():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+
+    db_manager.record_server_latency(1, 250.0)
+
+    query, params = db_manager.cursor.execute.call_args[0]
+    assert "COALESCE" in query
+    assert params == {"server_id": 1, "latency_ms": 250.0, "smoothing": 0.3}
@@ -0,0 +1,150 @@
+import os
+import psycopg2
+import pytest
+from unittest.mock import patch, MagicMock
+from app import app
+from database.database_manager import DatabaseManager
+import base64
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD, POSTGRES_CREDENTIALS
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+
+
+@pytest.fixture
+def auth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # Encode credentials
+        credentials = base64.b64encode(f"{BASIC_AUTH_USERNAME}:{BASIC_AUTH_PASSWORD}".encode()).decode('utf-8')
+        # Set the Authorization header for all requests
+        test_client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+        yield test_client
+
+
+@pytest.fixture
+def unauth_client():
+    app.config['TESTING'] = True
+    with app.test_client() as test_client:
+        # No Authorization header
+        yield test_client
+
+
+def test_evacuate_server_error_unauthorized_access(unauth_client):
+    response = unauth_client.post("/servers/1/evacuate")
+    assert response.status_code == 401
+
+
+@patch('routes.servers.DatabaseManager')
+def test_evacuate_server_success(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.evacuate_server.return_value = {"moved": 40, "remaining": 2}
+
+    response = auth_client.post("/servers/1/evacuate")
+
+    assert response.status_code == 200
+    assert response.json == {"server_id": 1, "moved": 40, "remaining": 2}
+    mock_db_instance.evacuate_server.assert_called_once_with(1, True, None)
+
+
+@patch('routes.servers.DatabaseManager')
+def test_evacuate_server_without_draining(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.evacuate_server.return_value = {"moved": 10, "remaining": 30}
+
+    response = auth_client.post("/servers/1/evacuate", json={"drain": False, "limit": 10})
+
+    assert response.status_code == 200
+    mock_db_instance.evacuate_server.assert_called_once_with(1, False, 10)
+
+
+@pytest.mark.parametrize("data, error", [
+    ({"drain": "yes"}, "Invalid 'drain' parameter. It must be a boolean."),
+    ({"limit": 0}, "Invalid 'limit' parameter. It must be a positive integer."),
+    ({"limit": True}, "Invalid 'limit' parameter. It must be a positive integer."),
+])
+@patch('routes.servers.DatabaseManager')
+def test_evacuate_server_error_invalid_params(mock_db_manager, auth_client, data, error):
+    response = auth_client.post("/servers/1/evacuate", json=data)
+
+    assert response.status_code == 400
+    assert response.json == {"error": error}
+    mock_db_manager.return_value.evacuate_server.assert_not_called()
+
+
+@patch('routes.servers.DatabaseManager')
+def test_evacuate_server_error_server_not_found(mock_db_manager, auth_client):
+    mock_db_manager.return_value.check_server_exists_using_id.return_value = False
+
+    response = auth_client.post("/servers/1/evacuate")
+
+    assert response.status_code == 404
+    assert response.json == {"error": "Server not found"}
+
+
+@patch('routes.servers.DatabaseManager')
+def test_evacuate_server_error_internal_error(mock_db_manager, auth_client):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_id.return_value = True
+    mock_db_instance.evacuate_server.side_effect = Exception("Internal error")
+
+    response = auth_client.post("/servers/1/evacuate")
+
+    assert response.status_code == 500
+    assert response.json == {"error": "An unexpected error occurred", "details": "Internal error"}
+
+
+def test_evacuate_server_invalidates_moved_keys():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    # rows are (active dynamic keys on the server before the move, moved key id, tg_user_id)
+    db_manager.cursor.fetchall.return_value = [(3, 100000001, 7), (3, 100000002, 8)]
+
+    with patch.object(DatabaseManager, "invalidate_dynamic_keys") as invalidate, \
+            patch('database.database_manager.get_reference_data') as get_reference_data:
+        assert db_manager.evacuate_server(1) == {"moved": 2, "remaining": 1}
+
+    invalidate.assert_called_once_with([(100000001, 7), (100000002, 8)])
+    get_reference_data.return_value.reload.assert_called_once()
+
+    # Nothing to move, the statement still returns the count
+    db_manager.cursor.fetchall.return_value = [(0, None, None)]
+    with patch('database.database_manager.get_reference_data'):
+        assert db_manager.evacuate_server(1, drain=False) == {"moved": 0, "remaining": 0}
+
+
+@pytest.fixture
+def schema_db_manager():
+    # the tables of database/database.sql in a schema of their own, on a real database
+    try:
+        conn = psycopg2.connect(**POSTGRES_CREDENTIALS)
+    except psycopg2.OperationalError:
+        pytest.skip("no database available")
+    conn.autocommit = True
+    with conn.cursor() as cursor, open(os.path.join(ROOT, "database", "database.sql")) as f:
+        cursor.execute("DROP SCHEMA IF EXISTS evacuate_test CASCADE; CREATE SCHEMA evacuate_test; "
+                       "SET search_path TO evacuate_test;")
+        cursor.execute(f.read())
+    db_manager = DatabaseManager()
+    db_manager._conn = conn
+    yield db_manager
+    with conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA evacuate_test CASCADE;")
+    conn.close()
+
+
+def test_drain_of_health_deactivated_server_is_not_undone_by_recovery(schema_db_manager):
+    db_manager = schema_db_manager
+    db_manager.cursor.execute("INSERT INTO outline_server (id, hostname, port, api_url, is_active, health_history, "
+                              "health_deactivated) VALUES (1, 'one.example.com', 443, 'http://one', FALSE, 0, TRUE);")
+
+    with patch('database.database_manager.get_reference_data'):
+        assert db_manager.evacuate_server(1) == {"moved": 0, "remaining": 0}
+        # the server answers again, it stays drained
+        for _ in range(3):
+            assert db_manager.record_health_checks([{"server_id": 1, "healthy": True, "latency_ms": 10.0}],
+                                                   failure_threshold=3, recovery_threshold=3) == []
+
+    db_manager.cursor.execute("SELECT is_active, health_deactivated FROM outline_server WHERE id = 1;")
+    assert db_manager.cursor.fetchone() == (False, False)
@@ -37,8 +37,8 @@ def test_get_servers_success(mock_db_manager, auth_client):
     mock_db_instance.get_servers.return_value = {
         "total_count": 2,
         "servers": [
-            {"id": 1, "location": "test_location1", "unused_keys": 2},
-            {"id": 2, "location": "test_location2", "unused_keys": 0}
+            {"id": 1, "location": "test_location1", "unused_keys": 2, "used_keys": 5},
+            {"id": 2, "location": "test_location2", "unused_keys": 0, "used_keys": 0}
         ]
     }
 
@@ -50,8 +50,8 @@ def test_get_servers_success(mock_db_manager, auth_client):
     assert response.json == {
         "total_count": 2,
         "servers": [
-            {"id": 1, "location": "test_location1", "unused_keys": 2},
-            {"id": 2, "location": "test_location2", "unused_keys": 0}
+            {"id": 1, "location": "test_location1", "unused_keys": 2, "used_keys": 5},
+            {"id": 2, "location": "test_location2", "unused_keys": 0, "used_keys": 0}
         ]
     }
 
@@ -1,9 +1,15 @@
+import os
+import psycopg2
 import pytest
 from unittest.mock import patch, MagicMock
 from app import app
 import json
 import base64
-from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD
+from config import BASIC_AUTH_USERNAME, BASIC_AUTH_PASSWORD, POSTGRES_CREDENTIALS
+from database.database_manager import DatabaseManager
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+from outline.client import OutlineAPIError
 
 
 @pytest.fixture
@@ -35,13 +41,13 @@ def test_post_outline_keys_error_unauthorized_access(unauth_client):
     assert response.status_code == 401
 
 
-@patch('routes.servers.requests.get')
+@patch('routes.servers.probe_server')
 @patch('routes.servers.DatabaseManager')
-def test_post_servers_success(mock_db_manager, mock_get, auth_client):
+def test_post_servers_success(mock_db_manager, mock_probe_server, auth_client):
     # Mock the external API request with a successful response
-    mock_get.return_value = MagicMock(status_code=200, json=lambda: {
+    mock_probe_server.return_value = {
         "hostnameForAccessKeys": "test-hostname", "portForNewAccessKeys": 1234
-    })
+    }
 
     # Mock the database manager to simulate successful creation
     mock_db_instance = mock_db_manager.return_value
@@ -57,6 +63,8 @@ def test_post_servers_success(mock_db_manager, mock_get, auth_client):
     response = auth_client.post("/servers", data=json.dumps(data), content_type='application/json')
     assert response.status_code == 201
     assert "id" in response.json
+    # no version in the server information, capabilities are detected by the client later
+    assert mock_db_instance.create_outline_server.call_args.kwargs["api_version"] is None
 
 
 @pytest.mark.parametrize("missing_key", ["api_url", "location", "provider_id"])
@@ -125,14 +133,14 @@ def test_post_servers_error_invalid_api_url_scheme(auth_client, invalid_scheme):
     assert response.json == {"error": "Invalid URL scheme"}
 
 
-@patch('routes.servers.requests.get')
+@patch('routes.servers.probe_server')
 @patch('routes.servers.DatabaseManager')
-def test_post_servers_error_duplicate_api_url(mock_db_manager, mock_get, auth_client):
+def test_post_servers_error_duplicate_api_url(mock_db_manager, mock_probe_server, auth_client):
 
     # Mock the external API request with a successful response
-    mock_get.return_value = MagicMock(status_code=200, json=lambda: {
+    mock_probe_server.return_value = {
         "hostnameForAccessKeys": "test-hostname", "portForNewAccessKeys": 1234
-    })
+    }
 
     mock_db_instance = mock_db_manager.return_value
     mock_db_instance.check_server_exists_using_api_url.return_value = True
@@ -148,10 +156,10 @@ def test_post_servers_error_duplicate_api_url(mock_db_manager, mock_get, auth_cl
     assert response.json == {"error": "Server with provided api_url already exists in database"}
 
 
-@patch('routes.servers.requests.get')
-def test_post_servers_error_external_request_error(mock_get, auth_client):
+@patch('routes.servers.probe_server')
+def test_post_servers_error_external_request_error(mock_probe_server, auth_client):
 
-    mock_get.return_value = MagicMock(status_code=404)
+    mock_probe_server.side_effect = OutlineAPIError("404 Client Error", 404)
 
     data = {
         "api_url": "http://example.com/api",
@@ -164,14 +172,30 @@ def test_post_servers_error_external_request_error(mock_get, auth_client):
     assert response.json == {"error": "Server was found but unexpected error occurred"}
 
 
-@patch('routes.servers.requests.get')
+@patch('routes.servers.probe_server')
+def test_post_servers_error_server_unreachable(mock_probe_server, auth_client):
+
+    mock_probe_server.side_effect = OutlineAPIError("Request timed out")
+
+    data = {
+        "api_url": "http://example.com/api",
+        "location": "example_location",
+        "provider_id": 1
+    }
+
+    response = auth_client.post("/servers", data=json.dumps(data), content_type='application/json')
+    assert response.status_code == 500
+    assert response.json == {"error": "An unexpected error occurred", "details": "Request timed out"}
+
+
+@patch('routes.servers.probe_server')
 @patch('routes.servers.DatabaseManager')
-def test_post_servers_error_db_creation_error(mock_db_manager, mock_get, auth_client):
+def test_post_servers_error_db_creation_error(mock_db_manager, mock_probe_server, auth_client):
 
     # Mock the external API request with a successful response
-    mock_get.return_value = MagicMock(status_code=200, json=lambda: {
+    mock_probe_server.return_value = {
         "hostnameForAccessKeys": "test-hostname", "portForNewAccessKeys": 1234
-    })
+    }
 
     # Mock the database manager to simulate successful creation
     mock_db_instance = mock_db_manager.return_value
@@ -187,3 +211,55 @@ def test_post_servers_error_db_creation_error(mock_db_manager, mock_get, auth_cl
     response = auth_client.post("/servers", data=json.dumps(data), content_type='application/json')
     assert response.status_code == 500
     assert response.json == {"error": "Failed to create outline server", "details": "DB error"}
+
+
+@patch('routes.servers.probe_server')
+@patch('routes.servers.DatabaseManager')
+def test_post_servers_error_registered_concurrently(mock_db_manager, mock_probe_server, auth_client):
+    mock_probe_server.return_value = {"hostnameForAccessKeys": "test-hostname", "portForNewAccessKeys": 1234}
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.check_server_exists_using_api_url.return_value = False
+    # another request registered the server after the check, the unique api_url rejected this one
+    mock_db_instance.create_outline_server.return_value = None
+
+    data = {"api_url": "http://example.com/api", "location": "example_location", "provider_id": 1}
+    response = auth_client.post("/servers", data=json.dumps(data), content_type='application/json')
+
+    assert response.status_code == 409
+    assert response.json == {"error": "Server with provided api_url already exists in database"}
+
+
+@pytest.fixture
+def schema_db_manager():
+    # the tables of database/database.sql in a schema of their own, on a real database
+    try:
+        conn = psycopg2.connect(**POSTGRES_CREDENTIALS)
+    except psycopg2.OperationalError:
+        pytest.skip("no database available")
+    conn.autocommit = True
+    with conn.cursor() as cursor, open(os.path.join(ROOT, "database", "database.sql")) as f:
+        cursor.execute("DROP SCHEMA IF EXISTS servers_test CASCADE; CREATE SCHEMA servers_test; "
+                       "SET search_path TO servers_test;")
+        cursor.execute(f.read())
+        cursor.execute("INSERT INTO server_provider (id, provider) VALUES (1, 'provider');")
+    db_manager = DatabaseManager()
+    db_manager._conn = conn
+    yield db_manager
+    with conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA servers_test CASCADE;")
+    conn.close()
+
+
+def test_create_outline_server_rejects_registered_api_url(schema_db_manager):
+    db_manager = schema_db_manager
+    db_manager.cursor.execute("SELECT id FROM server_location LIMIT 1;")
+    location_id = db_manager.cursor.fetchone()[0]
+
+    with patch('database.database_manager.get_reference_data') as get_reference_data, \
+            patch('database.database_manager.get_server_selector'):
+        get_reference_data.return_value.get_location_id.return_value = location_id
+        assert db_manager.create_outline_server("one.example.com", 443, "http://one", "Austria", 1) is not None
+        assert db_manager.create_outline_server("one.example.com", 443, "http://one", "Austria", 1) is None
+
+    assert db_manager.check_server_exists_using_api_url("http://one")
+    assert db_manager.conn.autocommit is True
@@ -0,0 +1,191 @@
+import os
+import psycopg2
+import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch, MagicMock
+from config import POSTGRES_CREDENTIALS
+from database.database_manager import DatabaseManager
+from outline.client import OutlineAPIError
+from outline.transfer_metrics import fetch_transfer, fetch_all_transfer, run_cycle
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+SERVERS = [{"id": 1, "api_url": "http://one.example.com/api"}, {"id": 2, "api_url": "http://two.example.com/api"}]
+
+
+@patch('outline.transfer_metrics.get_client')
+def test_fetch_transfer(mock_get_client):
+    mock_get_client.return_value.get_transfer_metrics.return_value = {"1": 100, "2": 0}
+
+    assert fetch_transfer(SERVERS[0]["api_url"], timeout=5) == {1: 100, 2: 0}
+    mock_get_client.return_value.get_transfer_metrics.assert_called_once_with(timeout=5)
+
+    mock_get_client.return_value.get_transfer_metrics.side_effect = OutlineAPIError("Request timed out")
+    assert fetch_transfer(SERVERS[0]["api_url"]) is None
+
+
+@patch('outline.transfer_metrics.fetch_transfer')
+def test_fetch_all_transfer_keeps_order(mock_fetch_transfer):
+    mock_fetch_transfer.side_effect = lambda api_url: None if "two" in api_url else {1: 100}
+
+    assert fetch_all_transfer(SERVERS) == [{1: 100}, None]
+    assert fetch_all_transfer([]) == []
+
+
+@patch('outline.transfer_metrics.fetch_all_transfer')
+@patch('outline.transfer_metrics.DatabaseManager')
+def test_run_cycle_stores_deltas_and_rolls_up(mock_db_manager, mock_fetch_all_transfer):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.try_advisory_lock.return_value = True
+    mock_db_instance.get_servers_to_check.return_value = SERVERS
+    mock_db_instance.expire_transfer_metrics.return_value = []
+    mock_fetch_all_transfer.return_value = [{1: 150, 2: 10}, None]
+
+    assert run_cycle() is True
+
+    # the unreachable server keeps its last report
+    sampled_at, reports = mock_db_instance.store_transfer_reports.call_args.args
+    assert reports == {1: {1: 150, 2: 10}}
+    assert sampled_at.tzinfo is timezone.utc
+    first_day, last_day = mock_db_instance.create_transfer_sample_partitions.call_args.args
+    assert first_day == sampled_at.date() and (last_day - first_day).days == 1
+    hourly_since, daily_since = mock_db_instance.rollup_transfer.call_args.args
+    assert hourly_since.minute == 0 and daily_since.hour == 0
+    mock_db_instance.advisory_unlock.assert_called_once()
+
+
+@patch('outline.transfer_metrics.fetch_all_transfer')
+@patch('outline.transfer_metrics.DatabaseManager')
+def test_run_cycle_skips_store_without_reports(mock_db_manager, mock_fetch_all_transfer):
+    mock_db_instance = mock_db_manager.return_value
+    mock_db_instance.try_advisory_lock.return_value = True
+    mock_db_instance.get_servers_to_check.return_value = SERVERS
+    mock_db_instance.expire_transfer_metrics.return_value = ["transfer_sample_20260101"]
+    mock_fetch_all_transfer.return_value = [None, None]
+
+    assert run_cycle() is True
+
+    mock_db_instance.store_transfer_reports.assert_not_called()
+    mock_db_instance.rollup_transfer.assert_called_once()
+
+
+@patch('outline.transfer_metrics.fetch_all_transfer')
+@patch('outline.transfer_metrics.DatabaseManager')
+def test_run_cycle_skips_when_locked_by_another_instance(mock_db_manager, mock_fetch_all_transfer):
+    mock_db_manager.return_value.try_advisory_lock.return_value = False
+
+    assert run_cycle() is False
+
+    mock_fetch_all_transfer.assert_not_called()
+
+
+def make_db_manager():
+    db_manager = DatabaseManager()
+    db_manager._conn, db_manager._cursor = MagicMock(), MagicMock()
+    return db_manager
+
+
+def test_store_transfer_reports_copies_reports():
+    db_manager = make_db_manager()
+    db_manager.cursor.rowcount = 1
+    sampled_at = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    assert db_manager.store_transfer_reports(sampled_at, {1: {1: 150, 2: 10}, 2: {}}) == 1
+
+    copy_statement, rows = db_manager.cursor.copy_expert.call_args.args
+    assert copy_statement.startswith("COPY transfer_report_copy")
+    assert rows.getvalue() == "1\t1\t150\n1\t2\t10\n"
+    assert db_manager.cursor.execute.call_args.args[1] == {"sampled_at": sampled_at, "server_ids": [1, 2]}
+    db_manager.conn.commit.assert_called_once()
+    assert db_manager.conn.autocommit is True
+
+
+def test_store_transfer_reports_rolls_back_on_error():
+    db_manager = make_db_manager()
+    db_manager.cursor.copy_expert.side_effect = Exception("COPY failed")
+
+    with pytest.raises(Exception, match="COPY failed"):
+        db_manager.store_transfer_reports(datetime.now(timezone.utc), {1: {1: 50}})
+
+    db_manager.conn.rollback.assert_called_once()
+    assert db_manager.conn.autocommit is True
+
+
+@pytest.mark.parametrize("migration_name", ["012_transfer_metrics.sql", "014_transfer_last.sql"])
+def test_schema_creates_transfer_tables_like_migration(migration_name):
+    with open(os.path.join(ROOT, "database", "migrations", migration_name)) as migration, \
+            open(os.path.join(ROOT, "database", "database.sql")) as schema:
+        assert migration.read() in schema.read()
+
+
+@pytest.fixture
+def transfer_schema_conn():
+    # the transfer tables and functions of migrations 012 and 014 in a schema of their own, on a real database
+    try:
+        conn = psycopg2.connect(**POSTGRES_CREDENTIALS)
+    except psycopg2.OperationalError:
+        pytest.skip("no database available")
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA IF EXISTS transfer_metrics_test CASCADE; CREATE SCHEMA transfer_metrics_test; "
+                       "SET search_path TO transfer_metrics_test;")
+        cursor.execute("CREATE TABLE outline_key (uuid UUID PRIMARY KEY, id INTEGER, fk_outline_server_id INTEGER); "
+                       "CREATE TABLE dynamic_key (id BIGINT, fk_outline_key_uuid UUID, is_active BOOLEAN); "
+                       "INSERT INTO outline_key VALUES ('00000000-0000-0000-0000-000000000001', 1, 1); "
+                       "INSERT INTO dynamic_key VALUES (100000001, '00000000-0000-0000-0000-000000000001', TRUE);")
+        for migration_name in ["012_transfer_metrics.sql", "014_transfer_last.sql"]:
+            with open(os.path.join(ROOT, "database", "migrations", migration_name)) as f:
+                cursor.execute(f.read())
+    yield conn
+    with conn.cursor() as cursor:
+        cursor.execute("DROP SCHEMA transfer_metrics_test CASCADE;")
+    conn.close()
+
+
+@patch('outline.transfer_metrics.fetch_all_transfer')
+def test_run_cycle_twice_on_migration_schema(mock_fetch_all_transfer, transfer_schema_conn):
+
+    class SchemaDatabaseManager(DatabaseManager):
+        def __init__(self) -> None:
+            super().__init__()
+            self._conn = transfer_schema_conn
+
+        def get_servers_to_check(self) -> list[dict[str, any]]:
+            return SERVERS[:1]
+
+        def close(self) -> None:
+            self._cursor = None
+
+    mock_fetch_all_transfer.side_effect = [[{1: 100}], [{1: 150}], [{1: 175}]]
+    with patch('outline.transfer_metrics.DatabaseManager', SchemaDatabaseManager):
+        # partitions of today and tomorrow exist after the first round, the next ones create them again
+        assert run_cycle() is True
+        assert run_cycle() is True
+        assert run_cycle() is True
+
+    with transfer_schema_conn.cursor() as cursor:
+        cursor.execute("SELECT SUM(bytes), MIN(dynamic_key_id) FROM transfer_sample;")
+        assert cursor.fetchone() == (75, 100000001)
+        cursor.execute("SELECT SUM(bytes), SUM(samples) FROM transfer_daily;")
+        assert cursor.fetchone() == (75, 2)
+
+
+def test_collectors_taking_turns_continue_from_stored_report(transfer_schema_conn):
+
+    def collector():
+        # a collector process of its own, it keeps nothing between rounds
+        db_manager = DatabaseManager()
+        db_manager._conn = transfer_schema_conn
+        return db_manager
+
+    day = datetime.now(timezone.utc).date()
+    collector().create_transfer_sample_partitions(day, day)
+    rounds = [{1: {1: 100}}, {1: {1: 150}, 2: {1: 10}}, {1: {1: 140}, 2: {1: 30}}, {1: {}}, {1: {1: 20}}]
+    # key 1 of server 1 primes, grows by 50, decreases, leaves the window and comes back with 20
+    assert [collector().store_transfer_reports(datetime.now(timezone.utc), reports) for reports in rounds] == \
+        [0, 1, 0, 0, 1]
+
+    with transfer_schema_conn.cursor() as cursor:
+        cursor.execute("SELECT bytes FROM transfer_sample ORDER BY sampled_at;")
+        assert cursor.fetchall() == [(50,), (20,)]
+        cursor.execute("SELECT fk_outline_server_id, outline_key_id, bytes FROM transfer_last ORDER BY 1;")
+        assert cursor.fetchall() == [(1, 1, 20), (2, 1, 30)]